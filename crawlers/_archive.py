@@ -0,0 +1,140 @@
+"""
+把检查直接写成压缩包，不在 download 下生成文件夹，省去下载完再打包的一遍读写。
+
+压缩包里的路径跟写入文件夹时一样，以检查目录名开头，比如 `张三-CT-20240101/[1] 头部/001.dcm`。
+临时文件写在压缩包旁边的 .partial 目录，放入压缩包后即删除。
+
+中断时的情况：
+
+- TAR：任何时候都是完整的，哪怕进程被杀掉。每个条目先写数据和结尾标记，最后才写头部的第一个块，
+  在那之前读取时会把该位置当作结尾（全零块），所以最多丢失正在写的那个。
+- ZIP：中央目录在末尾，出错或者按 Ctrl+C 时会写完它；但进程被强行杀掉的话就只能用修复工具了。
+"""
+import shutil
+import tarfile
+from abc import ABC, abstractmethod
+import threading
+import time
+import zipfile
+from io import BytesIO
+from pathlib import Path
+
+from crawlers._utils import next_unique_name
+
+# 命令行选项的值到扩展名和压缩方式。
+FORMATS = {
+	"zip": (".zip", zipfile.ZIP_DEFLATED),
+	"zip-store": (".zip", zipfile.ZIP_STORED),
+	"tar": (".tar", None),
+}
+
+_BLOCK = 512
+
+_COPY_SIZE = 1024 * 1024
+
+
+class ArchiveSink(ABC):
+	"""
+	一个检查的压缩包，add_file() 可以在多个线程里调用，写入由锁串行化。
+	"""
+
+	def __init__(self, study_dir: Path, path: Path):
+		self.study_dir = study_dir
+		self.path = path
+		self.partial_dir = path.with_name(path.name + ".partial")
+		self.series_names: set[str] = set()
+		self._lock = threading.Lock()
+
+	def entry_name(self, file: Path):
+		"""检查目录下的文件在压缩包里的名字。"""
+		return file.relative_to(self.study_dir.parent).as_posix()
+
+	def add_file(self, file: Path, source: Path):
+		"""把 source 的内容作为 file 写入压缩包，file 是它在检查目录下的路径。"""
+		with self._lock, source.open("rb") as fp:
+			self._write(self.entry_name(file), fp, source.stat().st_size)
+
+	def add_bytes(self, file: Path, data: bytes):
+		with self._lock:
+			self._write(self.entry_name(file), BytesIO(data), len(data))
+
+	@abstractmethod
+	def _write(self, name: str, fp, size: int):
+		"""写入一个条目，调用方已持有锁。"""
+
+	@abstractmethod
+	def close(self):
+		pass
+
+
+class _TarSink(ArchiveSink):
+
+	def __init__(self, study_dir: Path, path: Path):
+		super().__init__(study_dir, path)
+		self._fp = path.open("xb")
+		self._fp.write(bytes(_BLOCK * 2))
+		self._end = 0
+
+	def _write(self, name: str, fp, size: int):
+		info = tarfile.TarInfo(name)
+		info.size, info.mtime, info.mode = size, int(time.time()), 0o644
+		header = info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+
+		# 数据写在头部之后的位置，然后是新的结尾标记。
+		out = self._fp
+		out.seek(self._end + len(header))
+		shutil.copyfileobj(fp, out, _COPY_SIZE)
+		out.write(bytes(-size % _BLOCK + _BLOCK * 2))
+
+		# 头部可能有多个块（中文名需要 PAX 扩展头），第一个块最后写，它写入前这里还是结尾。
+		out.seek(self._end + _BLOCK)
+		out.write(header[_BLOCK:])
+		out.flush()
+		out.seek(self._end)
+		out.write(header[:_BLOCK])
+		out.flush()
+
+		self._end += len(header) + size + (-size % _BLOCK)
+
+	def close(self):
+		with self._lock:
+			self._fp.close()
+
+
+class _ZipSink(ArchiveSink):
+
+	def __init__(self, study_dir: Path, path: Path, compression: int):
+		super().__init__(study_dir, path)
+
+		# 压缩级别只对 ZIP_DEFLATED 有意义。
+		options = {"compresslevel": 1} if compression == zipfile.ZIP_DEFLATED else {}
+		self._zip = zipfile.ZipFile(path, "x", compression, allowZip64=True, **options)
+
+	def _write(self, name: str, fp, size: int):
+		info = zipfile.ZipInfo(name, time.localtime()[:6])
+		info.compress_type = self._zip.compression
+		info.external_attr = 0o644 << 16
+		info.file_size = size
+		with self._zip.open(info, "w") as out:
+			shutil.copyfileobj(fp, out, _COPY_SIZE)
+
+	def close(self):
+		with self._lock:
+			self._zip.close()
+
+
+def open_archive(study_dir: Path, format_: str):
+	"""
+	为检查创建压缩包，名字是检查目录名加扩展名，已存在时添加编号，不会覆盖。
+	"""
+	extension, compression = FORMATS[format_]
+	study_dir.parent.mkdir(parents=True, exist_ok=True)
+	name = study_dir.name
+	while True:
+		path = study_dir.with_name(name + extension)
+		try:
+			if compression is None:
+				return _TarSink(study_dir, path)
+			return _ZipSink(study_dir, path, compression)
+		except FileExistsError:
+			name = next_unique_name(name)
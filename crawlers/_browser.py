@@ -1,29 +1,34 @@
 import asyncio
-import asyncio
+import re
 import sys
-from typing import Any
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from http.cookies import Morsel
+from typing import Optional
 
+from aiohttp import CookieJar
 from playwright.async_api import Frame, Page, ElementHandle, Playwright, Browser, Error, BrowserContext, WebSocket, \
-	Response, async_playwright
+	Response, Request, Route, async_playwright
+from yarl import URL
 
-_driver_instance: Any = None
-_playwright: Playwright
-_browser: Browser
+from crawlers._utils import new_http_client, fetch_options, add_summary
 
 
-async def launch_browser(playwright: Playwright) -> Browser:
+async def launch_browser(playwright: Playwright, headless=False) -> Browser:
 	"""
 	考虑到 Playwright 的支持成熟度，还是尽可能地选择 chromium 系浏览器。
 	"""
 	try:
-		return await playwright.chromium.launch(headless=False)
+		return await playwright.chromium.launch(headless=headless)
 	except Error as e:
 		if not e.message.startswith("BrowserType.launch: Executable doesn't exist"):
 			raise
 
 	if sys.platform == "win32":
 		print("PlayWright: 使用 Windows 自带的 Edge 浏览器。")
-		return await playwright.chromium.launch(headless=False,
+		return await playwright.chromium.launch(headless=headless,
 			executable_path=r"C:\Program Files (x86)\Microsoft\Edge\Application\msedge.exe")
 
 	raise Exception("在该系统上运行必须提供浏览器的路径。")
@@ -40,6 +45,86 @@ async def wait_text(context: Page | Frame | ElementHandle, selector: str):
 	return await (await context.wait_for_selector(selector)).text_content()
 
 
+# 这些请求头由 aiohttp 自己生成，或者已经在 Cookie 罐里了。
+_SKIPPED_HEADERS = {"cookie", "host", "content-length", "connection", "accept-encoding"}
+
+
+async def export_http_client(context: BrowserContext, request: Request):
+	"""
+	浏览器完成登录和反爬验证之后，用它的 Cookies 和某个请求的请求头创建 aiohttp 会话，
+	从而能绕过页面直接下载，不受查看器一张张加载的限制。
+
+	:param context: 浏览器上下文，从中导出 Cookies
+	:param request: 要模仿的请求，通常是一个图像的请求
+	"""
+	headers = {}
+	for name, value in (await request.all_headers()).items():
+		# HTTP2 的伪头部以冒号开头。
+		if not name.startswith(":") and name not in _SKIPPED_HEADERS:
+			headers[name.title()] = value
+
+	jar = CookieJar(quote_cookie=False)
+	for cookie in await context.cookies():
+		morsel = Morsel()
+		morsel.set(cookie["name"], cookie["value"], cookie["value"])
+		morsel["path"] = cookie["path"]
+		morsel["secure"] = cookie["secure"]
+
+		# 没有点开头的是 host-only 的，不设置 domain 就会绑定到 URL 的主机。
+		domain = cookie["domain"]
+		if domain.startswith("."):
+			morsel["domain"] = domain
+		jar.update_cookies({cookie["name"]: morsel}, URL(f"https://{domain.lstrip('.')}"))
+
+	return new_http_client(headers=headers, cookie_jar=jar)
+
+
+_DIGITS = re.compile(r"(\d+)")
+
+
+class UrlPattern:
+	"""
+	从几个 URL 推断出同类资源的 URL，要求它们只有一处数字不同，例如 .../1.dcm 和 .../2.dcm。
+	"""
+
+	def __init__(self, parts: list[str], position: int, width: int):
+		self.parts = parts
+		self.position = position
+		self.width = width
+
+	@staticmethod
+	def infer(urls: list[str]) -> Optional["UrlPattern"]:
+		"""推断不出来则返回 None，至少需要两个 URL。"""
+		splits = [_DIGITS.split(url) for url in urls]
+		if len(splits) < 2 or any(len(x) != len(splits[0]) for x in splits):
+			return None
+
+		varying = [i for i in range(len(splits[0])) if len({x[i] for x in splits}) > 1]
+		if len(varying) != 1 or varying[0] % 2 == 0:
+			return None
+
+		# 有前导 0 的说明是定宽的，否则宽度为 0 即不填充。
+		position = varying[0]
+		numbers = [x[position] for x in splits]
+		width = len(numbers[0]) if any(n.startswith("0") and len(n) > 1 for n in numbers) else 0
+
+		return UrlPattern(splits[0], position, width)
+
+	def number(self, url: str) -> Optional[int]:
+		"""返回 URL 里变化的那个数字，不符合该模式则为 None。"""
+		parts = _DIGITS.split(url)
+		if len(parts) != len(self.parts):
+			return None
+		if any(a != b for i, (a, b) in enumerate(zip(parts, self.parts)) if i != self.position):
+			return None
+		return int(parts[self.position])
+
+	def format(self, number: int):
+		parts = list(self.parts)
+		parts[self.position] = str(number).zfill(self.width)
+		return "".join(parts)
+
+
 class PlaywrightCrawler:
 	"""本项目的爬虫都比较简单，有固定的模式，所以写个抽象类来统一下代码"""
 
@@ -71,28 +156,228 @@ class PlaywrightCrawler:
 		context.on("response", self._on_response)
 		return self._do_run(context)
 
+	def detach(self, context: BrowserContext):
+		"""移除 run() 添加的监听器，以便上下文给下一个爬虫使用。"""
+		context.remove_listener("page", self._prepare_page)
+		context.remove_listener("response", self._on_response)
+
+
+# 下载影像用不到的资源类型，拦截掉能省流量，页面也加载得更快。
+# 样式表没有拦截，有些查看器要靠它来显示元素，而爬虫在等待元素可见。
+BLOCKED_RESOURCES = frozenset(("image", "font", "media"))
+
+# 统计和广告脚本，跟下载无关。
+_TRACKERS = re.compile(r"google-analytics\.com|googletagmanager\.com|hm\.baidu\.com|cnzz\.com|51\.la/|umeng\.com")
+
+
+class _StudyStats:
+	"""一次 run_with_browser 的统计，结束时打印。"""
+
+	def __init__(self, launch_time: float):
+		self.launch_time = launch_time
+		self.context_time = 0.0
+		self.blocked = Counter()
+		self.transferred = 0
+
+	async def on_request_finished(self, request: Request):
+		try:
+			sizes = await request.sizes()
+		except Error:
+			return  # 上下文已关闭
+		self.transferred += sizes["responseBodySize"] + sizes["responseHeadersSize"]
+
+	def summary(self):
+		blocked = "，".join(f"{k} {v}" for k, v in self.blocked.most_common()) or "无"
+		return (
+			f"浏览器启动 {self.launch_time:.1f} 秒，创建上下文 {self.context_time:.2f} 秒，"
+			f"传输 {self.transferred / 1048576:.1f}MB，拦截的请求：{blocked}"
+		)
+
+
+class BrowserPool:
+	"""
+	长期运行的浏览器，以及一组可重复使用的上下文，批量下载时省去每次启动浏览器的时间。
+	浏览器在第一次借用上下文时启动，所有上下文都会拦截 BLOCKED_RESOURCES 类型的请求和统计脚本。
+
+	上下文用完后关闭页面，清除 Cookies、路由和访问过的源的存储（localStorage、IndexedDB 等）再放回池中，
+	下一个检查可能是别人的分享链接，不能看到上一个的数据。清除失败或者爬虫自己关闭了上下文，就丢弃它。
+	"""
+
+	def __init__(self, size=2, headless=False, blocked=BLOCKED_RESOURCES):
+		"""
+		:param size: 最多同时使用的上下文数
+		:param headless: 是否以无头模式启动浏览器
+		:param blocked: 要拦截的资源类型，见 Playwright 的 Request.resource_type
+		"""
+		self.size = size
+		self.headless = headless
+		self.blocked = blocked
+		self.launch_time = 0.0
+
+		self._slots = asyncio.Semaphore(size)
+		self._idle: list[BrowserContext] = []
+		self._closed: set[BrowserContext] = set()
+		self._stats: dict[BrowserContext, _StudyStats] = {}
+		self._origins: dict[BrowserContext, set[str]] = {}
+		self._launching = asyncio.Lock()
+		self.browser: Optional[Browser] = None
+
+	async def __aenter__(self):
+		self._token = _pool.set(self)
+		return self
+
+	async def __aexit__(self, *ignore):
+		_pool.reset(self._token)
+		if self.browser:
+			await self.browser.close()
+			await self._driver.__aexit__(None, None, None)
+
+	async def _launch(self):
+		"""
+		第一次使用时才启动浏览器，批量下载里没有需要浏览器的网站就不用启动。
+		返回本次启动花费的时间，已经启动了的为 0。
+		"""
+		async with self._launching:
+			if self.browser:
+				return 0.0
+
+			start = time.perf_counter()
+			self._driver = async_playwright()
+			playwright = await self._driver.__aenter__()
+			try:
+				self.browser = await launch_browser(playwright, self.headless)
+			except BaseException:
+				await self._driver.__aexit__(None, None, None)
+				raise
+
+			self.launch_time = time.perf_counter() - start
+			return self.launch_time
+
+	async def _new_context(self, kwargs):
+		context = await self.browser.new_context(**kwargs)
+		context.on("close", self._closed.add)
+		context.on("request", lambda r: self._on_request(context, r))
+		context.on("requestfinished", lambda r: self._on_request_finished(context, r))
+		await self._install_filter(context)
+		return context
+
+	def _on_request(self, context: BrowserContext, request: Request):
+		url = URL(request.url)
+		if url.scheme in ("http", "https"):
+			self._origins.setdefault(context, set()).add(str(url.origin()))
+
+	async def _on_request_finished(self, context: BrowserContext, request: Request):
+		stats = self._stats.get(context)
+		if stats:
+			await stats.on_request_finished(request)
+
+	def _install_filter(self, context: BrowserContext):
+		return context.route("**/*", lambda route: self._filter(context, route))
+
+	async def _filter(self, context: BrowserContext, route: Route):
+		request = route.request
+		if request.resource_type in self.blocked:
+			kind = request.resource_type
+		elif _TRACKERS.search(request.url):
+			kind = "tracker"
+		else:
+			return await route.fallback()
+
+		# 不是从 context() 借出的上下文（比如正在回收的）没有统计。
+		stats = self._stats.get(context)
+		if stats:
+			stats.blocked[kind] += 1
+		await route.abort()
+
+	async def _recycle(self, context: BrowserContext):
+		if context in self._closed:
+			return False
+		try:
+			for page in context.pages:
+				await page.close()
+			await self._clear_storage(context)
+			await context.clear_cookies()
+			await context.unroute_all(behavior="ignoreErrors")
+			await self._install_filter(context)
+		except Error:
+			return False
+		return True
+
+	async def _clear_storage(self, context: BrowserContext):
+		"""
+		Playwright 没有清除存储的接口，只能用 Chromium 的 CDP，其它浏览器会抛出 Error，上下文就不复用了。
+		sessionStorage 属于页面，已经随页面关闭了。
+		"""
+		origins = self._origins.pop(context, ())
+		if not origins:
+			return
+		page = await context.new_page()
+		try:
+			session = await context.new_cdp_session(page)
+			for origin in origins:
+				await session.send("Storage.clearDataForOrigin", {"origin": origin, "storageTypes": "all"})
+			await session.detach()
+		finally:
+			await page.close()
+
+	@asynccontextmanager
+	async def context(self, **kwargs):
+		"""
+		借用一个上下文，带参数的不能共用，会新建并在用完后关闭。
+
+		:param kwargs: 转发到 Browser.new_context() 的参数
+		"""
+		async with self._slots:
+			# 只有启动了浏览器的那次要算上启动的时间。
+			stats = _StudyStats(await self._launch())
+
+			start = time.perf_counter()
+			reusable = not kwargs
+			if reusable and self._idle:
+				context = self._idle.pop()
+			else:
+				context = await self._new_context(kwargs)
+
+			stats.context_time = time.perf_counter() - start
+			self._stats[context] = stats
+			add_summary(stats.summary)
+
+			try:
+				yield context
+			finally:
+				if reusable and await self._recycle(context):
+					self._idle.append(context)
+				else:
+					self._closed.discard(context)
+					self._stats.pop(context, None)
+					self._origins.pop(context, None)
+					await context.close()
+
+
+_pool: ContextVar[Optional[BrowserPool]] = ContextVar("browser_pool", default=None)
+
 
 async def run_with_browser(crawler: PlaywrightCrawler, **kwargs):
 	"""
-	启动 Playwright 浏览器的快捷函数，单个 Browser 实例创建新的 Context。
+	启动 Playwright 浏览器的快捷函数，从浏览器池借一个上下文来运行爬虫。
 
-	因为这库有四层（ContextManager，Playwright，Browser，BrowserContext）
-	每次启动都要嵌套好几个 with 很烦，所以搞了一个全局的实例并支持自动销毁。
+	如果外层已经打开了 BrowserPool（比如批量下载时）就用它，
+	否则临时启动一个浏览器，运行完就关闭，是否无头由 fetch_options 决定。
 
 	:param crawler:
 	:param kwargs: 转发到 Browser.new_context() 的参数
 	"""
-	global _browser, _playwright, _driver_instance
+	pool = _pool.get()
+	if pool:
+		return await _run_in_pool(pool, crawler, kwargs)
 
-	if not _driver_instance:
-		_driver_instance = async_playwright()
-		_playwright = await _driver_instance.__aenter__()
-		_browser = await launch_browser(_playwright)
+	async with BrowserPool(1, fetch_options.get().headless) as pool:
+		return await _run_in_pool(pool, crawler, kwargs)
 
-	try:
-		async with await _browser.new_context(**kwargs) as context:
+
+async def _run_in_pool(pool: BrowserPool, crawler: PlaywrightCrawler, kwargs):
+	async with pool.context(**kwargs) as context:
+		try:
 			return await crawler.run(context)
-	finally:
-		if len(_browser.contexts) == 0:
-			await _browser.close()
-			await _driver_instance.__aexit__()
+		finally:
+			crawler.detach(context)
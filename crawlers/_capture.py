@@ -0,0 +1,95 @@
+"""
+调试用的响应抓包格式，每个序列一个数据文件加一个索引文件，都只追加写入：
+
+- responses.pack：依次拼接每张图的标签 JSON、图像属性和像素。
+- responses.idx：每行一个 JSON，记录一张图的三段数据在 pack 里的位置，行号就是图的序号。
+
+先写数据再写索引，中断时最多丢失最后一张，已有的记录仍然完整可用。
+"""
+import json
+import mmap
+from dataclasses import dataclass
+from pathlib import Path
+
+PACK_FILE = "responses.pack"
+INDEX_FILE = "responses.idx"
+
+
+@dataclass(slots=True, frozen=True)
+class CaptureRecord:
+	"""一张图的数据在 pack 文件里的位置，三段是连续存放的。"""
+
+	offset: int
+	tags: int
+	attrs: int
+	pixels: int
+
+
+class CaptureWriter:
+
+	def __init__(self, directory: Path):
+		self._pack = directory.joinpath(PACK_FILE).open("ab")
+		self._index = directory.joinpath(INDEX_FILE).open("a", encoding="utf8")
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *ignore):
+		self.close()
+
+	def append(self, tags: bytes, attrs: bytes, pixels: bytes):
+		offset = self._pack.tell()
+		self._pack.write(tags)
+		self._pack.write(attrs)
+		self._pack.write(pixels)
+		self._pack.flush()
+
+		record = {"offset": offset, "tags": len(tags), "attrs": len(attrs), "pixels": len(pixels)}
+		self._index.write(json.dumps(record) + "\n")
+		self._index.flush()
+
+	def close(self):
+		self._pack.close()
+		self._index.close()
+
+
+def read_index(directory: Path):
+	"""
+	读取索引，返回每张图的记录。最后一行可能因为中断而不完整，忽略它。
+	"""
+	records = []
+	with directory.joinpath(INDEX_FILE).open(encoding="utf8") as fp:
+		for line in fp:
+			try:
+				records.append(CaptureRecord(**json.loads(line)))
+			except ValueError:
+				break
+	return records
+
+
+class CaptureFile:
+	"""
+	用 mmap 读取 pack 文件，像素以 memoryview 返回而不复制，用完之前不能关闭。
+	"""
+
+	def __init__(self, pack: Path):
+		with pack.open("rb") as fp:
+			self._map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *ignore):
+		self._map.close()
+
+	def tags(self, record: CaptureRecord) -> list:
+		start = record.offset
+		return json.loads(self._map[start:start + record.tags])
+
+	def attrs(self, record: CaptureRecord) -> str:
+		start = record.offset + record.tags
+		return self._map[start:start + record.attrs].decode()
+
+	def pixels(self, record: CaptureRecord) -> memoryview:
+		start = record.offset + record.tags + record.attrs
+		return memoryview(self._map)[start:start + record.pixels]
@@ -0,0 +1,207 @@
+"""
+已下载影像的目录，保存在 SQLite 数据库里，用来快速查找某个患者、某天的检查下载过没有。
+
+有检查、序列、实例三张表，数据都来自 DCM 文件的头部（不读像素）。下载时每保存一个文件就添加一条，
+已有的下载目录可以用 tools/catalog.py 重建。
+"""
+import sqlite3
+import struct
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+
+from pydicom import dcmread, Dataset
+from pydicom.errors import InvalidDicomError, BytesLengthException
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS study (
+	uid TEXT PRIMARY KEY,
+	patient_name TEXT,
+	patient_id TEXT,
+	birth_date TEXT,
+	sex TEXT,
+	date TEXT,
+	time TEXT,
+	description TEXT,
+	accession TEXT,
+	path TEXT
+);
+CREATE TABLE IF NOT EXISTS series (
+	uid TEXT PRIMARY KEY,
+	study_uid TEXT NOT NULL,
+	number INTEGER,
+	modality TEXT,
+	description TEXT,
+	path TEXT
+);
+CREATE TABLE IF NOT EXISTS instance (
+	path TEXT PRIMARY KEY,
+	uid TEXT,
+	series_uid TEXT NOT NULL,
+	number INTEGER,
+	size INTEGER
+);
+CREATE INDEX IF NOT EXISTS study_patient ON study (patient_name);
+CREATE INDEX IF NOT EXISTS study_date ON study (date);
+CREATE INDEX IF NOT EXISTS series_study ON series (study_uid);
+CREATE INDEX IF NOT EXISTS instance_series ON instance (series_uid, size);
+CREATE INDEX IF NOT EXISTS instance_uid ON instance (uid);
+"""
+
+# 读取头部时只解析这些标签，跳过其它的能快不少。DICOMDIR 也用它们。
+HEADER_TAGS = [
+	"SpecificCharacterSet", "StudyInstanceUID", "PatientName", "PatientID", "PatientBirthDate", "PatientSex",
+	"StudyDate", "StudyTime", "StudyDescription", "StudyID", "AccessionNumber",
+	"SeriesInstanceUID", "SeriesNumber", "Modality", "SeriesDescription",
+	"SOPClassUID", "SOPInstanceUID", "InstanceNumber",
+]
+
+
+@dataclass(slots=True, frozen=True)
+class InstanceHeader:
+	"""一个文件在目录里的所有信息，可以在进程间传递。"""
+
+	path: str
+	size: int
+	study: tuple
+	series: tuple
+	instance: tuple
+
+
+def _text(value):
+	return None if value is None or value == "" else str(value)
+
+
+def _number(value):
+	return None if value is None or value == "" else int(value)
+
+
+def read_dataset(file: Path):
+	"""只读取 DCM 文件头部的 HEADER_TAGS，不是 DICOM 文件或者头部被截断的返回 None。"""
+	try:
+		return dcmread(file, stop_before_pixels=True, specific_tags=HEADER_TAGS)
+	except (InvalidDicomError, BytesLengthException, EOFError, struct.error, ValueError, OSError):
+		return None
+
+
+def read_header(file: Path):
+	"""
+	只读取 DCM 文件的头部，返回要存入目录的信息，不是 DICOM 文件或缺少 UID 的返回 None。
+	"""
+	ds = read_dataset(file)
+	if ds is not None:
+		return header_from_dataset(file, ds, file.stat().st_size)
+
+
+def header_from_dataset(file: Path, ds: Dataset, size: int):
+	"""从已读取的头部提取要存入目录的信息，缺少 UID 的返回 None。"""
+	study_uid, series_uid = ds.get("StudyInstanceUID"), ds.get("SeriesInstanceUID")
+	if not study_uid or not series_uid:
+		return None
+
+	path = file.absolute()
+	study = (
+		str(study_uid), _text(ds.get("PatientName")), _text(ds.get("PatientID")),
+		_text(ds.get("PatientBirthDate")), _text(ds.get("PatientSex")),
+		_text(ds.get("StudyDate")), _text(ds.get("StudyTime")),
+		_text(ds.get("StudyDescription")), _text(ds.get("AccessionNumber")),
+		str(path.parent.parent),
+	)
+	series = (
+		str(series_uid), str(study_uid), _number(ds.get("SeriesNumber")),
+		_text(ds.get("Modality")), _text(ds.get("SeriesDescription")), str(path.parent),
+	)
+	instance = (
+		str(path), _text(ds.get("SOPInstanceUID")), str(series_uid), _number(ds.get("InstanceNumber")),
+	)
+	return InstanceHeader(str(path), size, study, series, instance)
+
+
+class Catalog:
+	"""
+	可以在多个线程里同时调用 add()，写入由锁串行化，每 commit_every 条提交一次事务，关闭时提交剩余的。
+	多个进程同时写同一个数据库也没问题，SQLite 会让它们排队。
+	"""
+
+	def __init__(self, file: Path, commit_every=200):
+		file.parent.mkdir(parents=True, exist_ok=True)
+		self._db = sqlite3.connect(file, timeout=30, check_same_thread=False)
+		self._db.execute("PRAGMA journal_mode=WAL")
+		self._db.executescript(_SCHEMA)
+		self._lock = threading.Lock()
+		self._commit_every = commit_every
+		self._uncommitted = 0
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *ignore):
+		self.close()
+
+	def add(self, header: InstanceHeader):
+		with self._lock:
+			db = self._db
+			db.execute("INSERT OR REPLACE INTO study VALUES (?,?,?,?,?,?,?,?,?,?)", header.study)
+			db.execute("INSERT OR REPLACE INTO series VALUES (?,?,?,?,?,?)", header.series)
+			db.execute("INSERT OR REPLACE INTO instance VALUES (?,?,?,?,?)", header.instance + (header.size,))
+
+			self._uncommitted += 1
+			if self._uncommitted >= self._commit_every:
+				db.commit()
+				self._uncommitted = 0
+
+	def remove_missing(self):
+		"""删除文件已不存在的实例，以及没有实例的序列和检查，返回删除的实例数。"""
+		with self._lock:
+			missing = [(p,) for (p,) in self._db.execute("SELECT path FROM instance") if not Path(p).is_file()]
+			self._db.executemany("DELETE FROM instance WHERE path = ?", missing)
+			self._db.execute("DELETE FROM series WHERE uid NOT IN (SELECT series_uid FROM instance)")
+			self._db.execute("DELETE FROM study WHERE uid NOT IN (SELECT study_uid FROM series)")
+			self._db.commit()
+			return len(missing)
+
+	def find_studies(self, patient: str = None, modality: str = None, date_from: str = None, date_to: str = None):
+		"""
+		查找检查，返回字典的列表，包含检查的信息、模态、序列数、实例数和总大小，按日期倒序排列。
+
+		:param patient: 患者姓名或 ID 包含的文字
+		:param modality: 包含该模态的序列，如 CT、MR
+		:param date_from: 检查日期的下限，格式为 YYYYMMDD，包含当天
+		:param date_to: 检查日期的上限，格式同上，也可以只写年份或年月
+		"""
+		conditions, params = [], []
+		if patient:
+			conditions.append("(s.patient_name LIKE ? OR s.patient_id LIKE ?)")
+			params += [f"%{patient}%"] * 2
+		if modality:
+			conditions.append("s.uid IN (SELECT study_uid FROM series WHERE modality = ?)")
+			params.append(modality.upper())
+		if date_from:
+			conditions.append("s.date >= ?")
+			params.append(date_from)
+		if date_to:
+			# 后面补上 ~ 使得 202403 包含三月的所有日期。
+			conditions.append("s.date <= ?")
+			params.append(date_to + "~")
+
+		where = "WHERE " + " AND ".join(conditions) if conditions else ""
+		# 实例数和大小用索引 instance_series 就能算出，不用读取实例表，五万个实例也只要十几毫秒。
+		sql = f"""
+			SELECT s.*, group_concat(DISTINCT r.modality) AS modalities, count(*) AS series_count,
+				sum((SELECT count(*) FROM instance WHERE series_uid = r.uid)) AS instances,
+				sum((SELECT sum(size) FROM instance WHERE series_uid = r.uid)) AS size
+			FROM study s
+			JOIN series r ON r.study_uid = s.uid
+			{where}
+			GROUP BY s.uid
+			ORDER BY s.date DESC, s.time DESC
+		"""
+		with self._lock:
+			cursor = self._db.execute(sql, params)
+			names = [c[0] for c in cursor.description]
+			return [dict(zip(names, row)) for row in cursor]
+
+	def close(self):
+		with self._lock:
+			self._db.commit()
+			self._db.close()
@@ -0,0 +1,136 @@
+"""
+多个会话共用的连接池，批量下载时同一个医院的检查不必每次都重新解析 DNS、建立 TCP 连接和 TLS 握手。
+
+打开 ConnectionPool 之后，new_http_client() 创建的会话都使用它的连接器，会话关闭时不会关闭连接器，
+重试策略也用它的，这样同一个主机的失败在所有会话里累计到一个断路器上。
+统计数据来自 aiohttp 的 TraceConfig，新建连接算未命中，复用空闲的连接算命中。
+"""
+from contextvars import ContextVar
+from types import SimpleNamespace
+from typing import Optional
+
+from aiohttp import TCPConnector, TraceConfig
+
+from crawlers._retry import RetryPolicy
+
+
+def new_connector(limit=100, limit_per_host=0, keepalive_timeout=15.0, dns_ttl=10, happy_eyeballs_delay=0.25):
+	"""
+	创建连接器，参数的含义跟 FetchOptions 里的同名字段相同，0 表示不限制或者关闭。
+
+	:param limit: 同时打开的连接数上限
+	:param limit_per_host: 每个主机同时打开的连接数上限
+	:param keepalive_timeout: 空闲连接保留的秒数，0 表示用完即关闭。
+	:param dns_ttl: DNS 解析结果缓存的秒数
+	:param happy_eyeballs_delay: 同时有 IPv4 和 IPv6 地址时，等待前一个地址连接多少秒再尝试下一个
+	"""
+	if keepalive_timeout:
+		keepalive = {"keepalive_timeout": keepalive_timeout}
+	else:
+		# aiohttp 的 None 表示一直保留，而且不能跟 force_close 一起传。
+		keepalive = {"force_close": True}
+
+	return TCPConnector(
+		limit=limit,
+		limit_per_host=limit_per_host,
+		use_dns_cache=dns_ttl > 0,
+		ttl_dns_cache=dns_ttl or None,
+		happy_eyeballs_delay=happy_eyeballs_delay or None,
+		**keepalive,
+	)
+
+
+class _HostStats:
+	__slots__ = ("hits", "misses")
+
+	def __init__(self):
+		self.hits = 0
+		self.misses = 0
+
+
+class ConnectionPool:
+	"""
+	进程内共用的连接器，用 async with 打开，在其中创建的会话（包括子任务里的）都会使用它。
+	"""
+
+	def __init__(self, retries=0, **kwargs):
+		"""
+		:param retries: 共用的重试策略最多重试的次数，为 0 则没有，由各个会话自己决定。
+		:param kwargs: 转发到 new_connector() 的参数
+		"""
+		self.kwargs = kwargs
+		self.retry_policy = RetryPolicy(retries) if retries > 0 else None
+		self.connector: Optional[TCPConnector] = None
+		self.hosts: dict[str, _HostStats] = {}
+		self.dns_hits = 0
+		self.dns_misses = 0
+
+		self.trace_config = TraceConfig(SimpleNamespace)
+		self.trace_config.on_request_start.append(self._on_request)
+		self.trace_config.on_request_redirect.append(self._on_request)
+		self.trace_config.on_connection_reuseconn.append(self._on_reuse)
+		self.trace_config.on_connection_create_end.append(self._on_create)
+		self.trace_config.on_dns_cache_hit.append(self._on_dns_hit)
+		self.trace_config.on_dns_cache_miss.append(self._on_dns_miss)
+
+	async def __aenter__(self):
+		self.connector = new_connector(**self.kwargs)
+		self._token = _pool.set(self)
+		return self
+
+	async def __aexit__(self, *ignore):
+		_pool.reset(self._token)
+		await self.connector.close()
+
+	@property
+	def hits(self):
+		return sum(s.hits for s in self.hosts.values())
+
+	@property
+	def misses(self):
+		return sum(s.misses for s in self.hosts.values())
+
+	def _host_stats(self, context):
+		host = context.host
+		stats = self.hosts.get(host)
+		if stats is None:
+			stats = self.hosts[host] = _HostStats()
+		return stats
+
+	async def _on_request(self, _, context, params):
+		# 连接的事件不带 URL，只能在请求开始时记下主机，重定向则换成新的。
+		context.host = params.url.host
+
+	async def _on_reuse(self, _, context, params):
+		self._host_stats(context).hits += 1
+
+	async def _on_create(self, _, context, params):
+		self._host_stats(context).misses += 1
+
+	async def _on_dns_hit(self, *ignore):
+		self.dns_hits += 1
+
+	async def _on_dns_miss(self, *ignore):
+		self.dns_misses += 1
+
+	def summary(self):
+		hits, misses = self.hits, self.misses
+		lines = []
+		if hits + misses:
+			lines.append(
+				f"连接池：复用连接 {hits} 次，新建 {misses} 个（命中率 {hits / (hits + misses):.0%}），"
+				f"DNS 缓存命中 {self.dns_hits} 次，未命中 {self.dns_misses} 次"
+			)
+			for host, stats in self.hosts.items():
+				lines.append(f"{host}：复用 {stats.hits} 次，新建 {stats.misses} 个")
+		if self.retry_policy and self.retry_policy.summary():
+			lines.append(self.retry_policy.summary())
+		return "\n".join(lines)
+
+
+_pool: ContextVar[Optional[ConnectionPool]] = ContextVar("connection_pool", default=None)
+
+
+def shared_pool():
+	"""当前打开的 ConnectionPool，没有则为 None。"""
+	return _pool.get()
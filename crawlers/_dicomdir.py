@@ -0,0 +1,277 @@
+"""
+为每个检查目录生成 DICOMDIR 和 manifest.json，阅片软件读一个文件就能知道整个检查有哪些实例，
+不用打开每个 DCM 文件。
+
+两者都由下载时读取的头部生成，不需要事后重新扫描。manifest.json 同时是增量的记录，
+断点续传时先加载它，再加上新下载的实例。
+
+注意 DICOMDIR 里的文件路径用的是可读的目录名（可能有中文和空格），以 UTF-8 编码，
+严格来说标准只允许 8 个字符以内的大写字母和数字，但常见的阅片软件都能识别。
+"""
+import json
+import os
+import struct
+import threading
+from pathlib import Path
+
+from pydicom import Dataset
+from pydicom.dataset import FileMetaDataset
+from pydicom.filebase import DicomBytesIO
+from pydicom.filewriter import write_file_meta_info
+from pydicom.uid import ExplicitVRLittleEndian, MediaStorageDirectoryStorage, generate_uid, PYDICOM_IMPLEMENTATION_UID
+
+from crawlers._catalog import read_dataset
+
+MANIFEST_FILE = "manifest.json"
+DICOMDIR_FILE = "DICOMDIR"
+
+# 清单里实例的字段，每个实例是一个数组，比对象省不少空间。
+INSTANCE_FIELDS = ["file", "uid", "number", "class", "syntax", "size"]
+
+_ITEM = b"\xfe\xff\x00\xe0"
+_SEQUENCE_DELIMITER = b"\xfe\xff\xdd\xe0\x00\x00\x00\x00"
+
+
+def _get_text(ds: Dataset, keyword: str):
+	value = ds.get(keyword)
+	return "" if value is None else str(value)
+
+
+def _get_number(ds: Dataset, keyword: str):
+	value = ds.get(keyword)
+	return None if value is None or value == "" else int(value)
+
+
+class StudyIndex:
+	"""
+	一个检查目录的索引，add() 可以在多个线程里同时调用，save() 写入 manifest.json 和 DICOMDIR。
+	"""
+
+	def __init__(self, study_dir: Path, resume=True):
+		"""
+		:param study_dir: 检查目录
+		:param resume: 是否加载目录里已有的清单，继续添加
+		"""
+		self.study_dir = study_dir
+		self.manifest = {"patient": {}, "study": {}, "fields": INSTANCE_FIELDS, "series": {}}
+		self._lock = threading.Lock()
+		self._dirty = False
+
+		file = study_dir / MANIFEST_FILE
+		if resume and file.is_file():
+			self.manifest = json.loads(file.read_text("utf8"))
+
+	def add(self, file: Path, ds: Dataset, size: int):
+		series_uid = _get_text(ds, "SeriesInstanceUID")
+		if not series_uid:
+			return
+
+		relative = file.relative_to(self.study_dir)
+		instance = [
+			relative.name, _get_text(ds, "SOPInstanceUID"), _get_number(ds, "InstanceNumber"),
+			_get_text(ds, "SOPClassUID"), str(ds.file_meta.get("TransferSyntaxUID", ExplicitVRLittleEndian)), size,
+		]
+
+		with self._lock:
+			manifest = self.manifest
+			if not manifest["study"]:
+				manifest["patient"] = {
+					"name": _get_text(ds, "PatientName"),
+					"id": _get_text(ds, "PatientID"),
+					"birth_date": _get_text(ds, "PatientBirthDate"),
+					"sex": _get_text(ds, "PatientSex"),
+				}
+				manifest["study"] = {
+					"uid": _get_text(ds, "StudyInstanceUID"),
+					"id": _get_text(ds, "StudyID"),
+					"date": _get_text(ds, "StudyDate"),
+					"time": _get_text(ds, "StudyTime"),
+					"description": _get_text(ds, "StudyDescription"),
+					"accession": _get_text(ds, "AccessionNumber"),
+				}
+
+			series = manifest["series"].get(series_uid)
+			if series is None:
+				series = manifest["series"][series_uid] = {
+					"dir": relative.parent.as_posix(),
+					"number": _get_number(ds, "SeriesNumber"),
+					"modality": _get_text(ds, "Modality"),
+					"description": _get_text(ds, "SeriesDescription"),
+					"instances": {},
+				}
+			series["instances"][relative.name] = instance
+			self._dirty = True
+
+	def add_existing(self, series_dir: Path):
+		"""
+		添加序列目录里还不在清单中的 DCM 文件，只读取它们的头部。
+		用于断点续传，上次运行被强行结束时已下载的实例没来得及写入清单。
+		"""
+		relative = series_dir.relative_to(self.study_dir).as_posix()
+		with self._lock:
+			known = set()
+			for series in self.manifest["series"].values():
+				if series["dir"] == relative:
+					known.update(series["instances"])
+
+		for file in series_dir.glob("*.dcm"):
+			if file.name not in known:
+				ds = read_dataset(file)
+				if ds is not None:
+					self.add(file, ds, file.stat().st_size)
+
+	def dump(self):
+		"""返回文件名到内容的字典，没有新的实例时为空。"""
+		with self._lock:
+			if not self._dirty:
+				return {}
+			self._dirty = False
+			text = json.dumps(self.manifest, ensure_ascii=False, separators=(",", ":"))
+			return {MANIFEST_FILE: text.encode(), DICOMDIR_FILE: build_dicomdir(self.manifest)}
+
+	def save(self):
+		"""有新的实例时才写入，都是先写临时文件再改名，中断也不会损坏已有的。"""
+		for name, data in self.dump().items():
+			_replace(self.study_dir / name, data)
+
+
+def _replace(file: Path, data: bytes):
+	temp = file.with_name(file.name + ".tmp")
+	temp.write_bytes(data)
+	os.replace(temp, file)
+
+
+def _sort_key(series: dict):
+	return series["number"] is None, series["number"] or 0, series["dir"]
+
+
+def _element(tag: int, vr: bytes, value: bytes):
+	"""Explicit VR Little Endian 编码的元素，只用于长度字段为 2 字节的 VR。"""
+	if len(value) % 2:
+		value += b"\0" if vr == b"UI" else b" "
+	return struct.pack("<HH2sH", tag >> 16, tag & 0xFFFF, vr, len(value)) + value
+
+
+def _text(value):
+	return b"" if value is None else str(value).encode()
+
+
+def _record(record_type: bytes, elements: dict[int, tuple[bytes, bytes]]):
+	"""
+	编码一条目录记录，偏移量先写 0，它们总是在固定的位置，之后直接修改字节即可。
+	文本都以 UTF-8 编码，包括 CS 类型的文件路径，pydicom 不允许 CS 有中文所以没用它编码。
+	"""
+	elements[0x00041400] = b"UL", bytes(4)
+	elements[0x00041410] = b"US", b"\xff\xff"
+	elements[0x00041420] = b"UL", bytes(4)
+	elements[0x00041430] = b"CS", record_type
+	elements[0x00080005] = b"CS", b"ISO_IR 192"
+	return bytearray(b"".join(_element(tag, *elements[tag]) for tag in sorted(elements)))
+
+
+# 上面的前三个元素依次是 12、10、12 字节，值在最后 4 或 2 字节。
+_NEXT_OFFSET = slice(8, 12)
+_LOWER_OFFSET = slice(30, 34)
+
+
+class _Node:
+	"""DICOMDIR 里的一条记录，以及它的下级，offset 是它在文件里的位置。"""
+
+	__slots__ = ("record", "children", "offset")
+
+	def __init__(self, record: bytearray):
+		self.record = record
+		self.children: list[_Node] = []
+		self.offset = 0
+
+	def walk(self):
+		yield self
+		for child in self.children:
+			yield from child.walk()
+
+
+def _build_tree(manifest: dict):
+	patient, study = manifest["patient"], manifest["study"]
+	root = _Node(_record(b"PATIENT", {
+		0x00100010: (b"PN", _text(patient["name"])),
+		0x00100020: (b"LO", _text(patient["id"])),
+	}))
+	study_node = _Node(_record(b"STUDY", {
+		0x00080020: (b"DA", _text(study["date"])),
+		0x00080030: (b"TM", _text(study["time"])),
+		0x00080050: (b"SH", _text(study["accession"])),
+		0x00081030: (b"LO", _text(study["description"])),
+		0x0020000D: (b"UI", _text(study["uid"])),
+		0x00200010: (b"SH", _text(study["id"])),
+	}))
+	root.children.append(study_node)
+
+	for uid, series in sorted(manifest["series"].items(), key=lambda x: _sort_key(x[1])):
+		series_node = _Node(_record(b"SERIES", {
+			0x00080060: (b"CS", _text(series["modality"])),
+			0x0008103E: (b"LO", _text(series["description"])),
+			0x0020000E: (b"UI", _text(uid)),
+			0x00200011: (b"IS", _text(series["number"])),
+		}))
+		study_node.children.append(series_node)
+
+		directory = series["dir"].replace("/", "\\")
+		for name, sop_uid, number, sop_class, syntax, _ in sorted(series["instances"].values()):
+			series_node.children.append(_Node(_record(b"IMAGE", {
+				0x00041500: (b"CS", f"{directory}\\{name}".encode()),
+				0x00041510: (b"UI", _text(sop_class)),
+				0x00041511: (b"UI", _text(sop_uid)),
+				0x00041512: (b"UI", _text(syntax)),
+				0x00200013: (b"IS", _text(number)),
+			})))
+
+	return root
+
+
+def build_dicomdir(manifest: dict):
+	"""
+	生成 DICOMDIR 文件的内容，一个患者下一个检查，然后是各个序列和其中的实例。
+
+	记录之间用偏移量关联，偏移量是从文件开头算起的位置。每条记录只编码一次，
+	算出位置后直接改写其中的偏移量，三千个实例也只要几十毫秒，用 pydicom 编码则要好几秒。
+	"""
+	root = _build_tree(manifest)
+	nodes = list(root.walk())
+
+	meta = FileMetaDataset()
+	meta.MediaStorageSOPClassUID = MediaStorageDirectoryStorage
+	meta.MediaStorageSOPInstanceUID = generate_uid(entropy_srcs=[manifest["study"]["uid"]])
+	meta.TransferSyntaxUID = ExplicitVRLittleEndian
+	meta.ImplementationClassUID = PYDICOM_IMPLEMENTATION_UID
+
+	fp = DicomBytesIO()
+	fp.is_little_endian, fp.is_implicit_VR = True, False
+	fp.write(b"\x00" * 128 + b"DICM")
+	write_file_meta_info(fp, meta, enforce_standard=True)
+	header = fp.getvalue()
+
+	# 根目录只有一个患者，第一条和最后一条记录都是它。
+	offset = len(header) + 8 + 12 + 12 + 10 + 12
+	for node in nodes:
+		node.offset = offset
+		offset += 8 + len(node.record)
+
+	for node in nodes:
+		for current, following in zip(node.children, node.children[1:]):
+			current.record[_NEXT_OFFSET] = struct.pack("<I", following.offset)
+		if node.children:
+			node.record[_LOWER_OFFSET] = struct.pack("<I", node.children[0].offset)
+
+	parts = [
+		header,
+		_element(0x00041130, b"CS", b""),
+		_element(0x00041200, b"UL", struct.pack("<I", root.offset)),
+		_element(0x00041202, b"UL", struct.pack("<I", root.offset)),
+		_element(0x00041212, b"US", bytes(2)),
+		b"\x04\x00\x20\x12SQ\x00\x00\xff\xff\xff\xff",
+	]
+	for node in nodes:
+		parts.append(_ITEM + struct.pack("<I", len(node.record)))
+		parts.append(node.record)
+	parts.append(_SEQUENCE_DELIMITER)
+	return b"".join(parts)
@@ -0,0 +1,330 @@
+"""
+各站点共用的下载引擎，站点模块只需列出序列和实例，并提供下载单个实例的协程，
+剩下的并发控制、进度条、保存文件都由这里处理。
+"""
+import asyncio
+import sys
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Sequence
+
+from aiohttp import ClientResponse, ClientPayloadError, ClientConnectionError
+from tqdm import tqdm
+
+from crawlers._archive import ArchiveSink, open_archive
+from crawlers._catalog import Catalog, read_dataset, header_from_dataset
+from crawlers._dicomdir import StudyIndex
+from crawlers._journal import StudyJournal
+from crawlers._sink import spool, SpooledFile, clean_partial, PARTIAL_DIR, FileProducer
+from crawlers._store import ObjectStore
+from crawlers._transcode import Transcoder
+from crawlers._utils import SeriesDirectory, fetch_options, add_summary
+from crawlers._writer import FileWriter
+
+# 下载单个实例的协程，返回文件的内容，返回 None 则跳过该实例。
+# 也可以返回还没读取响应体的响应，由引擎边接收边写入文件，适合大文件；
+# 或者返回 FileProducer，由它自己写入引擎给的临时文件。
+InstanceFetch = Callable[[Any], Awaitable[bytes | ClientResponse | FileProducer | None]]
+
+
+class _StudyOutput:
+	"""
+	一个检查的输出，写入文件夹时有断点续传的日志，写成压缩包时则没有，两者都可以有索引。
+	除了 series_names 都在 FileWriter 的线程里调用。
+	"""
+
+	def __init__(self, study_dir: Path, archive_format: str, dicomdir: bool):
+		self.study_dir = study_dir
+		self.journal: StudyJournal | None = None
+		self.archive: ArchiveSink | None = None
+
+		if archive_format:
+			self.archive = open_archive(study_dir, archive_format)
+			self.partial_dir = self.archive.partial_dir
+		else:
+			self.partial_dir = study_dir / PARTIAL_DIR
+
+		clean_partial(self.partial_dir)
+		if not self.archive:
+			self.journal = StudyJournal(study_dir)
+
+		# 压缩包每次都是新的，不能接着文件夹里已有的清单。
+		self.index = StudyIndex(study_dir, resume=not self.archive) if dicomdir else None
+
+		# 上次运行被强行结束时清单没来得及保存，补上已下载的。
+		if self.index and self.journal:
+			for series_dir in self.journal.series_dirs():
+				self.index.add_existing(series_dir)
+
+	def close(self):
+		if self.journal:
+			self.journal.close()
+		clean_partial(self.partial_dir)
+
+		# 中断时也保存，断点续传会从已有的清单继续。
+		if self.index and self.archive:
+			for name, data in self.index.dump().items():
+				self.archive.add_bytes(self.study_dir / name, data)
+		elif self.index:
+			self.index.save()
+
+		if self.archive:
+			self.archive.close()
+
+
+class _SeriesJob:
+	"""引擎内部用的，记录一个序列的下载状态。"""
+
+	def __init__(self, directory: SeriesDirectory, desc: str, instances: Sequence, fetch: InstanceFetch, extension: str, key: str, instance_key: str):
+		self.directory = directory
+		self.desc = desc
+		self.instances = instances
+		self.fetch = fetch
+		self.extension = extension
+		self.key = key
+		self.instance_key = instance_key
+		self.journal: StudyJournal | None = None
+		self.archive: ArchiveSink | None = None
+		self.partial_dir: Path | None = None
+		self.writer: FileWriter | None = None
+		self.store: ObjectStore | None = None
+		self.catalog: Catalog | None = None
+		self.index: StudyIndex | None = None
+		self.transcoder: Transcoder | None = None
+		self.progress: tqdm | None = None
+		self.remaining = len(instances)
+
+		# 前一个序列，以及本序列的目录是否已确定（已创建或者不会再创建）。
+		self.previous: _SeriesJob | None = None
+		self.settled = asyncio.Event()
+		self.created = False
+		self._creating = asyncio.Lock()
+
+	async def resume(self, output: _StudyOutput, writer: FileWriter):
+		"""如果上次运行已经创建了本序列的目录，则继续使用它。"""
+		self.writer, self.journal, self.archive = writer, output.journal, output.archive
+		self.partial_dir, self.index = output.partial_dir, output.index
+
+		existing = self.journal and await writer.call(self.journal.series_dir, self.key)
+		if existing:
+			self.directory.reuse_dir(existing)
+			self.created = True
+			self.settled.set()
+		elif not self.instances:
+			self.settled.set()
+
+	async def is_complete(self, index: int):
+		if not self.created or not self.journal:
+			return False
+		file = self.directory.get(index, self.extension)
+		return await self.writer.call(self.journal.is_complete, self.instance_key, index, file)
+
+	async def _wait_previous(self):
+		job = self.previous
+		while job:
+			await job.settled.wait()
+			job = job.previous
+
+	def _make_dir(self):
+		if self.archive:
+			return self.directory.reserve_name(self.archive.series_names)
+		self.directory.make_dir()
+		self.journal.add_dir(self.key, self.directory.path)
+
+	def _commit(self, index: int, file: SpooledFile):
+		target = self.directory.get(index, self.extension)
+
+		# 临时文件刚写入，还在系统缓存里，只读头部很快，目录和索引共用一次解析。
+		ds = None
+		if self.extension == "dcm" and (self.catalog or self.index):
+			ds = read_dataset(file.path)
+
+		# 写入压缩包的不经过对象存储，也不记录到目录，因为没有对应的文件。
+		if self.archive:
+			self.archive.add_file(target, file.path)
+			file.path.unlink()
+		elif self.store:
+			self.store.commit(file, target)
+		else:
+			file.commit(target)
+
+		if self.journal:
+			self.journal.add_instance(self.instance_key, index, file.size, file.sha256)
+
+		if ds is None:
+			return
+		if self.index:
+			self.index.add(target, ds, file.size)
+		if self.catalog and not self.archive:
+			header = header_from_dataset(target, ds, file.size)
+			if header:
+				self.catalog.add(header)
+
+	async def save(self, index: int, file: SpooledFile):
+		# 等前面的序列都确定了目录再创建，重名时的编号才跟逐个下载时一样。
+		async with self._creating:
+			if not self.created:
+				await self._wait_previous()
+				await self.writer.call(self._make_dir)
+				self.created = True
+				self.settled.set()
+
+		await self.writer.call(self._commit, index, file)
+
+	def finish_one(self):
+		self.progress.update()
+		self.remaining -= 1
+		if self.remaining > 0:
+			return
+
+		self.progress.close()
+
+		# 全部跳过了的序列不创建目录，后面的序列不用再等它。
+		self.settled.set()
+
+
+class InstanceFetcher:
+	"""
+	并发下载实例的引擎，用法是先 add() 添加所有的序列，然后 await run() 即可。
+
+	- 同时进行的请求数有全局和每个序列两个上限，排在前面的序列先开始，多个序列可以同时下载。
+	- 文件名由实例在序列中的次序决定，跟响应到达的先后无关。
+	- 先写入临时文件，完整后才移动到序列目录，不会出现只有一半的文件。
+	- 文件操作都在 FileWriter 的线程池里执行，不阻塞网络请求，磁盘跟不上时会减慢下载。
+	- 序列目录按添加的顺序创建，目录结构跟逐个下载时完全一样。
+	- 支持断点续传，在检查目录里记录已下载的实例（见 StudyJournal），重新运行时只下载缺少的。
+	  影响文件内容的选项（variant 和 fetch_options.transcode）不同时，序列目录照旧，但实例会重新下载。
+	- 每个检查目录生成 DICOMDIR 和 manifest.json（见 StudyIndex），可以用 fetch_options.dicomdir 关闭。
+	- 设置了 fetch_options.catalog 时，每保存一个 DCM 文件就读取其头部添加到目录（见 Catalog）。
+	- 设置了 fetch_options.archive 时，检查写成一个压缩包而不是文件夹（见 ArchiveSink），此时不支持断点续传。
+	- 设置了 fetch_options.store 时，文件放入对象存储，序列目录里的是链接（见 ObjectStore）。
+	- 设置了 fetch_options.transcode 时，DCM 文件下载完就在进程池里转码为无损压缩的格式（见 Transcoder）。
+	- 流式读取的响应体中途断开时重新请求该实例，最多 fetch_options.retries 次，响应头之前的重试见 RetryPolicy。
+	- 任意一个实例出错都会取消其余的请求，并抛出该异常。
+	"""
+
+	def __init__(self, concurrency: int = None, series_concurrency: int = None, variant: str = ""):
+		"""
+		:param concurrency: 全局同时进行的请求数，默认取 fetch_options。
+		:param series_concurrency: 每个序列同时进行的请求数，默认取 fetch_options。
+		:param variant: 站点自己的影响文件内容的选项，比如 Hinacom 的 --raw，会加入断点续传日志的键。
+		"""
+		options = fetch_options.get()
+
+		# 自动调整时由控制器按主机限制，这里只需保证不超过它的上限。
+		if options.adaptive:
+			self.concurrency = concurrency or options.max_concurrency
+		else:
+			self.concurrency = concurrency or options.concurrency
+		self.writer_threads = options.writer_threads
+		self.series_concurrency = series_concurrency or options.series_concurrency or self.concurrency
+		self._series: list[_SeriesJob] = []
+
+		self.store = None
+		if options.store:
+			self.store = ObjectStore(Path(options.store))
+			add_summary(self.store.summary)
+		self.catalog_file = options.catalog
+		self.dicomdir = options.dicomdir
+		self.archive = options.archive
+		self.transcode = options.transcode
+		self.processes = options.processes
+		self.retries = options.retries
+		self.variant = "|".join(x for x in (variant, options.transcode) if x)
+
+	def add(self, directory: SeriesDirectory, desc: str, instances: Sequence, fetch: InstanceFetch, extension="dcm", key: str = None):
+		"""
+		添加一个序列，注意 fetch 协程会被并发调用。
+
+		:param directory: 保存的位置
+		:param desc: 在进度条上显示的名字
+		:param instances: 实例的列表，元素会原样传给 fetch
+		:param fetch: 下载单个实例的协程
+		:param extension: 文件扩展名
+		:param key: 在断点续传日志中标识该序列，同一个链接每次运行都要相同，默认由位置和名字组成。
+		"""
+		key = key or f"{len(self._series)}/{desc}"
+		instance_key = f"{key}|{self.variant}" if self.variant else key
+		self._series.append(_SeriesJob(directory, desc, instances, fetch, extension, key, instance_key))
+
+	async def run(self):
+		async with FileWriter(self.writer_threads) as writer:
+			catalog = None
+			if self.catalog_file:
+				catalog = await writer.call(Catalog, Path(self.catalog_file))
+			transcoder = Transcoder(self.transcode, self.processes) if self.transcode else None
+			try:
+				await self._run(writer, catalog, transcoder)
+			finally:
+				if transcoder:
+					transcoder.close()
+				if catalog:
+					await writer.call(catalog.close)
+
+	async def _run(self, writer: FileWriter, catalog: Catalog | None, transcoder: Transcoder | None):
+		outputs, previous = {}, None
+		for job in self._series:
+			job.previous, previous = previous, job
+			study_dir = job.directory.study_dir
+			if study_dir not in outputs:
+				outputs[study_dir] = await writer.call(_StudyOutput, study_dir, self.archive, self.dicomdir)
+			await job.resume(outputs[study_dir], writer)
+			job.store, job.catalog = self.store, catalog
+			if job.extension == "dcm":
+				job.transcoder = transcoder
+
+		global_limit = asyncio.Semaphore(self.concurrency)
+		try:
+			async with asyncio.TaskGroup() as group:
+				for position, job in enumerate(self._series):
+					job.progress = tqdm(
+						total=len(job.instances), desc=job.desc,
+						unit="张", file=sys.stdout, position=position,
+					)
+					series_limit = asyncio.Semaphore(self.series_concurrency)
+					for i, instance in enumerate(job.instances):
+						group.create_task(self._fetch_one(job, i, instance, series_limit, global_limit))
+		except ExceptionGroup as e:
+			# 保持跟以前逐个下载时一样的异常类型，调用方不需要处理 ExceptionGroup。
+			raise e.exceptions[0]
+		finally:
+			for job in self._series:
+				if job.progress:
+					job.progress.close()
+			for output in outputs.values():
+				await writer.call(output.close)
+
+	async def _download(self, job: _SeriesJob, instance):
+		"""
+		下载实例到临时文件，返回 None 表示跳过。RetryPolicy 只能重试到收到响应头为止，
+		所以流式读取的响应体中途断开时，在这里重新请求。
+		"""
+		attempt = 0
+		while True:
+			payload = await job.fetch(instance)
+			if payload is None:
+				return None
+			try:
+				return await spool(job.writer, job.partial_dir, payload)
+			except (ClientPayloadError, ClientConnectionError, asyncio.TimeoutError):
+				if not isinstance(payload, ClientResponse) or attempt >= self.retries:
+					raise
+				attempt += 1
+
+	async def _fetch_one(self, job: _SeriesJob, index: int, instance, series_limit, global_limit):
+		if await job.is_complete(index):
+			return job.finish_one()
+
+		# 先拿序列的再拿全局的，避免占着全局名额等待序列的名额。
+		# 响应体也在名额内读取，所以同时在内存中的块数是有上限的。
+		async with series_limit, global_limit:
+			payload = await self._download(job, instance)
+
+		# 转码不占请求的名额，CPU 跟不上时临时文件会在 partial 目录里排队。
+		if payload is not None and job.transcoder:
+			payload = await job.transcoder.transcode(payload, index)
+
+		# 移动到序列目录可能要等前面的序列，必须在释放名额之后，否则会死锁。
+		if payload is not None:
+			await job.save(index, payload)
+
+		job.finish_one()
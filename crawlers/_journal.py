@@ -0,0 +1,100 @@
+import json
+import threading
+from pathlib import Path
+
+
+class StudyJournal:
+	"""
+	断点续传用的日志，每个检查目录一个，只追加不修改，每行一条 JSON 记录：
+
+	- 创建序列目录：{"series": 序列键, "dir": 目录名}
+	- 下载完一个实例：{"series": 序列键, "index": 次序, "size": 字节数, "sha256": 摘要}
+
+	重新运行同一个链接时，根据它复用已有的序列目录，并跳过已下载完整的实例。
+	写入是线程安全的，可以在 FileWriter 的多个线程里同时调用。
+	"""
+
+	FILENAME = ".journal.jsonl"
+
+	def __init__(self, study_dir: Path):
+		self.file = study_dir / self.FILENAME
+		self._dirs: dict[str, str] = {}
+		self._instances: dict[tuple[str, int], int] = {}
+		self._fp = None
+		self._broken_tail = False
+		self._lock = threading.Lock()
+
+		if self.file.is_file():
+			self._load()
+
+	def _load(self):
+		line = "\n"
+		with self.file.open("r", encoding="utf-8", errors="replace") as fp:
+			for line in fp:
+				try:
+					record = json.loads(line)
+				except ValueError:
+					continue  # 中断时最后一行可能没写完，忽略即可。
+
+				if "dir" in record:
+					self._dirs[record["series"]] = record["dir"]
+				else:
+					self._instances[(record["series"], record["index"])] = record["size"]
+
+		self._broken_tail = not line.endswith("\n")
+
+	def series_dir(self, key: str):
+		"""
+		查找上次为该序列创建的目录，如果没有记录或者已被删除则返回 None。
+		"""
+		name = self._dirs.get(key)
+		if name is None:
+			return None
+		path = self.file.parent / name
+		return path if path.is_dir() else None
+
+	def series_dirs(self):
+		"""上次运行创建的、仍然存在的序列目录。"""
+		directories = (self.file.parent / name for name in self._dirs.values())
+		return [path for path in directories if path.is_dir()]
+
+	def is_complete(self, key: str, index: int, file: Path):
+		"""
+		实例是否已经下载过，且文件的大小跟记录的一致（没有被截断）。
+		"""
+		size = self._instances.get((key, index))
+		if size is None:
+			return False
+		try:
+			return file.stat().st_size == size
+		except FileNotFoundError:
+			return False
+
+	def add_dir(self, key: str, path: Path):
+		self._dirs[key] = path.name
+		self._append({"series": key, "dir": path.name})
+
+	def add_instance(self, key: str, index: int, size: int, digest: str):
+		self._instances[(key, index)] = size
+		self._append({"series": key, "index": index, "size": size, "sha256": digest})
+
+	def _append(self, record: dict):
+		with self._lock:
+			self._write_line(json.dumps(record, ensure_ascii=False))
+
+	def _write_line(self, line: str):
+		if not self._fp:
+			self.file.parent.mkdir(parents=True, exist_ok=True)
+			self._fp = self.file.open("a", encoding="utf-8")
+			if self._broken_tail:
+				self._fp.write("\n")
+
+		# 每条都立即刷新，这样进程被杀掉也只丢最后一条。
+		self._fp.write(line + "\n")
+		self._fp.flush()
+
+	def close(self):
+		with self._lock:
+			if self._fp:
+				self._fp.close()
+				self._fp = None
@@ -0,0 +1,167 @@
+"""
+失败请求的自动重试，以及防止不断请求已经挂掉的主机的断路器。
+"""
+import asyncio
+import random
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+from aiohttp import ClientConnectionError, ClientSSLError, ClientHandlerType, ClientRequest, ClientResponse
+
+# 只重试幂等的请求，POST 之类的可能有副作用。
+_IDEMPOTENT_METHODS = frozenset(("GET", "HEAD", "OPTIONS"))
+
+_RETRY_STATUSES = frozenset((408, 429, 500, 502, 503, 504))
+
+
+def parse_retry_after(value: str | None):
+	"""
+	解析 Retry-After 头，它可以是秒数或者 HTTP 日期，无效时返回 None。
+	"""
+	if not value:
+		return None
+	value = value.strip()
+	if value.isdigit():
+		return float(value)
+	try:
+		date = parsedate_to_datetime(value)
+	except (TypeError, ValueError):
+		return None
+	return max(0.0, (date - datetime.now(timezone.utc)).total_seconds())
+
+
+class _Circuit:
+	"""
+	单个主机的断路器，连续失败达到阈值后打开，冷却期间所有请求都等待。
+	冷却结束后只放一个请求过去试探，成功则关闭，失败则加倍冷却时间再次打开。
+	"""
+
+	def __init__(self, threshold: int, cooldown: float):
+		self.threshold = threshold
+		self.base_cooldown = cooldown
+		self.cooldown = cooldown
+		self.failures = 0
+		self.open_until = 0.0
+		self.trips = 0
+		self._probing = False
+
+	async def enter(self):
+		"""
+		等到允许发送请求为止，如果本次请求是试探则返回 True。
+		"""
+		while self.failures >= self.threshold:
+			delay = self.open_until - time.monotonic()
+			if delay <= 0 and not self._probing:
+				self._probing = True
+				return True
+
+			# 等待冷却结束，或者试探请求的结果。
+			await asyncio.sleep(max(delay, 0.5))
+
+		return False
+
+	def record(self, ok: bool, probe: bool):
+		if probe:
+			self._probing = False
+
+		if ok:
+			self.failures = 0
+			self.cooldown = self.base_cooldown
+			return
+
+		self.failures += 1
+
+		# 打开之前就发出的请求失败了不再延长冷却。
+		if probe or self.failures == self.threshold:
+			self.open_until = time.monotonic() + self.cooldown
+			self.trips += 1
+			if probe:
+				self.cooldown = min(self.cooldown * 2, 300)
+
+	def cancel_probe(self):
+		self._probing = False
+
+
+class RetryPolicy:
+	"""
+	aiohttp 的客户端中间件，对幂等请求的网络错误和 429、5xx 响应自动重试。
+
+	- 等待时间按指数增长并有上限，且随机化（full jitter），避免多个请求同时重试。
+	- 如果响应有 Retry-After 头，则按它的时间等待。
+	- 重试完仍失败则返回最后的响应或抛出异常，由 raise_for_status 照常处理。
+	- 只能重试到收到响应头为止，读取响应体时断开的不在此处理，InstanceFetcher 会重新请求流式读取的实例。
+	"""
+
+	def __init__(self, retries=4, base=0.5, cap=30.0, threshold=5, cooldown=10.0):
+		"""
+		:param retries: 最多重试的次数
+		:param base: 第一次重试前等待的时间上限（秒）
+		:param cap: 每次等待的最长时间（秒），Retry-After 的最多为它的 10 倍
+		:param threshold: 连续失败多少次打开断路器
+		:param cooldown: 断路器打开后的冷却时间（秒）
+		"""
+		self.retries = retries
+		self.base = base
+		self.cap = cap
+		self.threshold = threshold
+		self.cooldown = cooldown
+		self.circuits: dict[str, _Circuit] = {}
+
+		self.retried = 0
+		self.backoff = 0.0
+
+	def _delay(self, attempt: int, retry_after: str | None):
+		delay = parse_retry_after(retry_after)
+		if delay is not None:
+			return min(delay, self.cap * 10)
+		return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+	async def __call__(self, request: ClientRequest, handler: ClientHandlerType) -> ClientResponse:
+		if request.method not in _IDEMPOTENT_METHODS:
+			return await handler(request)
+
+		circuit = self.circuits.get(request.url.host)
+		if circuit is None:
+			circuit = self.circuits[request.url.host] = _Circuit(self.threshold, self.cooldown)
+
+		attempt = 0
+		while True:
+			waiting = time.monotonic()
+			probe = await circuit.enter()
+			self.backoff += time.monotonic() - waiting
+
+			try:
+				response = await handler(request)
+			except (ClientConnectionError, asyncio.TimeoutError) as e:
+				circuit.record(False, probe)
+				# 证书错误重试也没用。
+				if attempt >= self.retries or isinstance(e, ClientSSLError):
+					raise
+				delay = self._delay(attempt, None)
+			except BaseException:
+				if probe:
+					circuit.cancel_probe()
+				raise
+			else:
+				if response.status not in _RETRY_STATUSES:
+					circuit.record(True, probe)
+					return response
+
+				circuit.record(False, probe)
+				if attempt >= self.retries:
+					return response
+
+				delay = self._delay(attempt, response.headers.get("Retry-After"))
+				response.release()
+
+			attempt += 1
+			self.retried += 1
+			self.backoff += delay
+			await asyncio.sleep(delay)
+
+	def summary(self):
+		trips = sum(c.trips for c in self.circuits.values())
+		if self.retried == 0 and trips == 0:
+			return ""
+		return f"重试 {self.retried} 次，等待共 {self.backoff:.1f} 秒，断路器打开 {trips} 次"
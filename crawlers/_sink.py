@@ -0,0 +1,128 @@
+"""
+把下载的实例先写到临时文件，完整之后再改名为最终的文件名，这样中断时不会留下不完整的文件。
+响应体是边接收边写入的，内存占用只有一个块的大小，不随文件大小增长。
+"""
+import os
+import tempfile
+from contextlib import nullcontext
+from dataclasses import dataclass
+from hashlib import sha256
+from pathlib import Path
+from typing import Awaitable, Callable
+
+from aiohttp import ClientResponse
+
+from crawlers._writer import FileWriter
+
+# 每次从响应读取的大小，峰值内存约为它乘以同时进行的请求数。
+CHUNK_SIZE = 64 * 1024
+
+# 临时文件放在检查目录下，跟最终位置在同一个分区，改名才是原子的。
+PARTIAL_DIR = ".partial"
+
+# 自己写入临时文件的协程函数，参数是文件的路径，返回大小和 SHA-256 摘要。
+# 用于在子进程里生成的文件，内容不必传回主进程。
+FileProducer = Callable[[Path], Awaitable[tuple[int, str]]]
+
+
+@dataclass(slots=True, frozen=True)
+class SpooledFile:
+	"""已完整写入的临时文件。"""
+
+	path: Path
+	size: int
+	sha256: str
+
+	def commit(self, target: Path):
+		"""原子地移动到最终的位置，已存在的文件会被覆盖。"""
+		os.replace(self.path, target)
+
+
+def _make_temp(directory: Path):
+	directory.mkdir(parents=True, exist_ok=True)
+	fd, name = tempfile.mkstemp(".tmp", dir=directory)
+	return fd, Path(name)
+
+
+def _reserve_temp(directory: Path):
+	"""创建空的临时文件，交给 FileProducer 写入。"""
+	fd, path = _make_temp(directory)
+	os.close(fd)
+	return path
+
+
+def file_digest(file: Path):
+	"""返回文件的大小和 SHA-256 摘要，给 FileProducer 用。"""
+	hasher, size = sha256(), 0
+	with file.open("rb") as fp:
+		while chunk := fp.read(CHUNK_SIZE):
+			hasher.update(chunk)
+			size += len(chunk)
+	return size, hasher.hexdigest()
+
+
+class _TempFile:
+	"""正在写入的临时文件，除了构造都在 FileWriter 的线程里调用。"""
+
+	def __init__(self, directory: Path):
+		fd, self.path = _make_temp(directory)
+		self.fp = os.fdopen(fd, "wb")
+		self.hasher = sha256()
+		self.size = 0
+
+	def write(self, chunk: bytes):
+		self.fp.write(chunk)
+		self.hasher.update(chunk)
+		self.size += len(chunk)
+
+	def finish(self):
+		self.fp.close()
+		return SpooledFile(self.path, self.size, self.hasher.hexdigest())
+
+	def discard(self):
+		self.fp.close()
+		self.path.unlink(missing_ok=True)
+
+
+async def spool(writer: FileWriter, directory: Path, payload: bytes | ClientResponse | FileProducer):
+	"""
+	将实例的内容写入临时文件，写入和计算摘要都在 writer 的线程里进行。
+
+	:param writer: 执行文件操作的线程池
+	:param directory: 临时文件所在的目录，一般是检查目录下的 PARTIAL_DIR
+	:param payload: 文件的内容，或者是还未读取响应体的响应，读完后会关闭它，
+					也可以是自己写入临时文件的 FileProducer。
+	"""
+	if callable(payload):
+		path = await writer.call(_reserve_temp, directory)
+		try:
+			size, digest = await payload(path)
+		except BaseException:
+			await writer.call(path.unlink, True)
+			raise
+		return SpooledFile(path, size, digest)
+
+	# 先进入 async with 再创建临时文件，创建失败或者排队时被取消，响应也会释放，连接能回到连接池。
+	is_response = isinstance(payload, ClientResponse)
+	async with payload if is_response else nullcontext():
+		temp = await writer.call(_TempFile, directory)
+		try:
+			if is_response:
+				async for chunk in payload.content.iter_chunked(CHUNK_SIZE):
+					await writer.call(temp.write, chunk)
+			else:
+				await writer.call(temp.write, payload)
+
+			return await writer.call(temp.finish)
+		except BaseException:
+			await writer.call(temp.discard)
+			raise
+
+
+def clean_partial(directory: Path):
+	"""删除临时文件所在的目录，包括上次中断时留下的临时文件。"""
+	if not directory.is_dir():
+		return
+	for file in directory.iterdir():
+		file.unlink(missing_ok=True)
+	directory.rmdir()
@@ -0,0 +1,100 @@
+"""
+按内容寻址的对象存储，同一个链接多次下载时，相同的实例在磁盘上只存一份。
+
+对象以 SHA-256 命名，放在 objects/<前两位>/<其余> 下，检查目录里的文件是指向对象的链接，
+目录结构跟不用存储时完全一样。能用 reflink（Btrfs、XFS 等支持的写时复制）时优先使用，
+这样修改其中一个文件不会影响其它的；不支持则用硬链接。
+
+两种链接都要求存储跟下载目录在同一个分区。
+"""
+import errno
+import os
+import threading
+from pathlib import Path
+
+from crawlers._sink import SpooledFile
+
+try:
+	from fcntl import ioctl
+except ImportError:
+	ioctl = None
+
+# Linux 的 FICLONE，让目标文件共享源文件的数据块。
+_FICLONE = 0x40049409
+
+# 这些错误说明文件系统不支持 reflink，以后不用再试了。
+_NO_REFLINK = {errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EXDEV, errno.ENOSYS}
+
+
+class ObjectStore:
+	"""
+	FileWriter 的多个线程会同时调用 commit()，对象用 os.link 放入存储，已存在时会失败，
+	所以同一个内容同时到达也只会存一份。
+	"""
+
+	def __init__(self, root: Path):
+		self.root = root
+		self.reflink = ioctl is not None
+		self.instances = 0
+		self.duplicates = 0
+		self.total_bytes = 0
+		self.saved_bytes = 0
+		self._lock = threading.Lock()
+
+	def object_path(self, digest: str):
+		return self.root / "objects" / digest[:2] / digest[2:]
+
+	def commit(self, file: SpooledFile, target: Path):
+		"""
+		把临时文件放入存储（已有相同内容的则丢弃它），然后在 target 处创建指向对象的链接。
+		"""
+		source = self.object_path(file.sha256)
+		source.parent.mkdir(parents=True, exist_ok=True)
+		try:
+			os.link(file.path, source)
+			duplicate = False
+		except FileExistsError:
+			duplicate = True
+		file.path.unlink()
+
+		self._link(source, target)
+
+		with self._lock:
+			self.instances += 1
+			self.total_bytes += file.size
+			if duplicate:
+				self.duplicates += 1
+				self.saved_bytes += file.size
+
+	def _link(self, source: Path, target: Path):
+		# 先链接到临时名字再改名，跟 SpooledFile.commit 一样会覆盖已存在的文件。
+		temp = target.with_name(f".{target.name}.{threading.get_ident()}.link")
+		if self.reflink:
+			try:
+				return self._clone(source, temp, target)
+			except OSError as e:
+				if e.errno not in _NO_REFLINK:
+					raise
+				self.reflink = False
+
+		temp.unlink(missing_ok=True)
+		os.link(source, temp)
+		os.replace(temp, target)
+
+	@staticmethod
+	def _clone(source: Path, temp: Path, target: Path):
+		with source.open("rb") as src, temp.open("wb") as dst:
+			try:
+				ioctl(dst.fileno(), _FICLONE, src.fileno())
+			except OSError:
+				dst.close()
+				temp.unlink()
+				raise
+		os.replace(temp, target)
+
+	def summary(self):
+		if self.instances == 0:
+			return ""
+		ratio = self.saved_bytes / self.total_bytes if self.total_bytes else 0
+		return (f"对象存储：{self.instances} 个实例中 {self.duplicates} 个已存在，"
+				f"节省了 {self.saved_bytes / 1048576:.1f}MB（{ratio:.0%}）")
@@ -0,0 +1,155 @@
+"""
+根据延迟和错误自动调整并发数的控制器，算法跟 TCP 拥塞控制一样是 AIMD：
+正常时每轮加 1（加性增），被限流或变慢时乘以一个系数（乘性减）。
+"""
+import asyncio
+import time
+from collections import deque
+
+from aiohttp import ClientError, ClientHandlerType, ClientRequest, ClientResponse
+
+
+def percentile(values, p: float):
+	"""简单的最近秩法，样本不多，排序就行。"""
+	ordered = sorted(values)
+	return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+class _HostWindow:
+	"""单个主机的并发窗口，在收到响应头时释放名额，所以它限制的是服务端处理请求的部分。"""
+
+	# 延迟样本数少于此值时只增不减，避免刚开始波动大导致误判。
+	MIN_SAMPLES = 20
+
+	def __init__(self, initial: float, maximum: int, tolerance: float):
+		self.limit = float(initial)
+		self.maximum = maximum
+		self.tolerance = tolerance
+		self.in_flight = 0
+
+		self.peak = self.limit
+		self.throttled = 0
+		self.latencies = []
+
+		self._recent = deque(maxlen=64)
+		self._baseline = float("inf")
+		self._last_decrease = 0.0
+		self._waiters = deque()
+
+	async def acquire(self):
+		while self.in_flight >= max(1, int(self.limit)):
+			waiter = asyncio.get_running_loop().create_future()
+			self._waiters.append(waiter)
+			try:
+				await waiter
+			except asyncio.CancelledError:
+				# 如果已经被唤醒，要把名额让给下一个。
+				if waiter in self._waiters:
+					self._waiters.remove(waiter)
+				else:
+					self._wake()
+				raise
+		self.in_flight += 1
+
+	def release(self, started: float, status: int | None):
+		"""
+		:param started: 发送请求的时间
+		:param status: 响应码，请求出错时为 None
+		"""
+		full = self.in_flight >= int(self.limit)
+		self.in_flight -= 1
+
+		if status is None or status == 429 or status >= 500:
+			self.throttled += 1
+			self._decrease(started, 0.5)
+		else:
+			latency = time.monotonic() - started
+			self.latencies.append(latency)
+			self._recent.append(latency)
+			self._on_success(started, full)
+
+		self._wake()
+
+	def abandon(self):
+		"""请求被取消了，只释放名额而不计入统计。"""
+		self.in_flight -= 1
+		self._wake()
+
+	def _on_success(self, started: float, full: bool):
+		if len(self._recent) >= self.MIN_SAMPLES:
+			p50 = percentile(self._recent, 50)
+			self._baseline = min(self._baseline, p50)
+			if p50 > self._baseline * self.tolerance:
+				return self._decrease(started, 0.9)
+
+		# 窗口没用满说明瓶颈不在这里，增加也没意义。
+		if full:
+			self.limit = min(self.maximum, self.limit + 1 / self.limit)
+			self.peak = max(self.peak, self.limit)
+
+	def _decrease(self, started: float, factor: float):
+		# 在上次减小之前发出的请求反映的是旧的窗口，不应该再减一次。
+		if started < self._last_decrease:
+			return
+		self._last_decrease = time.monotonic()
+		self.limit = max(1.0, self.limit * factor)
+		self._recent.clear()
+
+	def _wake(self):
+		available = max(1, int(self.limit)) - self.in_flight
+		while available > 0 and self._waiters:
+			waiter = self._waiters.popleft()
+			if not waiter.done():
+				waiter.set_result(None)
+				available -= 1
+
+
+class AdaptiveController:
+	"""
+	aiohttp 的客户端中间件，按主机分别控制同时进行的请求数，
+	依据是最近的延迟中位数相对于最低时的倍数，以及 429、5xx 响应和网络错误。
+	"""
+
+	def __init__(self, initial=4, maximum=32, tolerance=2.0):
+		"""
+		:param initial: 初始的并发数
+		:param maximum: 并发数的上限
+		:param tolerance: 延迟中位数超过最低时的多少倍就认为服务器过载
+		"""
+		self.initial = initial
+		self.maximum = maximum
+		self.tolerance = tolerance
+		self.hosts: dict[str, _HostWindow] = {}
+
+	async def __call__(self, request: ClientRequest, handler: ClientHandlerType) -> ClientResponse:
+		host = request.url.host
+		window = self.hosts.get(host)
+		if window is None:
+			window = self.hosts[host] = _HostWindow(self.initial, self.maximum, self.tolerance)
+
+		await window.acquire()
+		started = time.monotonic()
+		try:
+			response = await handler(request)
+		except (ClientError, asyncio.TimeoutError):
+			window.release(started, None)
+			raise
+		except BaseException:
+			window.abandon()
+			raise
+
+		window.release(started, response.status)
+		return response
+
+	def summary(self):
+		lines = []
+		for host, window in self.hosts.items():
+			if not window.latencies:
+				continue
+			p50 = percentile(window.latencies, 50) * 1000
+			p90 = percentile(window.latencies, 90) * 1000
+			lines.append(
+				f"{host}：最终并发 {window.limit:.1f}，最高 {window.peak:.1f}，"
+				f"延迟 p50 {p50:.0f}ms p90 {p90:.0f}ms，限流或出错 {window.throttled} 次"
+			)
+		return "\n".join(lines)
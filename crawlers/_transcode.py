@@ -0,0 +1,139 @@
+"""
+下载完的实例转码为无损压缩的传输语法，未压缩的 DCM 文件一般能小一半以上。
+
+转码在临时文件放入序列目录之前进行，所以断点续传日志、对象存储、目录和压缩包看到的都是转码后的文件。
+已经是压缩格式的、没有像素的、编码器不支持的（比如浮点数像素）、不是 DICOM 或者被截断的保持原样。
+
+抽样检查往返无损：解码转码后的文件，跟原来的像素逐个比较，不一致的保留原文件。
+"""
+import asyncio
+import os
+import struct
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import sha256
+from io import BytesIO
+from pathlib import Path
+
+from pydicom import dcmread
+from pydicom.errors import InvalidDicomError, BytesLengthException
+from pydicom.uid import RLELossless, JPEG2000Lossless, JPEGLSLossless
+
+from crawlers._sink import SpooledFile
+from crawlers._utils import add_summary
+
+# 命令行选项的值到传输语法。
+SYNTAXES = {
+	"rle": RLELossless,
+	"jpeg2000": JPEG2000Lossless,
+	"jpeg-ls": JPEGLSLossless,
+}
+
+# 每个序列的第一个实例，以及之后每隔这么多个检查一次往返无损。
+VERIFY_EVERY = 20
+
+_SKIPPED, _DONE, _MISMATCH = range(3)
+
+
+def _transcode_file(path: Path, syntax: str, verify: bool):
+	"""
+	在子进程里执行，转码后的文件覆盖原来的临时文件。
+
+	:return: (状态, 大小, 摘要)，没有转码时后两者为 None。
+	"""
+	# 扩展名是 dcm 但内容不是的（比如报错页面）、被截断的、编码器不支持的，都保持原样。
+	try:
+		ds = dcmread(path)
+		if "PixelData" not in ds or ds.file_meta.TransferSyntaxUID.is_compressed:
+			return _SKIPPED, None, None
+
+		original = ds.pixel_array if verify else None
+		ds.compress(syntax, generate_instance_uid=False)
+	except (InvalidDicomError, BytesLengthException, EOFError, struct.error,
+			ValueError, NotImplementedError, RuntimeError, AttributeError):
+		return _SKIPPED, None, None
+
+	buffer = BytesIO()
+	ds.save_as(buffer)
+	data = buffer.getvalue()
+
+	if verify:
+		decoded = dcmread(BytesIO(data)).pixel_array
+		if decoded.shape != original.shape or (decoded != original).any():
+			return _MISMATCH, None, None
+
+	temp = path.with_name(path.name + ".transcode")
+	temp.write_bytes(data)
+	os.replace(temp, path)
+	return _DONE, len(data), sha256(data).hexdigest()
+
+
+class Transcoder:
+	"""
+	在进程池里转码临时文件，跟 hinacom 的 _DicomEncoder 一样，避免 CPU 密集的工作阻塞事件循环。
+	"""
+
+	def __init__(self, name: str, workers: int):
+		"""
+		:param name: SYNTAXES 中的键
+		:param workers: 进程数，为 0 则使用 CPU 的核数。
+		"""
+		from pydicom.pixels import get_encoder
+
+		self.syntax = SYNTAXES[name]
+		encoder = get_encoder(self.syntax)
+		if not encoder.is_available:
+			missing = "、".join(encoder.missing_dependencies)
+			raise RuntimeError(f"无法转码为 {self.syntax.name}，缺少依赖：{missing}")
+
+		self._pool = ProcessPoolExecutor(workers or os.cpu_count())
+		self.count = 0
+		self.skipped = 0
+		self.mismatched = 0
+		self.verified = 0
+		self.original_bytes = 0
+		self.transcoded_bytes = 0
+		add_summary(self.summary)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *ignore):
+		self.close()
+
+	def close(self):
+		self._pool.shutdown(cancel_futures=True)
+
+	async def transcode(self, file: SpooledFile, index: int):
+		"""
+		转码临时文件，返回转码后的，不需要或不能转码的原样返回。
+
+		:param file: 下载完的临时文件
+		:param index: 实例在序列中的次序，用来决定是否检查往返无损。
+		"""
+		verify = index % VERIFY_EVERY == 0
+		loop = asyncio.get_running_loop()
+		status, size, digest = await loop.run_in_executor(self._pool, _transcode_file, file.path, self.syntax, verify)
+
+		if status == _SKIPPED:
+			self.skipped += 1
+			return file
+		if status == _MISMATCH:
+			self.mismatched += 1
+			return file
+
+		self.count += 1
+		self.verified += verify
+		self.original_bytes += file.size
+		self.transcoded_bytes += size
+		return SpooledFile(file.path, size, digest)
+
+	def summary(self):
+		if self.count == 0 and self.mismatched == 0:
+			return ""
+		ratio = self.transcoded_bytes / self.original_bytes if self.original_bytes else 0
+		text = (f"转码为 {self.syntax.name}：{self.count} 个实例，{self.skipped} 个跳过，"
+				f"{self.original_bytes / 1048576:.1f}MB -> {self.transcoded_bytes / 1048576:.1f}MB（{ratio:.0%}），"
+				f"抽查了 {self.verified} 个")
+		if self.mismatched:
+			text += f"，{self.mismatched} 个解码后像素不一致，保留了原文件"
+		return text
@@ -2,10 +2,12 @@ import math
 import re
 import sys
 from base64 import b64encode
+from contextvars import ContextVar
+from dataclasses import dataclass
 from hashlib import sha256
 from io import TextIOWrapper
 from pathlib import Path
-from typing import Optional
+from typing import Any, Optional, Callable
 from zipfile import ZipFile
 
 import aiohttp
@@ -14,6 +16,10 @@ from pydicom.tag import Tag
 from pydicom.valuerep import VR, STR_VR, INT_VR, FLOAT_VR
 from tqdm import tqdm
 
+from crawlers._connector import new_connector, shared_pool
+from crawlers._retry import RetryPolicy
+from crawlers._throttle import AdaptiveController
+
 # 这儿的请求头也就意思一下，真要处理请求特征反爬还得使用自动化浏览器。
 _HEADERS = {
 	"Accept-Language": "zh,zh-CN;q=0.7,en;q=0.3",
@@ -23,6 +29,113 @@ _HEADERS = {
 }
 
 
+@dataclass(slots=True)
+class FetchOptions:
+	"""下载相关的参数，由 downloader.py 的命令行选项设置。"""
+
+	# 全局同时进行的请求数，自动调整时作为初始值。
+	concurrency: int = 4
+
+	# 单个序列内同时进行的请求数，0 表示跟全局的相同。
+	series_concurrency: int = 0
+
+	# 是否根据延迟和错误自动调整每个主机的并发数。
+	adaptive: bool = False
+
+	# 自动调整时并发数的上限。
+	max_concurrency: int = 32
+
+	# 请求失败时最多重试的次数，0 表示不重试。
+	retries: int = 4
+
+	# 执行文件操作的线程数。
+	writer_threads: int = 4
+
+	# CPU 密集的工作（如组装 DCM 文件）使用的进程数，0 表示跟 CPU 核数相同。
+	processes: int = 0
+
+	# 通过 WebSocket 下载的网站同时打开的连接数。
+	connections: int = 2
+
+	# 需要浏览器的网站，是否以无头模式启动浏览器。
+	headless: bool = False
+
+	# 按内容寻址的对象存储的目录，检查目录里的文件都链接到它，空字符串表示不使用。
+	store: str = ""
+
+	# 记录已下载影像的 SQLite 数据库，空字符串表示不记录。
+	catalog: str = ""
+
+	# 是否为每个检查目录生成 DICOMDIR 和 manifest.json。
+	dicomdir: bool = True
+
+	# 把检查写成压缩包而不是文件夹，可以是 zip、zip-store、tar，空字符串表示写入文件夹。
+	archive: str = ""
+
+	# 下载完的 DCM 文件转码为无损压缩的格式，可以是 rle、jpeg2000、jpeg-ls，空字符串表示不转码。
+	transcode: str = ""
+
+	# HTTP 连接池同时打开的连接数上限，0 表示不限制。
+	pool_limit: int = 100
+
+	# 连接池里每个主机同时打开的连接数上限，0 表示不限制。
+	pool_limit_per_host: int = 0
+
+	# 空闲连接保留的秒数，0 表示用完即关闭。
+	keepalive_timeout: float = 15.0
+
+	# DNS 解析结果缓存的秒数，0 表示不缓存。
+	dns_ttl: int = 10
+
+	# Happy Eyeballs 尝试下一个地址前等待的秒数，0 表示关闭，逐个地址尝试。
+	happy_eyeballs_delay: float = 0.25
+
+	def connector_options(self):
+		"""new_connector() 的参数。"""
+		return {
+			"limit": self.pool_limit,
+			"limit_per_host": self.pool_limit_per_host,
+			"keepalive_timeout": self.keepalive_timeout,
+			"dns_ttl": self.dns_ttl,
+			"happy_eyeballs_delay": self.happy_eyeballs_delay,
+		}
+
+
+# 用 ContextVar 而不是全局变量，这样同一进程里跑多个检查时各自的参数互不影响。
+fetch_options = ContextVar("fetch_options", default=FetchOptions())
+
+# 运行结束时打印的统计信息，由 downloader.py 设置为空列表来启用。
+_summaries: ContextVar[list[Callable[[], str]]] = ContextVar("summaries")
+
+
+def add_summary(provider: Callable[[], str]):
+	"""
+	注册一个函数，在运行结束时调用并打印其返回的统计信息。
+	"""
+	providers = _summaries.get(None)
+	if providers is not None:
+		providers.append(provider)
+
+
+def collect_summaries():
+	"""
+	开始收集统计信息，返回的列表在结束后传给 print_summaries。
+	"""
+	providers = []
+	_summaries.set(providers)
+	return providers
+
+
+def format_summaries(providers: list[Callable[[], str]]):
+	return "\n".join(text for text in (p() for p in providers) if text)
+
+
+def print_summaries(providers: list[Callable[[], str]]):
+	text = format_summaries(providers)
+	if text:
+		print("\n" + text)
+
+
 # noinspection PyTypeChecker
 async def _dump_response_check(response: aiohttp.ClientResponse):
 	"""
@@ -66,6 +179,28 @@ def new_http_client(*args, **kwargs):
 	# 使用 quote_cookie=False 避免对包含特殊字符的 cookie 值进行引号处理
 	kwargs.setdefault("cookie_jar", aiohttp.CookieJar(quote_cookie=False))
 
+	# 重试要放在并发控制的外层，这样每次重试都重新排队，失败的响应也会被控制器看到。
+	options, middlewares = fetch_options.get(), list(kwargs.get("middlewares", ()))
+	pool = shared_pool()
+	if options.retries > 0 and pool and pool.retry_policy:
+		middlewares.append(pool.retry_policy)
+	elif options.retries > 0:
+		policy = RetryPolicy(options.retries)
+		middlewares.append(policy)
+		add_summary(policy.summary)
+	if options.adaptive:
+		controller = AdaptiveController(options.concurrency, options.max_concurrency)
+		middlewares.append(controller)
+		add_summary(controller.summary)
+	kwargs["middlewares"] = middlewares
+
+	# 打开了共用的连接池就用它，否则每个会话有自己的连接器，会话关闭时一起关闭。
+	if "connector" not in kwargs and pool:
+		kwargs["connector"], kwargs["connector_owner"] = pool.connector, False
+		kwargs["trace_configs"] = [*kwargs.get("trace_configs", ()), pool.trace_config]
+	elif "connector" not in kwargs:
+		kwargs["connector"] = new_connector(**options.connector_options())
+
 	return aiohttp.ClientSession(*args, **kwargs)
 
 
@@ -146,14 +281,16 @@ def make_unique_dir(path: Path):
 	except OSError:
 		if not path.is_dir():
 			raise
-		matches = _filename_serial_re.match(path.name)
-		if matches:
-			n = int(matches.group(2)) + 1
-			alt = f"{matches.group(1)} ({n})"
-		else:
-			alt = f"{path.name} (1)"
+		return make_unique_dir(path.parent / next_unique_name(path.name))
 
-		return make_unique_dir(path.parent / alt)
+
+def next_unique_name(name: str):
+	"""名字重复时换用的下一个，在后面添加编号或者把已有的编号加一。"""
+	matches = _filename_serial_re.match(name)
+	if matches:
+		n = int(matches.group(2)) + 1
+		return f"{matches.group(1)} ({n})"
+	return f"{name} (1)"
 
 
 class SeriesDirectory:
@@ -178,10 +315,34 @@ class SeriesDirectory:
 		else:
 			self._suggested = study_dir / str(number)
 
+		self.study_dir = study_dir
 		self._unique = unique
 		self._path = None
 		self._width = int(math.log10(size)) + 2
 
+	@property
+	def path(self) -> Optional[Path]:
+		"""序列目录的路径，在创建之前为 None"""
+		return self._path
+
+	def reuse_dir(self, path: Path):
+		"""
+		不创建新目录，而是使用已存在的，用于断点续传。
+		"""
+		self._path = path
+
+	def reserve_name(self, used: set[str]):
+		"""
+		不创建目录，只确定名字，重名时的编号规则跟 make_dir 相同，用于写入压缩包。
+
+		:param used: 检查里已经用了的序列目录名，会把本序列的加进去。
+		"""
+		path = self._suggested
+		while self._unique and path.name in used:
+			path = path.parent / next_unique_name(path.name)
+		used.add(path.name)
+		self._path = path
+
 	def make_dir(self):
 		if self._unique:
 			self._path = make_unique_dir(self._suggested)
@@ -207,13 +368,13 @@ class SeriesDirectory:
 		return self._path / base.zfill(width)
 
 
-def parse_dcm_value(value: str, vr: str):
+def dcm_value_caster(vr: str) -> Callable[[str], Any]:
 	"""
-	在 pydicom 里没找到自动转换的功能，得自己处理下类型。
-	https://stackoverflow.com/a/77661160/7065321
+	返回把字符串转换为指定 VR 的值的函数，同一个 VR 可以重复使用，省去每次判断类型。
+	多值的以反斜杠分隔，转换后为列表。
 	"""
 	if vr == VR.AT:
-		return Tag(value)
+		return Tag
 
 	if vr in STR_VR:
 		cast_fn = str
@@ -224,10 +385,21 @@ def parse_dcm_value(value: str, vr: str):
 	else:
 		raise NotImplementedError("Unsupported VR: " + vr)
 
-	parts = value.split("\\")
-	if len(parts) == 1:
-		return cast_fn(value)
-	return [cast_fn(x) for x in parts]
+	def cast(value: str):
+		parts = value.split("\\")
+		if len(parts) == 1:
+			return cast_fn(value)
+		return [cast_fn(x) for x in parts]
+
+	return cast
+
+
+def parse_dcm_value(value: str, vr: str):
+	"""
+	在 pydicom 里没找到自动转换的功能，得自己处理下类型。
+	https://stackoverflow.com/a/77661160/7065321
+	"""
+	return dcm_value_caster(vr)(value)
 
 
 def suggest_series_name(ds: Dataset):
@@ -0,0 +1,77 @@
+"""
+在线程池里执行文件操作，避免磁盘慢的时候阻塞事件循环，拖慢所有的网络请求。
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, TypeVar
+
+T = TypeVar("T")
+
+
+class FileWriter:
+	"""
+	一次下载的所有文件操作都交给它，在固定数量的线程里执行。
+
+	等待执行的操作数有上限，超出时 call() 会等待，这样磁盘跟不上时会自然地减慢读取响应，
+	而不是把数据都堆在内存里。
+
+	同一个文件的操作应该依次 await，不要并发提交，线程池不保证它们的执行顺序。
+	"""
+
+	def __init__(self, workers=4, queue_size=64):
+		"""
+		:param workers: 线程数
+		:param queue_size: 最多有多少个操作在等待或执行中
+		"""
+		self._executor = ThreadPoolExecutor(workers, thread_name_prefix="FileWriter")
+		self._slots = asyncio.Semaphore(queue_size)
+		self._pending = set()
+		self._error: BaseException | None = None
+
+	async def __aenter__(self):
+		return self
+
+	async def __aexit__(self, *ignore):
+		await self.close()
+
+	async def submit(self, fn: Callable[..., T], *args) -> asyncio.Future[T]:
+		"""
+		把 fn(*args) 放入队列，不等待它执行完，队列满时则等到有空位。
+		返回的 Future 可以不管，它的异常会在 drain() 时抛出。
+		"""
+		future = await self._start(fn, *args)
+		future.add_done_callback(self._keep_error)
+		return future
+
+	async def _start(self, fn: Callable[..., T], *args) -> asyncio.Future[T]:
+		await self._slots.acquire()
+		future = asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+		self._pending.add(future)
+		future.add_done_callback(self._on_done)
+		return future
+
+	def _on_done(self, future):
+		self._pending.discard(future)
+		self._slots.release()
+
+	def _keep_error(self, future):
+		# 调用 exception() 之后 asyncio 就不会再警告异常没有被获取。
+		if future.cancelled() or future.exception() is None:
+			return
+		if self._error is None:
+			self._error = future.exception()
+
+	async def call(self, fn: Callable[..., T], *args) -> T:
+		"""在线程池中调用 fn(*args)，返回其结果，异常直接抛给调用方，不会留到 drain()。"""
+		return await (await self._start(fn, *args))
+
+	async def drain(self):
+		"""等待所有已提交的操作完成，如果 submit() 的操作出过错，则抛出第一个异常。"""
+		await asyncio.gather(*self._pending, return_exceptions=True)
+		error, self._error = self._error, None
+		if error:
+			raise error
+
+	async def close(self):
+		"""关闭线程池，会等待正在执行的操作完成。"""
+		await asyncio.to_thread(self._executor.shutdown, True, cancel_futures=True)
@@ -40,4 +40,4 @@ async def run(share_url, *args):
 		viewer_url = str(response.real_url.origin()) + matches.group(1)
 
 	async with await HinacomDownloader.from_url(client, viewer_url) as downloader:
-		await downloader.download_all("--raw" in args)
+		await downloader.download_all("--raw" in args, "--serial" not in args)
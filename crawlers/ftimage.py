@@ -4,14 +4,17 @@ import sys
 from dataclasses import dataclass
 from io import BytesIO
 from pathlib import Path
+from urllib.parse import urlsplit, urlunsplit
 
-from playwright.async_api import Response, Page, BrowserContext
+from aiohttp import ClientError, ClientSession
+from playwright.async_api import Response, Page, BrowserContext, Request, Route
 from pydicom import dcmread
 from tqdm import tqdm
 from yarl import URL
 
-from crawlers._browser import wait_text, run_with_browser, PlaywrightCrawler
-from crawlers._utils import suggest_save_dir
+from crawlers._browser import wait_text, run_with_browser, PlaywrightCrawler, UrlPattern, export_http_client
+from crawlers._utils import suggest_save_dir, fetch_options
+from crawlers._writer import FileWriter
 
 
 @dataclass(frozen=True, eq=False)
@@ -54,9 +57,34 @@ async def wait_study_info(page: Page):
 	return _FitImageStudyInfo(patient, kind, time, slices, series_table)
 
 
+def _with_series(url: str, series_id: str):
+	"""
+	替换图像 URL 路径里的序列 ID（第 4 段，跟 _on_response 解析的一样），
+	不能直接替换字符串，检查 ID 或者查询参数里也可能有同样的文本。
+	"""
+	parts = urlsplit(url)
+	segments = parts.path.split("/")
+	segments[4] = series_id
+	return urlunsplit(parts._replace(path="/".join(segments)))
+
+
+def _save_instance(study_id: str, series_id: str, body: bytes):
+	"""
+	文件名用 InstanceNumber，只需解析像素之前的标签，在 FileWriter 的线程里调用。
+	"""
+	ds = dcmread(BytesIO(body), stop_before_pixels=True, specific_tags=["InstanceNumber"])
+
+	file = Path(f"download/{study_id}/{series_id}/{ds.InstanceNumber}.dcm")
+	file.parent.mkdir(parents=True, exist_ok=True)
+	file.write_bytes(body)
+
+
 class FitImageDownloader(PlaywrightCrawler):
 	"""
 	飞图医疗影像平台的下载器，该平台自称被 3000 的多家医院采用。
+
+	查看器是一张张地加载图像的，速度受限于页面。默认在浏览器加载了同一序列的两张图之后，
+	从它们的 URL 推断出其它图像的，然后用浏览器的 Cookies 和请求头直接并发下载剩下的。
 	"""
 	_total = 0xFFFFFFFF
 	_downloaded = 0
@@ -65,31 +93,129 @@ class FitImageDownloader(PlaywrightCrawler):
 
 	share_url: str
 
-	def __init__(self, share_url: str):
+	def __init__(self, share_url: str, handoff=True):
+		"""
+		:param share_url: 分享链接
+		:param handoff: 是否在推断出图像的 URL 之后改用 aiohttp 下载，否则全部由浏览器加载。
+		"""
 		super().__init__()
 		self.share_url = share_url
+		self.handoff = handoff
+		self._writer = FileWriter()
+
+		self._saved: dict[str, list[str]] = {}
+		self._request: Request | None = None
+		self._pending = set()
+		self._sampled = asyncio.Event()
+		self._handed_off = False
+
+		# 下载完不关闭上下文，而是设置它，这样上下文可以放回浏览器池给下一个检查用。
+		self._done = asyncio.Event()
 
 	async def _on_response(self, response: Response):
 		asset_name = URL(response.request.url).path
 
-		if not asset_name.endswith(".dcm"):
+		# 交给 aiohttp 之后浏览器加载的就不要了，免得重复。
+		if not asset_name.endswith(".dcm") or self._handed_off:
 			return
 
-		_, _, _, self._study_id, series_id, _, _ = asset_name.split("/")
-		body = await response.body()
-		index = dcmread(BytesIO(body)).InstanceNumber
+		task = asyncio.current_task()
+		self._pending.add(task)
+		try:
+			_, _, _, self._study_id, series_id, _, _ = asset_name.split("/")
+			body = await response.body()
 
-		dir_ = Path(f"download/{self._study_id}/{series_id}/{index}.dcm")
-		dir_.parent.mkdir(parents=True, exist_ok=True)
-		dir_.write_bytes(body)
+			# 解析和写入都不在这里做，以免拖慢浏览器事件的处理，写完才计数以保证进度准确。
+			await self._writer.call(_save_instance, self._study_id, series_id, body)
+		finally:
+			self._pending.discard(task)
 
-		self._downloaded += 1
+		saved = self._saved.setdefault(series_id, [])
+		saved.append(response.request.url)
+		self._request = response.request
+		if len(saved) >= 2:
+			self._sampled.set()
+
+		self._count_one()
+		if self._downloaded == self._total and not self._handed_off:
+			self._done.set()
 
+	def _count_one(self):
+		self._downloaded += 1
 		if self._progress:
 			self._progress.update()
 
-		if self._downloaded == self._total:
-			await response.frame.page.context.close()
+	async def _wait_end(self, context: BrowserContext):
+		"""等到下载完，或者用户关掉了浏览器窗口。"""
+		closed = asyncio.ensure_future(context.wait_for_event("close", timeout=0))
+		done = asyncio.ensure_future(self._done.wait())
+		try:
+			await asyncio.wait((closed, done), return_when=asyncio.FIRST_COMPLETED)
+		finally:
+			closed.cancel()
+			done.cancel()
+
+	async def _try_handoff(self, context: BrowserContext, study: _FitImageStudyInfo, ended: asyncio.Future):
+		"""
+		等浏览器加载了同一序列的两张图，推断出 URL 的格式，然后直接下载剩下的。
+		推断不出来或者试探的请求失败则什么也不做，继续由浏览器加载。
+		"""
+		sampled = asyncio.ensure_future(self._sampled.wait())
+		await asyncio.wait((sampled, ended), return_when=asyncio.FIRST_COMPLETED)
+		if ended.done():
+			return sampled.cancel()
+
+		pivot, urls = next((k, v) for k, v in self._saved.items() if len(v) >= 2)
+		pattern = UrlPattern.infer(urls)
+		if not pattern:
+			return tqdm.write("无法从图像的 URL 推断出格式，继续由浏览器下载。")
+
+		# 序号可能从 0 或 1 开始，看已加载的里面有没有 0。
+		start = min(pattern.number(url) for url in urls)
+		start = 0 if start == 0 else 1
+
+		async with await export_http_client(context, self._request) as client:
+			# 先试一下最后一张，它一般还没被加载，能下载到 DICOM 才说明推断是对的。
+			probe = pattern.format(start + study.series[pivot][1] - 1)
+			try:
+				async with client.get(probe) as response:
+					if (await response.read())[128:132] != b"DICM":
+						raise ValueError("响应不是 DICOM 文件")
+			except (ClientError, ValueError) as e:
+				return tqdm.write(f"直接下载图像失败（{e}），继续由浏览器下载。")
+
+			self._handed_off = True
+			await context.route("**/*.dcm", _abort_route)
+			await asyncio.gather(*self._pending, return_exceptions=True)
+
+			jobs = []
+			for series_id, (_, size) in study.series.items():
+				saved = {pattern.number(_with_series(url, pivot)) for url in self._saved.get(series_id, ())}
+				for i in range(start, start + size):
+					if i not in saved:
+						jobs.append((series_id, _with_series(pattern.format(i), series_id)))
+
+			tqdm.write(f"已推断出图像 URL 的格式，剩下的 {len(jobs)} 张直接下载。")
+			await self._fetch_all(client, jobs)
+
+		self._done.set()
+
+	async def _fetch_all(self, client: ClientSession, jobs: list[tuple[str, str]]):
+		limit = asyncio.Semaphore(fetch_options.get().concurrency)
+
+		async def fetch(series_id: str, url: str):
+			async with limit:
+				async with client.get(url) as response:
+					body = await response.read()
+			await self._writer.call(_save_instance, self._study_id, series_id, body)
+			self._count_one()
+
+		try:
+			async with asyncio.TaskGroup() as group:
+				for job in jobs:
+					group.create_task(fetch(*job))
+		except ExceptionGroup as e:
+			raise e.exceptions[0]
 
 	def _fix_series_name(self, study: _FitImageStudyInfo):
 		save_to = Path(f"download/{self._study_id}")
@@ -112,13 +238,24 @@ class FitImageDownloader(PlaywrightCrawler):
 
 		# 下得比这里跑得还快，应该不可能，但还是检查下更完备些。
 		if self._downloaded >= study.total:
-			await context.close()
-		else:
-			await context.wait_for_event("close", timeout=0)
+			self._done.set()
+
+		ended = asyncio.ensure_future(self._wait_end(context))
+		try:
+			if self.handoff and not self._done.is_set():
+				await self._try_handoff(context, study, ended)
+			await ended
+		finally:
+			ended.cancel()
 
 		self._progress.close()
+		await self._writer.close()
 		print(f"下载完成，保存位置 {self._fix_series_name(study)}")
 
 
-async def run(share_url, *_):
-	await run_with_browser(FitImageDownloader(share_url))
+async def _abort_route(route: Route):
+	await route.abort()
+
+
+async def run(share_url, *args):
+	await run_with_browser(FitImageDownloader(share_url, "--browser" not in args))
@@ -4,21 +4,30 @@ https://blog.kaciras.com/article/45/download-dicom-files-from-hinacom-cloud-view
 """
 import asyncio
 import json
+import os
 import re
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache, partial
+from io import BytesIO
 from pathlib import Path
-from typing import Any
+from typing import Any, BinaryIO
 
 from aiohttp import ClientSession
 from pydicom.datadict import DicomDictionary
+from pydicom.dataelem import DataElement
 from pydicom.dataset import Dataset, FileMetaDataset
 from pydicom.encaps import encapsulate
 from pydicom.tag import Tag
 from pydicom.uid import ExplicitVRLittleEndian, JPEG2000Lossless
 from tqdm import tqdm
 
-from crawlers._utils import pathify, new_http_client, parse_dcm_value, SeriesDirectory, make_unique_dir, \
-	suggest_save_dir
+from crawlers._capture import CaptureWriter, CaptureFile, CaptureRecord, read_index, PACK_FILE
+from crawlers._fetcher import InstanceFetcher
+from crawlers._sink import file_digest
+from crawlers._utils import pathify, new_http_client, dcm_value_caster, SeriesDirectory, make_unique_dir, \
+	suggest_save_dir, fetch_options, add_summary
 
 _LINK_VIEW = re.compile(r"/Study/ViewImage\?studyId=([\w-]+)")
 _LINK_ENTRY = re.compile(r"window\.location\.href = '([^']+)'")
@@ -83,31 +92,62 @@ class HinacomDownloader:
 		async with self.client.get(api, params=params) as response:
 			return await response.read(), response.headers["X-ImageFrame"]
 
-	async def download_all(self, is_raw=False):
+	async def download_all(self, is_raw=False, pipelined=True, prefetch: int = None, workers: int = None):
 		"""
 		快捷方法，下载全部序列到 DCM 文件，保存的文件名将根据报告自动生成。
 		该方法会在控制台显示进度条和相关信息。
 
+		流水线模式下，同一张图的标签和像素同时请求，每张图只等待一次往返，
+		而且每个序列会保持 prefetch 张图在下载中，完成一张就补上后面的一张。
+
+		所有序列共用一个会话和 CAC 刷新任务，在全局的并发上限内同时下载，
+		prefetch 小于全局上限时，一个存储节点慢也不会拖住其它序列。
+
 		:param is_raw: 是否下载未压缩的图像，默认下载 JPEG2000 格式的。
+		:param pipelined: 是否同时请求标签和像素，关闭则跟以前一样先标签后像素。
+		:param prefetch: 每个序列同时下载的图片数，默认取 fetch_options 的设置。
+		:param workers: 组装 DCM 文件的进程数，默认取 fetch_options 的设置。
 		"""
 		save_to = _get_save_dir(self.dataset)
 		print(f'保存到: {save_to}')
 
-		for series in self.dataset["displaySets"]:
-			name, no, images = pathify(series["description"]) or "Unnamed", series["seriesNumber"], series["images"]
-			dir_ = SeriesDirectory(save_to, no, name, len(images))
+		fetch = self._fetch_pipelined if pipelined else self._fetch_serial
+		with _DicomEncoder(workers or fetch_options.get().processes) as encoder:
+			fetcher = InstanceFetcher(series_concurrency=prefetch, variant="raw" if is_raw else "")
+			for series in self.dataset["displaySets"]:
+				name, no, images = pathify(series["description"]) or "Unnamed", series["seriesNumber"], series["images"]
+				dir_ = SeriesDirectory(save_to, no, name, len(images))
+				fetcher.add(dir_, name, images, lambda info: fetch(info, is_raw, encoder))
+
+			await fetcher.run()
+
+	async def _fetch_serial(self, info, is_raw: bool, encoder: "_DicomEncoder"):
+		# 图片响应头包含的标签不够，必须每个都请求 GetImageDicomTags。
+		tags = await self.get_tags(info)
 
-			tasks = tqdm(images, desc=name, unit="张", file=sys.stdout)
-			for i, info in enumerate(tasks):
-				# 图片响应头包含的标签不够，必须每个都请求 GetImageDicomTags。
-				tags = await self.get_tags(info)
+		# 没有标签的视为非 DCM 文件，跳过。
+		if len(tags) == 0:
+			return None
 
-				# 没有标签的视为非 DCM 文件，跳过。
-				if len(tags) == 0:
-					continue
+		pixels, _ = await self.get_image(info, is_raw)
+		return encoder.encode(tags, pixels)
 
-				pixels, _ = await self.get_image(info, is_raw)
-				_write_dicom(tags, pixels, dir_.get(i, "dcm"))
+	async def _fetch_pipelined(self, info, is_raw: bool, encoder: "_DicomEncoder"):
+		image = asyncio.create_task(self.get_image(info, is_raw))
+		try:
+			tags = await self.get_tags(info)
+		except BaseException:
+			image.cancel()
+			raise
+
+		# 没有标签的视为非 DCM 文件，跳过。它的像素请求可能会失败，结果也用不到。
+		if len(tags) == 0:
+			image.cancel()
+			image.add_done_callback(_ignore_result)
+			return None
+
+		pixels, _ = await image
+		return encoder.encode(tags, pixels)
 
 	@staticmethod
 	async def from_url(client: ClientSession, viewer_url: str):
@@ -165,41 +205,176 @@ class HinacomDownloader:
 		return await HinacomDownloader.from_url(client, viewer_url)
 
 
-def _write_dicom(tag_list: list, image: bytes, filename: Path):
+def _ignore_result(task: asyncio.Task):
+	if not task.cancelled():
+		task.exception()
+
+
+def _build_dicom(tag_list: list, image: bytes):
+	buffer = BytesIO()
+	_write_dicom(tag_list, image, buffer)
+	return buffer.getvalue()
+
+
+def _write_dicom_file(tag_list: list, image: bytes, path: Path):
+	"""
+	在子进程里执行，直接写入引擎的临时文件，只返回大小、摘要和组装的耗时，
+	文件内容不用复制到 BytesIO，也不用传回主进程。
+	"""
+	start = time.perf_counter()
+	_write_dicom(tag_list, image, path)
+	elapsed = time.perf_counter() - start
+	return *file_digest(path), elapsed
+
+
+class _DicomEncoder:
+	"""
+	组装 DCM 文件要逐个设置几百个标签再序列化，是纯 CPU 的工作，放在进程池里执行，
+	避免阻塞事件循环上的请求。传给子进程的只有标签列表和像素，子进程直接写入文件。
+	"""
+
+	def __init__(self, workers: int):
+		"""
+		:param workers: 进程数，为 0 则使用 CPU 的核数。
+		"""
+		self._pool = ProcessPoolExecutor(workers or os.cpu_count())
+		self.count = 0
+		self.total_time = 0.0
+		self.max_time = 0.0
+		add_summary(self.summary)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *ignore):
+		self._pool.shutdown(cancel_futures=True)
+
+	def encode(self, tag_list: list, image: bytes):
+		"""返回写入 DCM 文件的 FileProducer，由 InstanceFetcher 给出临时文件的路径。"""
+		return partial(self._write, tag_list, image)
+
+	async def _write(self, tag_list: list, image: bytes, path: Path):
+		loop = asyncio.get_running_loop()
+		size, digest, elapsed = await loop.run_in_executor(self._pool, _write_dicom_file, tag_list, image, path)
+		self.count += 1
+		self.total_time += elapsed
+		self.max_time = max(self.max_time, elapsed)
+		return size, digest
+
+	def summary(self):
+		if self.count == 0:
+			return ""
+		average = self.total_time / self.count * 1000
+		return f"组装 DCM 文件 {self.count} 个，平均每个 {average:.1f}ms，最长 {self.max_time * 1000:.1f}ms"
+
+
+class _TagSchema:
+	"""
+	一个序列里各个图像的标签一般是同样的一串，只有值不同，所以把解析标签、查字典、
+	选择类型转换这些工作按标签序列缓存起来，每张图只需转换值并创建 DataElement。
+	"""
+
+	def __init__(self, keys: tuple[str, ...]):
+		self.elements = []
+
+		# GetImageDicomTags 的响应不含 VR，故私有标签只能假设为 LO 类型。
+		for key in keys:
+			tag = Tag(key.split(",", 2))
+			definition = DicomDictionary.get(tag)
+
+			if not definition:
+				# 正好 PrivateCreator 出现在它的标签之前，按顺序添加即可。
+				# DataElement 对 LO 类型会自动按斜杠分割多值字符串。
+				self.elements.append((False, tag, "LO", None))
+			elif definition[4]:
+				# 0002 的标签只能放在 file_meta 里而不能在 ds 中存在。
+				vr = definition[0]
+				self.elements.append((tag.group == 2, tag, vr, dcm_value_caster(vr)))
+			else:
+				# 没有关键字的标签以前用 setattr 设置不上，保持一致也跳过。
+				self.elements.append(None)
+
+	def apply(self, tag_list: list, ds: Dataset):
+		for element, item in zip(self.elements, tag_list):
+			if element is None:
+				continue
+			is_meta, tag, vr, cast = element
+			value = item["value"] if cast is None else cast(item["value"])
+			target = ds.file_meta if is_meta else ds
+			target[tag] = DataElement(tag, vr, value)
+
+
+@lru_cache(maxsize=64)
+def _get_schema(keys: tuple[str, ...]):
+	# 在进程池里每个进程各有一份缓存，同一个序列的图会反复用到。
+	return _TagSchema(keys)
+
+
+def _write_dicom(tag_list: list, image: bytes | memoryview, filename: Path | BinaryIO):
 	ds = Dataset()
 	ds.file_meta = FileMetaDataset()
 
-	# GetImageDicomTags 的响应不含 VR，故私有标签只能假设为 LO 类型。
-	for item in tag_list:
-		tag = Tag(item["tag"].split(",", 2))
-		definition = DicomDictionary.get(tag)
-
-		if tag.group == 2:
-			# 0002 的标签只能放在 file_meta 里而不能在 ds 中存在。
-			vr, key = definition[0], definition[4]
-			value = parse_dcm_value(item["value"], vr)
-			setattr(ds.file_meta, key, value)
-		elif definition:
-			vr, key = definition[0], definition[4]
-			setattr(ds, key, parse_dcm_value(item["value"], vr))
-		else:
-			# 正好 PrivateCreator 出现在它的标签之前，按顺序添加即可。
-			# DataElement 对 LO 类型会自动按斜杠分割多值字符串。
-			ds.add_new(tag, "LO", item["value"])
+	schema = _get_schema(tuple(item["tag"] for item in tag_list))
+	schema.apply(tag_list, ds)
 
 	ds.file_meta.MediaStorageSOPClassUID = ds.SOPClassUID
 	ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
 
 	# 根据文件体积和头部自动判断类型。
 	px_size = (ds.BitsAllocated + 7) // 8 * ds.Rows * ds.Columns
-	if image[16:23] == b"ftypjp2" and len(image) != px_size:
-		ds.PixelData = encapsulate([image])
+	encapsulated = image[16:23] == b"ftypjp2" and len(image) != px_size
+	if encapsulated:
 		ds.file_meta.TransferSyntaxUID = JPEG2000Lossless
 	else:
-		ds.PixelData = image
 		ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
 
-	ds.save_as(filename, enforce_file_format=True)
+	# 像素之后还有标签的很少见，交给 pydicom 按原来的方式处理。
+	if any(tag >= _PIXEL_DATA for tag in ds.keys()):
+		image = bytes(image)
+		ds.PixelData = encapsulate([image]) if encapsulated else image
+		ds.save_as(filename, enforce_file_format=True)
+		return
+
+	if isinstance(filename, Path):
+		with filename.open("wb") as fp:
+			_write_with_pixels(fp, ds, image, encapsulated)
+	else:
+		_write_with_pixels(filename, ds, image, encapsulated)
+
+
+_PIXEL_DATA = 0x7FE00010
+
+# 显式 VR 小端的 OB/OW 元素头：标签、VR、2 字节保留、4 字节长度。
+_PIXEL_HEADER = b"\xe0\x7f\x10\x00"
+_UNDEFINED_LENGTH = b"\xff\xff\xff\xff"
+
+# 只有一帧的基本偏移表，唯一的偏移量为 0。
+_ITEM_TAG = b"\xfe\xff\x00\xe0"
+_BASIC_OFFSET_TABLE = _ITEM_TAG + b"\x04\x00\x00\x00" + b"\x00\x00\x00\x00"
+_SEQUENCE_DELIMITER = b"\xfe\xff\xdd\xe0\x00\x00\x00\x00"
+
+
+def _write_with_pixels(fp: BinaryIO, ds: Dataset, image: bytes | memoryview, encapsulated: bool):
+	"""
+	先用 pydicom 写入不含像素的部分，然后自己写像素元素，直接写入图像的内存而不复制，
+	结果跟设置 PixelData 再 save_as 的完全相同。像素是最后一个元素，所以可以这样拼接。
+	"""
+	ds.save_as(fp, enforce_file_format=True)
+
+	padding = b"\x00" if len(image) % 2 else b""
+	length = (len(image) + len(padding)).to_bytes(4, "little")
+
+	if encapsulated:
+		# 跟 encapsulate([image]) 一样，整个图像作为一个片段。
+		fp.write(_PIXEL_HEADER + b"OB\x00\x00" + _UNDEFINED_LENGTH + _BASIC_OFFSET_TABLE)
+		fp.write(_ITEM_TAG + length)
+		fp.write(memoryview(image))
+		fp.write(padding + _SEQUENCE_DELIMITER)
+	else:
+		vr = b"OW" if ds.BitsAllocated > 8 else b"OB"
+		fp.write(_PIXEL_HEADER + vr + b"\x00\x00" + length)
+		fp.write(memoryview(image))
+		fp.write(padding)
 
 
 async def run(share_url, password, *args):
@@ -222,7 +397,7 @@ async def run(share_url, password, *args):
 		url = str(report_url.origin()) + match.group(0)
 
 	async with await HinacomDownloader.from_viewer_link(client, url) as downloader:
-		await downloader.download_all("--raw" in args)
+		await downloader.download_all("--raw" in args, "--serial" not in args)
 
 
 # ============================== 下面仅调试用 ==============================
@@ -231,6 +406,7 @@ async def run(share_url, password, *args):
 async def fetch_responses(downloader: HinacomDownloader, save_to: Path, is_raw: bool):
 	"""
 	下载原始的响应用于调试，后续可以用 build_dcm_from_responses 组合成 DCM 文件。
+	每个序列的响应追加到一个抓包文件里，格式见 crawlers/_capture.py。
 
 	:param downloader: 下载器对象
 	:param save_to: 保存的路径
@@ -242,45 +418,56 @@ async def fetch_responses(downloader: HinacomDownloader, save_to: Path, is_raw:
 		json.dump(downloader.dataset, fp, ensure_ascii=False)
 
 	for series in downloader.dataset["displaySets"]:
-		name, images = pathify(series["description"]), series["images"]
+		name, images = pathify(series["description"]) or "Unnamed", series["images"]
 		dir_ = make_unique_dir(save_to / name)
 
-		tasks = tqdm(images, desc=name, unit="张", file=sys.stdout)
-		for i, info in enumerate(tasks):
-			tags = await downloader.get_tags(info)
-			pixels, attrs = await downloader.get_image(info, is_raw)
-			dir_.joinpath(f"{i}.tags.json").write_text(json.dumps(tags))
-			dir_.joinpath(f"{i}.json").write_text(attrs)
-			dir_.joinpath(f"{i}.slice").write_bytes(pixels)
+		with CaptureWriter(dir_) as capture:
+			for info in tqdm(images, desc=name, unit="张", file=sys.stdout):
+				tags = await downloader.get_tags(info)
+				pixels, attrs = await downloader.get_image(info, is_raw)
+				capture.append(json.dumps(tags).encode(), attrs.encode(), pixels)
+
+
+def _build_captured(pack: Path, record: CaptureRecord, filename: Path):
+	with CaptureFile(pack) as capture, capture.pixels(record) as pixels:
+		_write_dicom(capture.tags(record), pixels, filename)
 
 
-def build_dcm_from_responses(source: Path, out_dir: Path = None):
+def build_dcm_from_responses(source: Path, out_dir: Path = None, workers: int = None):
 	"""
 	读取所有临时文件夹的数据（fetch_responses 下载的），合并成 DCM 文件。
+	抓包文件用 mmap 读取，组装在进程池里并行进行。
 
 	:param source: fetch_responses 的 save_to 参数
 	:param out_dir: 保存到哪里？默认跟通常下载的位置一样。
+	:param workers: 进程数，默认为 CPU 的核数。
 	"""
 	with source.joinpath("ImageSet.json").open() as fp:
 		image_set = json.load(fp)
-		name_map = {s["description"].rstrip(): s for s in image_set["displaySets"]}
 
 	if not out_dir:
 		out_dir = _get_save_dir(image_set)
 
-	for series_dir in source.iterdir():
-		if series_dir.is_file():
-			continue
-		info = name_map[series_dir.name]
-		size = len(info["images"])
-		dir_ = SeriesDirectory(out_dir / pathify(series_dir.name), size)
-
-		for i in range(size):
-			tags = series_dir.joinpath(f"{i}.tags.json").read_text("utf8")
-			if tags == "[]":
+	with ProcessPoolExecutor(workers) as pool:
+		futures, seen = [], {}
+		for info in image_set["displaySets"]:
+			# 同名的序列在 fetch_responses 里由 make_unique_dir 加了编号。
+			name = pathify(info["description"]) or "Unnamed"
+			n = seen[name] = seen.get(name, -1) + 1
+			series_dir = source / (f"{name} ({n})" if n else name)
+			if not series_dir.is_dir():
 				continue
-			pixels = series_dir.joinpath(f"{i}.slice").read_bytes()
-			_write_dicom(json.loads(tags), pixels, dir_.get(i, "dcm"))
+
+			# 序列目录在这里按顺序创建，子进程只写文件。
+			dir_ = SeriesDirectory(out_dir, info["seriesNumber"], name, len(info["images"]))
+			for i, record in enumerate(read_index(series_dir)):
+				# 标签为空（"[]"）的不是 DCM 文件。
+				if record.tags > 2:
+					target = dir_.get(i, "dcm")
+					futures.append(pool.submit(_build_captured, series_dir / PACK_FILE, record, target))
+
+		for future in tqdm(as_completed(futures), total=len(futures), unit="张", file=sys.stdout):
+			future.result()
 
 	print(F"从海纳医信的响应合成 DCM 文件。\n源目录：{source}\n输出目录：{out_dir}")
 
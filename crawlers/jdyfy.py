@@ -26,4 +26,4 @@ async def run(share_url, *args):
 			share_url = address.query["returnUrl"]
 
 		async with await HinacomDownloader.from_viewer_link(client, share_url) as downloader:
-			await downloader.download_all("--raw" in args)
+			await downloader.download_all("--raw" in args, "--serial" not in args)
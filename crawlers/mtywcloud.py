@@ -3,7 +3,8 @@ import urllib.parse
 from Cryptodome.Cipher import AES
 from yarl import URL
 
-from crawlers._utils import new_http_client, pkcs7_pad, SeriesDirectory, tqdme, suggest_save_dir
+from crawlers._fetcher import InstanceFetcher
+from crawlers._utils import new_http_client, pkcs7_pad, SeriesDirectory, suggest_save_dir
 
 _key = b"561382DAD3AE48A89AC3003E15D75CC0"
 _iv = b"1234567890000000"
@@ -33,20 +34,28 @@ async def run(url):
 		study_dir = suggest_save_dir(info["PatientName"], info["ModalitiesInStudy"], info["StudyDateTime"])
 		print(f"下载明天医网的云影像到：{study_dir}")
 
+		fetcher = InstanceFetcher()
 		for series in info["SeriesList"]:
 			desc = series["SeriesDescription"] or "定位像"
 			number = series["SeriesNumber"]
 			slices = series["ImageList"]
 			dir_ = SeriesDirectory(study_dir, number, desc, len(slices))
-			for i, image in tqdme(slices, desc=desc):
-				params = {
-					"sopInstanceUID": image["SOPInstanceUID"],
-					"seriesInstanceUID": image["SeriesInstanceUID"],
-					"studyInstanceUID": image["StudyInstanceUID"],
-					"imagePath": image["ImagePath"],
-					"httpPath": "null",
-					"retrieveAE": "",
-					"OrganizationID": query["OrganizationID"],
-				}
-				async with client.get("/ICCWebClient/api/Dicom/File", params=params) as response:
-					dir_.get(i, "dcm").write_bytes(await response.read())
+			fetcher.add(dir_, desc, slices, _fetch_image(client, query["OrganizationID"]))
+
+		await fetcher.run()
+
+
+def _fetch_image(client, organization: str):
+	async def fetch(image):
+		params = {
+			"sopInstanceUID": image["SOPInstanceUID"],
+			"seriesInstanceUID": image["SeriesInstanceUID"],
+			"studyInstanceUID": image["StudyInstanceUID"],
+			"imagePath": image["ImagePath"],
+			"httpPath": "null",
+			"retrieveAE": "",
+			"OrganizationID": organization,
+		}
+		return await client.get("/ICCWebClient/api/Dicom/File", params=params)
+
+	return fetch
@@ -4,14 +4,13 @@ https://blog.kaciras.com/article/45/download-dicom-files-from-hinacom-cloud-view
 import random
 import re
 import string
-import sys
 import time
 from hashlib import md5
 from urllib.parse import parse_qsl, urlencode
 
-from tqdm import tqdm
 from yarl import URL
 
+from crawlers._fetcher import InstanceFetcher
 from crawlers._utils import new_http_client, pathify, SeriesDirectory, suggest_save_dir
 
 TABLE_62 = string.digits + string.ascii_lowercase + string.ascii_uppercase
@@ -104,20 +103,24 @@ async def run(share_url: str):
 		save_to = _get_save_dir(detail["study"])
 		print(f'保存到: {save_to}\n')
 
+		fetcher = InstanceFetcher()
 		for series in series_list["result"]:
 			desc = pathify(series["description"]) or "Unnamed"
 			number = series['series_number']
 			names = series["names"].split(",")
 			dir_ = SeriesDirectory(save_to, number, desc, len(names))
+			fetcher.add(dir_, desc, names, _fetch_image(client, query, series["source_folder"]))
 
-			tasks = tqdm(names, desc=desc, unit="张", file=sys.stdout)
-			for i, name in enumerate(tasks):
-				path = "/rawdata/indata/" + series["source_folder"] + "/" + name
-				headers = {
-					"Authorization": _get_auth(query, name),
-					"Referer": "https://ylyyx.shdc.org.cn/",
-				}
-
-				async with client.get(path, headers=headers) as response:
-					file = await response.read()
-					dir_.get(i, "dcm").write_bytes(file)
+		await fetcher.run()
+
+
+def _fetch_image(client, query: dict, folder: str):
+	async def fetch(name: str):
+		path = "/rawdata/indata/" + folder + "/" + name
+		headers = {
+			"Authorization": _get_auth(query, name),
+			"Referer": "https://ylyyx.shdc.org.cn/",
+		}
+		return await client.get(path, headers=headers)
+
+	return fetch
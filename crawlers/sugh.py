@@ -1,6 +1,7 @@
 from yarl import URL
 
-from crawlers._utils import new_http_client, SeriesDirectory, tqdme, suggest_save_dir
+from crawlers._fetcher import InstanceFetcher
+from crawlers._utils import new_http_client, SeriesDirectory, suggest_save_dir
 
 
 async def run(share_url: str):
@@ -43,6 +44,7 @@ async def run(share_url: str):
 			"Referer": share_url,
 			"token": address.query["clinicalShareToken"],
 		}
+		fetcher = InstanceFetcher()
 		for series in series_list.values():
 			# 这里的 StudyUID 跟第一个请求返回的的有可能不一样。
 			url = "/api/cloudfilm-mgt/api/v1/dicom/studies/" + info["studyUID"]
@@ -50,7 +52,13 @@ async def run(share_url: str):
 
 			desc, number, instances = series["seriesDescription"], series["seriesNumber"], series["imgs"]
 			dir_ = SeriesDirectory(study_dir, number, desc, len(instances))
+			fetcher.add(dir_, desc, list(instances.values()), _fetch_instance(client, url, headers))
 
-			for i, instance in tqdme(instances.values(), desc=desc):
-				async with client.get(f"{url}/instances/{instance['imageUID']}/", headers=headers) as response:
-					dir_.get(i, "dcm").write_bytes(await response.read())
+		await fetcher.run()
+
+
+def _fetch_instance(client, url: str, headers: dict):
+	async def fetch(instance):
+		return await client.get(f"{url}/instances/{instance['imageUID']}/", headers=headers)
+
+	return fetch
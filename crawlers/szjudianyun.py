@@ -2,21 +2,28 @@
 下载 szjudianyun.com 上面的云影像，爬虫流程见：
 https://blog.kaciras.com/article/39/download-raw-dicom-from-cloud-ct-viewer
 """
+import asyncio
 import json
 import random
 import re
 import string
 import sys
+import time
+from collections import deque
+from contextlib import aclosing, asynccontextmanager, AsyncExitStack
+from hashlib import sha256
 from io import BytesIO
-from pathlib import Path
-from typing import Optional
+from typing import Optional, Callable
 
-from aiohttp import ClientWebSocketResponse
+from aiohttp import ClientSession, ClientWebSocketResponse, WSMsgType
 from pydicom import dcmread, Dataset
+from pydicom.errors import InvalidDicomError
 from tqdm import tqdm
 from yarl import URL
 
-from crawlers._utils import new_http_client, SeriesDirectory, suggest_save_dir
+from crawlers._journal import StudyJournal
+from crawlers._utils import new_http_client, SeriesDirectory, suggest_save_dir, fetch_options, add_summary
+from crawlers._writer import FileWriter
 
 _WHITE_SPACES = re.compile(r"\s+")
 
@@ -33,9 +40,8 @@ def _send_message(ws, id_, **message):
 	return ws.send_str(str(id_) + json.dumps(["sendMessage", message]))
 
 
-async def _get_dcm(ws, hospital_id, study, series, instance):
-	await _send_message(
-		ws, 42,
+def _hang_message(hospital_id, study, series, instance):
+	return dict(
 		hospital_id=hospital_id,
 		study=study,
 		tag=tag,
@@ -46,11 +52,139 @@ async def _get_dcm(ws, hospital_id, study, series, instance):
 		series_in=str(instance + 1)
 	)
 
-	# 451 开头的回复消息，没什么用。
-	await anext(ws)
 
-	# 第一位 4 是 socket.io 添加的需要跳过。
-	return (await anext(ws)).data[1:]
+class _Mismatch(Exception):
+	"""回复跟请求对不上，可能是服务端乱序或丢了消息。"""
+
+
+# 检查回复的内容是否属于请求，参数为请求、回复的文本部分和 DCM 文件。
+ReplyCheck = Callable[[dict, str, bytes], bool]
+
+
+class _Pipeline:
+	"""
+	在同一个 socket.io 连接上保持多个 hangC 请求在途，而不是等收到回复再发下一个，
+	这样每张图不用都等一个往返。每个回复是一条 451 开头的文本消息加一个二进制帧，
+	服务端看起来是按顺序处理的，所以按发送的顺序跟请求对应。
+
+	如果回复跟请求对不上或者等太久，就丢弃连接上迟到的消息，把窗口降为 1 再重新请求没完成的，
+	之后跟原来一样一问一答，也不再检查和超时。
+	"""
+
+	def __init__(self, ws: ClientWebSocketResponse, window: int, timeout=30.0, settle=2.0):
+		"""
+		:param ws: 已经完成握手的连接
+		:param window: 最多同时有多少个请求在途
+		:param timeout: 窗口大于 1 时，等待一个回复的最长时间（秒）
+		:param settle: 回退时，多久没有新消息就认为迟到的都收完了（秒）
+		"""
+		self.ws = ws
+		self.window = max(1, window)
+		self.timeout = timeout
+		self.settle = settle
+		self.initial_window = self.window
+		self.fallbacks = 0
+		add_summary(self.summary)
+
+	async def _next_message(self, timeout: Optional[float]):
+		while True:
+			message = await self.ws.receive(timeout)
+			if message.type in (WSMsgType.CLOSE, WSMsgType.CLOSING, WSMsgType.CLOSED, WSMsgType.ERROR):
+				raise ConnectionError("WebSocket 连接已断开")
+
+			# 4 开头的才是 socket.io 的消息，其它的是 engine.io 的心跳之类，跳过。
+			if message.type != WSMsgType.TEXT or message.data.startswith("4"):
+				return message
+
+	async def _receive(self):
+		"""
+		读取一个回复，返回文本部分和 DCM 文件。
+		"""
+		timeout = self.timeout if self.window > 1 else None
+
+		header = await self._next_message(timeout)
+		if header.type != WSMsgType.TEXT or not header.data.startswith("451"):
+			raise _Mismatch(f"预期 451 开头的消息，收到了 {header.type.name}")
+
+		body = await self._next_message(timeout)
+		if body.type != WSMsgType.BINARY:
+			raise _Mismatch(f"预期二进制消息，收到了 {body.type.name}")
+
+		# 第一位 4 是 socket.io 添加的需要跳过。
+		return header.data, body.data[1:]
+
+	async def _fall_back(self, reason: Exception):
+		self.window = 1
+		self.fallbacks += 1
+		tqdm.write(f"请求流水线出错（{reason or type(reason).__name__}），改为逐个请求。", sys.stderr)
+
+		# 把已发出的请求的回复都读掉，直到一段时间没有新消息。
+		while True:
+			try:
+				await self._next_message(self.settle)
+			except asyncio.TimeoutError:
+				return
+
+	async def fetch(self, messages: list[dict], check: ReplyCheck = None):
+		"""
+		按顺序请求多个图像，返回异步迭代器，依次产生每个请求的 DCM 文件。
+
+		:param messages: hangC 请求的参数
+		:param check: 检查回复是否属于该请求，不通过则回退到窗口为 1。
+		"""
+		todo, pending = deque(messages), deque()
+
+		while todo or pending:
+			while todo and len(pending) < self.window:
+				message = todo.popleft()
+				await _send_message(self.ws, 42, **message)
+				pending.append(message)
+
+			# 窗口为 1 时不可能对不上，跟原来一样不做检查。
+			if self.window == 1:
+				_, data = await self._receive()
+			else:
+				try:
+					header, data = await self._receive()
+					if not _echo_matches(pending[0], header):
+						raise _Mismatch("回复的序列或序号跟请求的不同")
+					if check and not check(pending[0], header, data):
+						raise _Mismatch("回复的内容跟请求的不一致")
+				except (_Mismatch, asyncio.TimeoutError) as e:
+					await self._fall_back(e)
+					todo.extendleft(reversed(pending))
+					pending.clear()
+					continue
+
+			pending.popleft()
+			yield data
+
+	async def request(self, message: dict, check: ReplyCheck = None):
+		async with aclosing(self.fetch([message], check)) as replies:
+			return await anext(replies)
+
+	def summary(self):
+		if self.fallbacks:
+			return f"szjudianyun 请求流水线窗口 {self.initial_window}，出错回退了 {self.fallbacks} 次"
+		return ""
+
+
+def _echo_matches(message: dict, header: str):
+	"""
+	如果回复的文本部分带有请求的序列和序号，检查它们跟请求的是否相同，没有则认为匹配。
+	"""
+	try:
+		args = json.loads(header[header.index("["):])
+	except ValueError:
+		return True
+
+	for arg in args:
+		if not isinstance(arg, dict):
+			continue
+		for key in ("series", "series_in"):
+			if key in arg and str(arg[key]) != message[key]:
+				return False
+	return True
 
 
 def _get_save_dir(ds: Dataset):
@@ -60,56 +194,229 @@ def _get_save_dir(ds: Dataset):
 	return suggest_save_dir(patient, desc, datetime)
 
 
-async def download_study(ws: ClientWebSocketResponse, info):
+def _save(journal: StudyJournal, job: "_SeriesJob", index: int, data: bytes):
+	# 写完才记录到日志，中断时写了一半的文件没有记录，下次会重新下载。
+	job.dir.get(index, "dcm").write_bytes(data)
+	journal.add_instance(job.sid, index, len(data), sha256(data).hexdigest())
+
+
+def _open_series_dir(journal: StudyJournal, job: "_SeriesJob", size: int):
+	"""
+	创建序列目录，如果上次运行已经创建过则继续使用，返回其中已下载完整的实例的次序。
+	序列的 ID 是服务端给的，同一个链接每次都一样，直接用作日志里的键。
+	"""
+	existing = journal.series_dir(job.sid)
+	if not existing:
+		job.dir.make_dir()
+		journal.add_dir(job.sid, job.dir.path)
+		return set()
+
+	job.dir.reuse_dir(existing)
+	return {i for i in range(size) if journal.is_complete(job.sid, i, job.dir.get(i, "dcm"))}
+
+
+class _SeriesCheck:
+	"""
+	回复的文本部分一般不带请求的参数，只能检查 DCM 文件：序列的 UID 要跟第一张的相同，
+	实例的 UID 不能重复，这样能发现回复错位到别的序列或者重复的情况。
+	"""
+
+	def __init__(self, first: Dataset):
+		self.series_uid = first.SeriesInstanceUID
+		self.seen = {first.SOPInstanceUID}
+
+	def __call__(self, _, __, data: bytes):
+		# 解析不了的也算不通过，回退到逐个请求后会重新请求它。
+		try:
+			ds = dcmread(BytesIO(data), stop_before_pixels=True)
+		except (InvalidDicomError, EOFError):
+			return False
+		if ds.get("SeriesInstanceUID") != self.series_uid or ds.get("SOPInstanceUID") in self.seen:
+			return False
+		self.seen.add(ds.SOPInstanceUID)
+		return True
+
+
+class _Session:
+	"""连接池里的一个 socket.io 会话，记录它下载的数量用于统计吞吐量。"""
+
+	def __init__(self, index: int, ws: ClientWebSocketResponse, window: int):
+		self.index = index
+		self.pipeline = _Pipeline(ws, window)
+		self.count = 0
+		self.size = 0
+		self.elapsed = 0.0
+
+	async def fetch(self, messages: list[dict], check: ReplyCheck = None):
+		start = time.perf_counter()
+		try:
+			async for data in self.pipeline.fetch(messages, check):
+				self.count += 1
+				self.size += len(data)
+				yield data
+		finally:
+			self.elapsed += time.perf_counter() - start
+
+	def summary(self):
+		if self.count == 0:
+			return ""
+		speed = self.size / 1048576 / max(self.elapsed, 1e-6)
+		return f"szjudianyun 连接 {self.index}：{self.count} 张，{self.size / 1048576:.1f}MB，{speed:.2f}MB/s"
+
+
+@asynccontextmanager
+async def _open_session(client: ClientSession, hospital_id: str, study: str, password: str):
+	"""
+	建立一个已登录的 socket.io 会话，先用轮询握手拿到 sid，再升级到 WebSocket 并发送 saveC 登录。
+	返回 WebSocket 连接和检查的信息。
+	"""
+	t = "".join(random.choices(string.ascii_letters + string.digits, k=7))
+
+	async with client.get(f"/socket.io/?EIO=3&transport=polling&t={t}") as response:
+		text = await response.text()
+		text = text[text.index("{"): text.rindex("}") + 1]
+		sid = json.loads(text)["sid"]
+
+	# aiohttp 不要求使用 ws: 协议，默认的 http: 也行。
+	async with client.ws_connect(f"/socket.io/?EIO=3&transport=websocket&sid={sid}") as ws:
+		await ws.send_str("2probe")
+		await anext(ws)
+		await ws.send_str("5")
+
+		await _send_message(ws, 42, type="saveC", hospital_id=hospital_id, study=study, password=password)
+		message = await anext(ws)
+		yield ws, json.loads(message.data[2:])[1]
+
+
+class _SeriesJob:
+
+	def __init__(self, sid: str, first: bytes):
+		self.sid = sid
+		self.first = first
+		self.ds = dcmread(BytesIO(first))
+		self.check = _SeriesCheck(self.ds)
+		self.dir: Optional[SeriesDirectory] = None
+		self.progress: Optional[tqdm] = None
+
+
+# 每次从队列里取多少张图给一个连接，太大的话最后会有连接空闲，太小则流水线填不满。
+_CHUNK_SIZE = 16
+
+
+async def _fetch_firsts(session: _Session, hospital_id, study, sids: list[str], firsts: dict[str, bytes]):
+	messages = [_hang_message(hospital_id, study, sid, 0) for sid in sids]
+	sid_iter = iter(sids)
+	async for data in session.fetch(messages):
+		firsts[next(sid_iter)] = data
+
+
+async def _fetch_chunks(session: _Session, hospital_id, study, writer: FileWriter, journal: StudyJournal, chunks: deque):
+	while chunks:
+		job, indices = chunks.popleft()
+		messages = [_hang_message(hospital_id, study, job.sid, i) for i in indices]
+		index_iter = iter(indices)
+		async for data in session.fetch(messages, job.check):
+			job.progress.update(1)
+			await writer.submit(_save, journal, job, next(index_iter), data)
+
+
+async def download_study(sessions: list[_Session], writer: FileWriter, info):
+	"""
+	先用所有连接同时下载每个序列的第一张图，确定目录的名字，再把剩下的分块交给各个连接。
+	支持断点续传，重新运行时继续使用上次的序列目录，只下载缺少的和被截断的。
+
+	:param sessions: 已登录的会话，至少要有一个
+	:param writer: 保存文件的线程池
+	:param info: 登录时返回的检查信息
+	"""
 	hospital_id, study = info["hosipital"].split(separator, 2)
 	series_list, sizes = info["series"], info["series_dicom_number"]
 
-	study_dir: Optional[Path] = None
+	# 最后会有一张非 DICOM 图片。
+	sids = [sid for sid in series_list if not sid.startswith("dfyfilm")]
+	if not sids:
+		return
 
-	for sid in series_list:
-		if sid.startswith("dfyfilm"):  # 最后会有一张非 DICOM 图片。
-			continue
+	firsts = {}
+	try:
+		async with asyncio.TaskGroup() as group:
+			for session in sessions:
+				assigned = sids[session.index::len(sessions)]
+				group.create_task(_fetch_firsts(session, hospital_id, study, assigned, firsts))
+	except ExceptionGroup as e:
+		raise e.exceptions[0]
 
-		# 只有先读取一个影像才能确定目录的名字。
-		first = await _get_dcm(ws, hospital_id, study, sid, 0)
-		ds = dcmread(BytesIO(first))
+	# 按原来的顺序创建目录，同名序列的编号才跟逐个下载时一样。
+	jobs = [_SeriesJob(sid, firsts[sid]) for sid in sids]
+	study_dir = _get_save_dir(jobs[0].ds)
+	print(f"下载 szjudianyun 的 DICOM 到：{study_dir}")
 
-		if not study_dir:
-			study_dir = _get_save_dir(ds)
-			print(f"下载 szjudianyun 的 DICOM 到：{study_dir}")
+	# 断点续传的日志，格式跟公共的下载引擎的相同。
+	journal = await writer.call(StudyJournal, study_dir)
+	try:
+		chunks = deque()
+		for position, job in enumerate(jobs):
+			description = job.ds.SeriesDescription or "定位像"
+			job.dir = SeriesDirectory(study_dir, job.ds.SeriesNumber, description, sizes[job.sid])
 
-		description = ds.SeriesDescription or "定位像"
-		dir_ = SeriesDirectory(study_dir, ds.SeriesNumber, description, sizes[sid])
-		dir_.get(0, "dcm").write_bytes(first)
+			# 先建好目录，否则多个线程同时写入时可能创建出重复的目录。
+			done = await writer.call(_open_series_dir, journal, job, sizes[job.sid])
+			if 0 not in done:
+				await writer.submit(_save, journal, job, 0, job.first)
+				done.add(0)
 
-		# 这里需要跳过已经下载的一个，tqdm 的迭代式写法好像做不到。
-		with tqdm(initial=1, total=sizes[sid], desc=description, unit="张", file=sys.stdout) as progress:
-			for i in range(1, sizes[sid]):
-				data = await _get_dcm(ws, hospital_id, study, sid, i)
-				progress.update(1)
-				dir_.get(i, "dcm").write_bytes(data)
+			job.progress = tqdm(
+				initial=len(done), total=sizes[job.sid], desc=description,
+				unit="张", file=sys.stdout, position=position,
+			)
+			missing = [i for i in range(1, sizes[job.sid]) if i not in done]
+			for start in range(0, len(missing), _CHUNK_SIZE):
+				chunks.append((job, missing[start:start + _CHUNK_SIZE]))
 
+		try:
+			async with asyncio.TaskGroup() as group:
+				for session in sessions:
+					group.create_task(_fetch_chunks(session, hospital_id, study, writer, journal, chunks))
+		except ExceptionGroup as e:
+			raise e.exceptions[0]
 
-async def run(url):
-	t = "".join(random.choices(string.ascii_letters + string.digits, k=7))
+		await writer.drain()
+	finally:
+		for job in jobs:
+			if job.progress:
+				job.progress.close()
+
+		# 等已提交的写入都结束再关闭日志，出错时它们的异常就不管了。
+		await asyncio.gather(writer.drain(), return_exceptions=True)
+		await writer.call(journal.close)
 
+
+async def run(url):
 	url = URL(url)
 	hospital_id = url.query["a"]
 	study = url.query["b"]
 	password = url.query["c"]
 
-	async with new_http_client(base_url) as client:
-		async with client.get(f"/socket.io/?EIO=3&transport=polling&t={t}") as response:
-			text = await response.text()
-			text = text[text.index("{"): text.rindex("}") + 1]
-			sid = json.loads(text)["sid"]
-
-		# aiohttp 不要求使用 ws: 协议，默认的 http: 也行。
-		async with client.ws_connect(f"/socket.io/?EIO=3&transport=websocket&sid={sid}") as ws:
-			await ws.send_str("2probe")
-			await anext(ws)
-			await ws.send_str("5")
-
-			await _send_message(ws, 42, type="saveC", hospital_id=hospital_id, study=study, password=password)
-			message = await anext(ws)
-			await download_study(ws, json.loads(message.data[2:])[1])
+	options = fetch_options.get()
+
+	async with new_http_client(base_url) as client, AsyncExitStack() as stack:
+		async def connect(index: int):
+			ws, info = await stack.enter_async_context(_open_session(client, hospital_id, study, password))
+			# 同时在途的请求数跟 HTTP 的并发数用同一个选项。
+			session = _Session(index, ws, options.concurrency)
+			add_summary(session.summary)
+			return session, info
+
+		try:
+			async with asyncio.TaskGroup() as group:
+				tasks = [group.create_task(connect(i)) for i in range(max(1, options.connections))]
+		except ExceptionGroup as e:
+			raise e.exceptions[0]
+
+		connected = [task.result() for task in tasks]
+		sessions = [session for session, _ in connected]
+
+		# 写文件在线程池里进行，可以跟下一个请求同时进行。
+		async with FileWriter() as writer:
+			await download_study(sessions, writer, connected[0][1])
+			await writer.drain()
@@ -1,6 +1,7 @@
 from yarl import URL
 
-from crawlers._utils import new_http_client, SeriesDirectory, tqdme, suggest_save_dir
+from crawlers._fetcher import InstanceFetcher
+from crawlers._utils import new_http_client, SeriesDirectory, suggest_save_dir
 
 
 async def run(share_url: str):
@@ -22,18 +23,24 @@ async def run(share_url: str):
 		study_dir = suggest_save_dir(info["patient_name"], info["checkitems"], info["study_date"])
 		print(f"下载医众数字影像到：{study_dir}")
 
+		fetcher = InstanceFetcher()
 		for series in info["series"]:
 			instances = series["instance_ids"].split(",")
 			number = series["series_number"]
 			desc = series["series_description"]
 			dir_ = SeriesDirectory(study_dir, number, desc, len(instances))
+			fetcher.add(dir_, desc, instances, _fetch_instance(client, cdn, study_uid, number))
 
-			for i, name in tqdme(instances, desc=desc):
-				# 有可能出现 PNG、JPG 截屏图片作为一个序列。
-				sep, ext = name.find("|"), "dcm"
-				if sep != -1:
-					name, ext = name[:sep], name[sep + 1:]
+		await fetcher.run()
 
-				u = cdn.joinpath(f"{study_uid}/{series['series_number']}.{name}.{ext}")
-				async with client.get(u) as response:
-					dir_.get(i, "dcm").write_bytes(await response.read())
+
+def _fetch_instance(client, cdn: URL, study_uid: str, series_number):
+	async def fetch(name: str):
+		# 有可能出现 PNG、JPG 截屏图片作为一个序列。
+		sep, ext = name.find("|"), "dcm"
+		if sep != -1:
+			name, ext = name[:sep], name[sep + 1:]
+
+		return await client.get(cdn.joinpath(f"{study_uid}/{series_number}.{name}.{ext}"))
+
+	return fetch
@@ -7,7 +7,8 @@ from urllib.parse import parse_qsl
 from Cryptodome.Cipher import AES
 from yarl import URL
 
-from crawlers._utils import new_http_client, SeriesDirectory, tqdme, pkcs7_unpad, suggest_save_dir
+from crawlers._fetcher import InstanceFetcher
+from crawlers._utils import new_http_client, SeriesDirectory, pkcs7_unpad, suggest_save_dir
 
 # 加载时计算的常量，网站更新可能变（已遇到一次）。
 _LAST_KEY = "c57b1589172b85531c2dbad73c5e9056"
@@ -86,18 +87,25 @@ async def run(share_url):
 			body = await response.json()
 			series_list = body["PatientInfo"]["StudyList"][0]["SeriesList"]
 
+		fetcher = InstanceFetcher()
 		for series in series_list:
 			desc, number, slices = series["SeriesDes"], series["SeriesNum"], series["ImageList"]
 			dir_ = SeriesDirectory(save_to, number, desc, len(slices))
+			fetcher.add(dir_, desc, slices, _fetch_image(client, credentials_token, info, series))
 
-			for i, image in tqdme(slices, desc=desc):
-				params = {
-					"CommandType": "GetImage",
-					"ContentType": "application/dicom",
-					"ObjectUID": image["UID"],
-					"StudyUID": info["studyInstanceUid"],
-					"SeriesUID": series["UID"],
-					"includeDeleted": "false",
-				}
-				async with _call_image_service(client, credentials_token, params) as response:
-					dir_.get(i, "dcm").write_bytes(await response.read())
+		await fetcher.run()
+
+
+def _fetch_image(client, token, info, series):
+	async def fetch(image):
+		params = {
+			"CommandType": "GetImage",
+			"ContentType": "application/dicom",
+			"ObjectUID": image["UID"],
+			"StudyUID": info["studyInstanceUid"],
+			"SeriesUID": series["UID"],
+			"includeDeleted": "false",
+		}
+		return await _call_image_service(client, token, params)
+
+	return fetch
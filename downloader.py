@@ -1,38 +1,267 @@
+import argparse
 import asyncio
+import importlib
+import json
+import shlex
 import sys
+import time
+from contextlib import AsyncExitStack
+from dataclasses import dataclass, field, fields, replace
+from pathlib import Path
 
 from yarl import URL
 
-from crawlers import szjudianyun, hinacom, cq12320, shdc, zscloud, ftimage, mtywcloud, yzhcloud, sugh, jdyfy
+from crawlers._connector import ConnectionPool
+from crawlers._utils import fetch_options, FetchOptions, collect_summaries, print_summaries, format_summaries
+
+
+def parse_args():
+	"""
+	只解析通用的选项，其余的参数（密码、--raw 等）原样传给各站点的 run 函数。
+	"""
+	parser = argparse.ArgumentParser(description="医疗云影像下载器，支持的站点见 README.md")
+	parser.add_argument("url", nargs="?", help="报告或分享的链接，批量下载时省略")
+	parser.add_argument("--concurrency", type=int, default=4, metavar="N", help="同时进行的请求数，默认为 4")
+	parser.add_argument("--series-concurrency", type=int, default=0, metavar="N", help="每个序列同时进行的请求数，默认不单独限制")
+	parser.add_argument("--adaptive", action="store_true", help="根据延迟和错误自动调整并发数，--concurrency 作为初始值")
+	parser.add_argument("--retries", type=int, default=4, metavar="N", help="请求失败时最多重试的次数，默认为 4")
+	parser.add_argument("--processes", type=int, default=0, metavar="N", help="处理 DCM 文件的进程数，默认跟 CPU 核数相同")
+	parser.add_argument("--connections", type=int, default=2, metavar="N", help="WebSocket 连接数，默认为 2")
+	parser.add_argument("--headless", action="store_true", help="需要浏览器的网站，不显示浏览器窗口")
+	parser.add_argument("--store", default="", metavar="DIR", help="相同的文件在该目录只存一份，检查目录里的是链接")
+	parser.add_argument("--catalog", default="", metavar="FILE", help="把下载的文件记录到该 SQLite 数据库，用 tools/catalog.py 查询")
+	parser.add_argument("--dicomdir", action=argparse.BooleanOptionalAction, default=True, help="为每个检查生成 DICOMDIR 和 manifest.json，默认开启")
+	parser.add_argument("--archive", choices=["zip", "zip-store", "tar"], default="", help="把检查直接写成压缩包，不生成文件夹")
+	parser.add_argument("--transcode", choices=["rle", "jpeg2000", "jpeg-ls"], default="", help="下载完的 DCM 文件转码为无损压缩的格式，节省空间")
+	parser.add_argument("--pool-limit", type=int, default=100, metavar="N", help="同时打开的 HTTP 连接数上限，0 为不限制，默认为 100")
+	parser.add_argument("--pool-limit-per-host", type=int, default=0, metavar="N", help="每个主机同时打开的连接数上限，默认不限制")
+	parser.add_argument("--keepalive-timeout", type=float, default=15, metavar="SECONDS", help="空闲连接保留的秒数，默认为 15")
+	parser.add_argument("--dns-ttl", type=int, default=10, metavar="SECONDS", help="DNS 解析结果缓存的秒数，0 为不缓存，默认为 10")
+	parser.add_argument("--happy-eyeballs-delay", type=float, default=0.25, metavar="SECONDS", help="同时有 IPv4 和 IPv6 地址时，等待多少秒再尝试下一个，0 为关闭，默认为 0.25")
+	parser.add_argument("--batch", metavar="FILE", help="批量下载，从文件读取链接，格式见 README.md")
+	parser.add_argument("--jobs", type=int, default=4, metavar="N", help="批量下载时同时下载的检查数，默认为 4")
+	parser.add_argument("--per-host", type=int, default=1, metavar="N", help="批量下载时每个网站同时下载的检查数，默认为 1")
+	parser.add_argument("--results", default="results.jsonl", metavar="FILE", help="批量下载的结果文件，默认为 results.jsonl")
+	return parser.parse_known_args()
+
+
+# 域名到爬虫模块的映射，匹配到才导入，这样下载普通网站时不用加载 Playwright 之类的大库。
+# 模式是完整的域名，以 * 开头的匹配其所有子域名。
+_SITES = {
+	"*.medicalimagecloud.com": "crawlers.hinacom",
+	"mdmis.cq12320.cn": "crawlers.cq12320",
+	"qr.szjudianyun.com": "crawlers.szjudianyun",
+	"ylyyx.shdc.org.cn": "crawlers.shdc",
+	"zscloud.zs-hospital.sh.cn": "crawlers.zscloud",
+	"app.ftimage.cn": "crawlers.ftimage",
+	"yyx.ftimage.cn": "crawlers.ftimage",
+	"m.yzhcloud.com": "crawlers.yzhcloud",
+	"ss.mtywcloud.com": "crawlers.mtywcloud",
+	"work.sugh.net": "crawlers.sugh",
+	"cloudpacs.jdyfy.com": "crawlers.jdyfy",
+}
+
+
+# 需要浏览器的站点模块，批量下载里有它们才启动浏览器池。
+_BROWSER_MODULES = frozenset(("crawlers.ftimage",))
+
+
+def find_site(host: str):
+	"""返回处理该域名的模块名，不支持的返回 None"""
+	for pattern, module_name in _SITES.items():
+		if pattern.startswith("*"):
+			if host.endswith(pattern[1:]):
+				return module_name
+		elif host == pattern:
+			return module_name
+
+
+def get_site(url: str):
+	"""根据链接的域名导入爬虫模块，不支持的返回 None"""
+	module_name = find_site(URL(url).host or "")
+	return module_name and importlib.import_module(module_name)
+
+
+@dataclass(slots=True)
+class _Study:
+	"""批量下载里的一项，args 是传给站点 run 函数的参数，options 覆盖命令行的通用选项。"""
+
+	url: str
+	args: list[str] = field(default_factory=list)
+	options: dict = field(default_factory=dict)
+
+
+# 连接池和挂在它上面的重试策略是所有检查共用的，不能为单个检查设置。
+_POOL_OPTIONS = frozenset(("pool_limit", "pool_limit_per_host", "keepalive_timeout", "dns_ttl", "happy_eyeballs_delay", "retries"))
+
+_OPTION_NAMES = frozenset(f.name for f in fields(FetchOptions)) - _POOL_OPTIONS
+
+
+def _parse_batch_line(line: str):
+	"""
+	一行是一个 JSON 对象，或者跟命令行一样的 `链接 [密码] [--raw ...]`。
+	"""
+	if not line.startswith("{"):
+		url, *args = shlex.split(line)
+		return _Study(url, args)
+
+	item = json.loads(line)
+	args = list(item.get("args", ()))
+	if item.get("password"):
+		args.insert(0, item["password"])
+
+	options = item.get("options", {})
+	unknown = options.keys() - _OPTION_NAMES
+	if unknown:
+		raise ValueError(f"未知的选项：{', '.join(unknown)}")
+
+	return _Study(item["url"], args, options)
+
+
+def read_batch(path: Path):
+	"""读取批量下载的文件，忽略空行和 # 开头的注释。"""
+	studies = []
+	with path.open(encoding="utf8") as fp:
+		for number, line in enumerate(fp, 1):
+			line = line.strip()
+			if not line or line.startswith("#"):
+				continue
+			try:
+				studies.append(_parse_batch_line(line))
+			except (ValueError, KeyError) as e:
+				raise ValueError(f"{path} 第 {number} 行有误：{e}") from e
+	return studies
+
+
+class _Batch:
+	"""
+	在同一个事件循环里同时下载多个检查，有全局和每个网站的并发上限。
+	每个检查完成后往结果文件写一行 JSON，包含链接、状态、错误和统计信息。
+	"""
+
+	def __init__(self, jobs: int, per_host: int, results):
+		self.jobs = asyncio.Semaphore(jobs)
+		self.per_host = per_host
+		self.hosts: dict[str, asyncio.Semaphore] = {}
+		self.results = results
+		self.failed = 0
+
+	async def run_one(self, study: _Study):
+		# 无效的链接下面的 get_site 还会报错，记为该检查出错。
+		try:
+			host = URL(study.url).host or ""
+		except ValueError:
+			host = ""
+		limit = self.hosts.get(host)
+		if limit is None:
+			limit = self.hosts[host] = asyncio.Semaphore(self.per_host)
+
+		result = {"url": study.url, "host": host}
+
+		# 先等网站的名额再等全局的，以免占着全局名额等一个忙的网站。
+		async with limit, self.jobs:
+			# 每个检查在自己的 Task 里，设置的 ContextVar 不影响其它检查。
+			fetch_options.set(replace(fetch_options.get(), **study.options))
+			summaries = collect_summaries()
+			start = time.perf_counter()
+
+			# 导入站点模块也可能出错（比如没有安装 Playwright），同样只影响这一个检查。
+			try:
+				module_ = get_site(study.url)
+				if module_ is None:
+					result["status"] = "unsupported"
+				else:
+					await module_.run(study.url, *study.args)
+					result["status"] = "ok"
+			except Exception as e:
+				result["status"] = "error"
+				result["error"] = f"{type(e).__name__}: {e}"
+
+			result["elapsed"] = round(time.perf_counter() - start, 3)
+			result["summary"] = format_summaries(summaries)
+
+		if result["status"] != "ok":
+			self.failed += 1
+		self.results.write(json.dumps(result, ensure_ascii=False) + "\n")
+		self.results.flush()
+
+
+def needs_browser(studies: list[_Study]):
+	"""批量下载里是否有需要浏览器的网站，只看域名，不导入爬虫模块。"""
+	for study in studies:
+		try:
+			host = URL(study.url).host or ""
+		except ValueError:
+			continue
+		if find_site(host) in _BROWSER_MODULES:
+			return True
+	return False
+
+
+async def run_batch(args):
+	studies = read_batch(Path(args.batch))
+	print(f"批量下载 {len(studies)} 个检查，结果写入 {args.results}")
+
+	# HTTP 连接是共用的，同一个网站的检查可以复用前面的连接，断路器也是共用的。
+	pool = ConnectionPool(fetch_options.get().retries, **fetch_options.get().connector_options())
+	with open(args.results, "a", encoding="utf8") as results:
+		async with AsyncExitStack() as stack:
+			await stack.enter_async_context(pool)
+
+			# 需要浏览器的网站共用一个浏览器，同时打开的上下文跟同时下载的检查一样多。
+			# 没有这样的网站就不导入 Playwright，也就不需要安装它。
+			if needs_browser(studies):
+				from crawlers._browser import BrowserPool
+				await stack.enter_async_context(BrowserPool(args.jobs, args.headless))
+
+			batch = _Batch(args.jobs, args.per_host, results)
+			async with asyncio.TaskGroup() as group:
+				for study in studies:
+					group.create_task(batch.run_one(study))
+
+	print(f"批量下载完成，{len(studies) - batch.failed} 个成功，{batch.failed} 个失败。")
+	print_summaries([pool.summary])
 
 
 async def main():
-	host = URL(sys.argv[1]).host
-
-	if host.endswith(".medicalimagecloud.com"):
-		module_ = hinacom
-	elif host == "mdmis.cq12320.cn":
-		module_ = cq12320
-	elif host == "qr.szjudianyun.com":
-		module_ = szjudianyun
-	elif host == "ylyyx.shdc.org.cn":
-		module_ = shdc
-	elif host == "zscloud.zs-hospital.sh.cn":
-		module_ = zscloud
-	elif host == "app.ftimage.cn" or host == "yyx.ftimage.cn":
-		module_ = ftimage
-	elif host == "m.yzhcloud.com":
-		module_ = yzhcloud
-	elif host == "ss.mtywcloud.com":
-		module_ = mtywcloud
-	elif host == "work.sugh.net":
-		module_ = sugh
-	elif host == "cloudpacs.jdyfy.com":
-		module_ = jdyfy
-	else:
+	args, extra = parse_args()
+	fetch_options.set(FetchOptions(
+		concurrency=args.concurrency,
+		series_concurrency=args.series_concurrency,
+		adaptive=args.adaptive,
+		retries=args.retries,
+		processes=args.processes,
+		connections=args.connections,
+		headless=args.headless,
+		store=args.store,
+		catalog=args.catalog,
+		dicomdir=args.dicomdir,
+		archive=args.archive,
+		transcode=args.transcode,
+		pool_limit=args.pool_limit,
+		pool_limit_per_host=args.pool_limit_per_host,
+		keepalive_timeout=args.keepalive_timeout,
+		dns_ttl=args.dns_ttl,
+		happy_eyeballs_delay=args.happy_eyeballs_delay,
+	))
+
+	if args.batch:
+		return await run_batch(args)
+	if not args.url:
+		return print("需要提供链接，或者用 --batch 指定批量下载的文件", file=sys.stderr)
+
+	module_ = get_site(args.url)
+	if module_ is None:
 		return print("不支持的网站，详情见 README.md")
 
-	await module_.run(*sys.argv[1:])
+	summaries = collect_summaries()
+	pool = ConnectionPool(fetch_options.get().retries, **fetch_options.get().connector_options())
+	summaries.append(pool.summary)
+	try:
+		async with pool:
+			await module_.run(args.url, *extra)
+	finally:
+		print_summaries(summaries)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,125 @@
+import asyncio
+import tarfile
+import zipfile
+from pathlib import Path
+
+import pytest
+
+from crawlers._archive import open_archive, ArchiveSink
+# noinspection PyProtectedMember
+from crawlers._fetcher import InstanceFetcher, _SeriesJob
+from crawlers._utils import SeriesDirectory, fetch_options, FetchOptions
+
+
+def _wait_series(monkeypatch, desc: str):
+	"""返回一个 Event，在名为 desc 的序列的实例都处理完后设置。"""
+	finished, original = asyncio.Event(), _SeriesJob.finish_one
+
+	def finish_one(job):
+		original(job)
+		if job.desc == desc and job.remaining == 0:
+			finished.set()
+
+	monkeypatch.setattr(_SeriesJob, "finish_one", finish_one)
+	return finished
+
+
+async def _download(study_dir: Path, archive: str, fail_at=None, wait: asyncio.Event = None):
+	async def fetch(value: int):
+		if value == fail_at:
+			# 等第一个序列写完，否则它可能还没写入就被取消了。
+			await wait.wait()
+			raise ValueError("boom")
+		return str(value).encode() * 1000
+
+	token = fetch_options.set(FetchOptions(archive=archive))
+	try:
+		fetcher = InstanceFetcher(concurrency=4)
+		fetcher.add(SeriesDirectory(study_dir, None, "头部", 3), "A", range(3), fetch)
+		fetcher.add(SeriesDirectory(study_dir, None, "头部", 2), "B", range(3, 5), fetch)
+		await fetcher.run()
+	finally:
+		fetch_options.reset(token)
+
+
+def _read_tar(file: Path):
+	with tarfile.open(file) as tar:
+		return {m.name: tar.extractfile(m).read() for m in tar}
+
+
+def _read_zip(file: Path):
+	with zipfile.ZipFile(file) as pack:
+		return {name: pack.read(name) for name in pack.namelist()}
+
+
+@pytest.mark.parametrize("archive, name, read", [
+	("tar", "患者-CT-20240101.tar", _read_tar),
+	("zip", "患者-CT-20240101.zip", _read_zip),
+	("zip-store", "患者-CT-20240101.zip", _read_zip),
+])
+async def test_write_archive(tmp_path, archive, name, read):
+	await _download(tmp_path / "患者-CT-20240101", archive)
+
+	# 不生成文件夹，临时文件也删除了。
+	assert [p.name for p in tmp_path.iterdir()] == [name]
+	entries = read(tmp_path / name)
+	assert entries == {
+		"患者-CT-20240101/头部/1.dcm": b"0" * 1000,
+		"患者-CT-20240101/头部/2.dcm": b"1" * 1000,
+		"患者-CT-20240101/头部/3.dcm": b"2" * 1000,
+		"患者-CT-20240101/头部 (1)/1.dcm": b"3" * 1000,
+		"患者-CT-20240101/头部 (1)/2.dcm": b"4" * 1000,
+	}
+
+
+async def test_interrupted(tmp_path, monkeypatch):
+	study_dir = tmp_path / "study"
+	with pytest.raises(ValueError):
+		await _download(study_dir, "zip", fail_at=3, wait=_wait_series(monkeypatch, "A"))
+	assert "study/头部 (1)/1.dcm" not in _read_zip(tmp_path / "study.zip")
+	assert "study/头部/3.dcm" in _read_zip(tmp_path / "study.zip")
+
+	# 已存在的不覆盖。
+	await _download(study_dir, "tar")
+	await _download(study_dir, "tar")
+	assert len(_read_tar(tmp_path / "study (1).tar")) == 5
+
+
+class _BrokenReader:
+
+	def __init__(self):
+		self.calls = 0
+
+	def read(self, _):
+		self.calls += 1
+		if self.calls > 1:
+			raise OSError("killed")
+		return b"x" * 700
+
+
+def test_tar_valid_while_writing(tmp_path):
+	sink = open_archive(tmp_path / "study", "tar")
+	sink.add_bytes(tmp_path / "study" / "a.dcm", b"a" * 100)
+
+	# 模拟写到一半进程被杀掉，头部还没写入，已有的条目仍然可读。
+	with pytest.raises(OSError):
+		sink._write("study/b.dcm", _BrokenReader(), 2000)
+	assert _read_tar(tmp_path / "study.tar") == {"study/a.dcm": b"a" * 100}
+
+	sink.add_bytes(tmp_path / "study" / "c.dcm", b"c" * 100)
+	sink.close()
+	assert _read_tar(tmp_path / "study.tar") == {"study/a.dcm": b"a" * 100, "study/c.dcm": b"c" * 100}
+
+
+@pytest.mark.parametrize("archive, level", [("zip", 1), ("zip-store", None)])
+def test_zip_compress_level(tmp_path, archive, level):
+	sink = open_archive(tmp_path / "study", archive)
+	try:
+		assert sink._zip.compresslevel == level
+	finally:
+		sink.close()
+
+
+def test_abstract_sink(tmp_path):
+	with pytest.raises(TypeError):
+		ArchiveSink(tmp_path / "study", tmp_path / "study.zip")
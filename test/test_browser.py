@@ -0,0 +1,82 @@
+from types import SimpleNamespace
+
+from crawlers._browser import UrlPattern, BrowserPool
+
+
+def test_infer_url_pattern():
+	pattern = UrlPattern.infer([
+		"https://example.com/s/12/a1b2/0003.dcm?v=2",
+		"https://example.com/s/12/a1b2/0004.dcm?v=2",
+	])
+	assert pattern.format(15) == "https://example.com/s/12/a1b2/0015.dcm?v=2"
+	assert pattern.number("https://example.com/s/12/a1b2/0120.dcm?v=2") == 120
+	assert pattern.number("https://example.com/s/13/a1b2/0120.dcm?v=2") is None
+
+
+def test_infer_url_pattern_failed():
+	assert UrlPattern.infer(["https://example.com/1.dcm"]) is None
+	assert UrlPattern.infer(["https://example.com/a.dcm", "https://example.com/b.dcm"]) is None
+	assert UrlPattern.infer(["https://example.com/1/1.dcm", "https://example.com/2/2.dcm"]) is None
+
+
+async def test_filter_without_stats():
+	aborted = []
+
+	async def abort():
+		aborted.append(True)
+
+	# 回收中的上下文没有统计，拦截时不能出错。
+	request = SimpleNamespace(resource_type="image", url="https://example.com/a.png")
+	await BrowserPool()._filter(object(), SimpleNamespace(request=request, abort=abort))
+	assert aborted == [True]
+
+
+class _FakeContext:
+	"""只实现 BrowserPool._recycle() 用到的方法，记录清除了哪些源的存储。"""
+
+	def __init__(self):
+		self.pages = []
+		self.cleared = []
+
+	async def new_page(self):
+		page = SimpleNamespace(close=self._close_page)
+		self.pages.append(page)
+		return page
+
+	async def _close_page(self):
+		self.pages.pop()
+
+	async def new_cdp_session(self, _):
+		async def send(method, params):
+			assert method == "Storage.clearDataForOrigin"
+			self.cleared.append(params["origin"])
+
+		async def detach():
+			pass
+
+		return SimpleNamespace(send=send, detach=detach)
+
+	async def clear_cookies(self):
+		pass
+
+	async def unroute_all(self, **_):
+		pass
+
+	async def route(self, *_):
+		pass
+
+
+async def test_recycle_clears_storage():
+	pool, context = BrowserPool(), _FakeContext()
+	for url in ["https://a.example.com/share/1", "https://a.example.com/api", "http://b.example.com:8080/x", "data:,"]:
+		pool._on_request(context, SimpleNamespace(url=url))
+
+	# 下一个检查可能是别人的，不能留下 localStorage 之类的数据。
+	assert await pool._recycle(context)
+	assert sorted(context.cleared) == ["http://b.example.com:8080", "https://a.example.com"]
+	assert context.pages == []
+
+	# 清除过的不再清除。
+	context.cleared.clear()
+	assert await pool._recycle(context)
+	assert context.cleared == []
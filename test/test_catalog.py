@@ -0,0 +1,82 @@
+import shutil
+from io import BytesIO
+from pathlib import Path
+
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, CTImageStorage
+
+from crawlers._catalog import Catalog
+from crawlers._fetcher import InstanceFetcher
+from crawlers._utils import SeriesDirectory, fetch_options, FetchOptions
+from tools.catalog import rebuild
+
+
+def _write_dcm(file: Path | BytesIO, patient: str, date: str, modality: str, series: int, index: int):
+	ds = Dataset()
+	ds.file_meta = FileMetaDataset()
+	ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+	ds.PatientName = patient
+	ds.StudyDate = date
+	ds.StudyInstanceUID = f"1.2.{date}"
+	ds.Modality = modality
+	ds.SeriesNumber = series
+	ds.SeriesInstanceUID = f"1.2.{date}.{series}"
+	ds.SOPClassUID = CTImageStorage
+	ds.SOPInstanceUID = f"1.2.{date}.{series}.{index}"
+	ds.InstanceNumber = index
+	if isinstance(file, Path):
+		file.parent.mkdir(parents=True, exist_ok=True)
+	ds.save_as(file, enforce_file_format=True)
+
+
+def test_rebuild_and_find(tmp_path):
+	root = tmp_path / "download"
+	for i in range(3):
+		_write_dcm(root / "A-CT-20240315" / "[1] S" / f"{i}.dcm", "Alice", "20240315", "CT", 1, i)
+	_write_dcm(root / "A-CT-20240315" / "[2] S" / "0.dcm", "Alice", "20240315", "SR", 2, 0)
+	_write_dcm(root / "B-MR-20230101" / "[1] S" / "0.dcm", "Bob", "20230101", "MR", 1, 0)
+	_write_dcm(root / ".store" / "objects" / "0.dcm", "Bob", "20230101", "MR", 1, 0)
+	root.joinpath("A-CT-20240315", "notes.dcm").write_text("不是 DICOM")
+
+	# 头部被截断的也跳过。
+	buffer = BytesIO()
+	_write_dcm(buffer, "Alice", "20240315", "CT", 1, 9)
+	root.joinpath("A-CT-20240315", "broken.dcm").write_bytes(buffer.getvalue()[:142])
+
+	with Catalog(tmp_path / "catalog.db") as catalog:
+		assert rebuild(catalog, root, 2) == (5, 0)
+
+		studies = catalog.find_studies(patient="ali", modality="ct", date_from="2024", date_to="202403")
+		assert len(studies) == 1
+		assert studies[0]["instances"] == 4
+		assert studies[0]["series_count"] == 2
+		assert studies[0]["path"] == str(root.joinpath("A-CT-20240315").absolute())
+
+		assert [s["patient_name"] for s in catalog.find_studies()] == ["Alice", "Bob"]
+		assert catalog.find_studies(date_to="2023") == catalog.find_studies(modality="MR")
+
+		root.joinpath("B-MR-20230101", "[1] S", "0.dcm").unlink()
+		assert rebuild(catalog, root, 2) == (4, 1)
+		assert len(catalog.find_studies()) == 1
+
+
+async def test_add_while_downloading(tmp_path):
+	async def fetch(index: int):
+		buffer = BytesIO()
+		_write_dcm(buffer, "Carol", "20250101", "CT", 1, index)
+		return buffer.getvalue()
+
+	study_dir = Path("download/__test_catalog")
+	token = fetch_options.set(FetchOptions(catalog=str(tmp_path / "catalog.db")))
+	try:
+		fetcher = InstanceFetcher()
+		fetcher.add(SeriesDirectory(study_dir, 1, "S", 3), "S", range(3), fetch)
+		await fetcher.run()
+	finally:
+		fetch_options.reset(token)
+		shutil.rmtree(study_dir, ignore_errors=True)
+
+	with Catalog(tmp_path / "catalog.db") as catalog:
+		studies = catalog.find_studies("Carol")
+		assert studies[0]["instances"] == 3
+		assert studies[0]["path"] == str(study_dir.absolute())
@@ -0,0 +1,95 @@
+import json
+import shutil
+from io import BytesIO
+from pathlib import Path
+
+import pytest
+from pydicom import dcmread
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.fileset import FileSet
+from pydicom.uid import ExplicitVRLittleEndian, CTImageStorage
+
+from crawlers._dicomdir import MANIFEST_FILE, DICOMDIR_FILE
+from crawlers._fetcher import InstanceFetcher
+from crawlers._utils import SeriesDirectory
+
+_study_dir = Path("download/__test_dicomdir")
+
+
+@pytest.fixture(autouse=True)
+def clean_study_dir():
+	yield
+	shutil.rmtree(_study_dir, ignore_errors=True)
+
+
+def _make_dcm(series: int, index: int):
+	ds = Dataset()
+	ds.file_meta = FileMetaDataset()
+	ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+	ds.PatientName = "Test"
+	ds.PatientID = "1"
+	ds.StudyInstanceUID = "1.2.3"
+	ds.StudyDate, ds.StudyTime = "20240101", "120000"
+	ds.Modality = "CT"
+	ds.SeriesNumber = series
+	ds.SeriesInstanceUID = f"1.2.3.{series}"
+	ds.SOPClassUID = CTImageStorage
+	ds.SOPInstanceUID = f"1.2.3.{series}.{index}"
+	ds.InstanceNumber = index + 1
+	buffer = BytesIO()
+	ds.save_as(buffer, enforce_file_format=True)
+	return buffer.getvalue()
+
+
+async def _download(indices):
+	def fetch_of(series):
+		async def fetch(index: int):
+			return _make_dcm(series, index) if index in indices else None
+		return fetch
+
+	fetcher = InstanceFetcher()
+	fetcher.add(SeriesDirectory(_study_dir, 1, "头部 平扫", 3), "A", range(3), fetch_of(1))
+	fetcher.add(SeriesDirectory(_study_dir, 2, "B", 2), "B", range(2), fetch_of(2))
+	await fetcher.run()
+
+
+@pytest.mark.filterwarnings("ignore:The referenced SOP Instance")
+async def test_dicomdir():
+	await _download({0, 1})
+
+	# 第二次运行补上缺少的，索引里应该同时有两次下载的。
+	await _download({0, 1, 2})
+
+	manifest = json.loads(_study_dir.joinpath(MANIFEST_FILE).read_text("utf8"))
+	assert manifest["study"]["uid"] == "1.2.3"
+	assert len(manifest["series"]["1.2.3.1"]["instances"]) == 3
+
+	# FileSet 按偏移量解析记录，偏移量错了会找不到记录。它不按 UTF-8 解码路径，只能找到 B 序列的。
+	ds = dcmread(_study_dir / DICOMDIR_FILE)
+	assert [x.SOPInstanceUID for x in FileSet(ds)] == ["1.2.3.2.0", "1.2.3.2.1"]
+
+	# pydicom 不按 UTF-8 解码路径，所以自己读原始的值。
+	ds = dcmread(_study_dir / DICOMDIR_FILE)
+	images = [r for r in ds.DirectoryRecordSequence if r.DirectoryRecordType == "IMAGE"]
+	for record in images:
+		parts = record.get_item(0x00041500).value.decode().strip().split("\\")
+		instance = dcmread(_study_dir.joinpath(*parts))
+		assert instance.SOPInstanceUID == record.ReferencedSOPInstanceUIDInFile
+
+	assert [r.ReferencedSOPInstanceUIDInFile for r in images] == [
+		"1.2.3.1.0", "1.2.3.1.1", "1.2.3.1.2", "1.2.3.2.0", "1.2.3.2.1",
+	]
+
+
+async def test_restore_after_kill():
+	await _download({0, 1})
+
+	# 模拟进程被强行结束，日志有记录但清单没有保存。
+	_study_dir.joinpath(MANIFEST_FILE).unlink()
+	_study_dir.joinpath(DICOMDIR_FILE).unlink()
+	await _download({0, 1})
+
+	manifest = json.loads(_study_dir.joinpath(MANIFEST_FILE).read_text("utf8"))
+	assert len(manifest["series"]["1.2.3.1"]["instances"]) == 2
+	assert len(manifest["series"]["1.2.3.2"]["instances"]) == 2
+	assert _study_dir.joinpath(DICOMDIR_FILE).is_file()
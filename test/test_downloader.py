@@ -0,0 +1,86 @@
+import asyncio
+import io
+import json
+
+import pytest
+
+import downloader
+from crawlers._utils import fetch_options
+
+
+def test_read_batch(tmp_path):
+	file = tmp_path / "batch.txt"
+	file.write_text("\n".join([
+		"# 注释",
+		"https://a.medicalimagecloud.com/t/1 'pass word' --raw",
+		"",
+		'{"url": "https://m.yzhcloud.com/x", "password": "p", "args": ["--serial"], "options": {"concurrency": 8}}',
+	]), encoding="utf8")
+
+	studies = downloader.read_batch(file)
+	assert studies[0].url == "https://a.medicalimagecloud.com/t/1"
+	assert studies[0].args == ["pass word", "--raw"]
+	assert studies[1].args == ["p", "--serial"]
+	assert studies[1].options == {"concurrency": 8}
+
+
+def test_read_batch_invalid(tmp_path):
+	file = tmp_path / "batch.txt"
+	file.write_text('{"url": "https://x", "options": {"foo": 1}}', encoding="utf8")
+	with pytest.raises(ValueError, match="第 1 行"):
+		downloader.read_batch(file)
+
+
+async def test_batch_limits(monkeypatch):
+	running, peak, seen = {}, {}, []
+
+	class Site:
+		@staticmethod
+		async def run(url, *args):
+			host = url.split("/")[2]
+			running[host] = running.get(host, 0) + 1
+			peak[host] = max(peak.get(host, 0), running[host])
+			seen.append((url, fetch_options.get().concurrency))
+			await asyncio.sleep(0.01)
+			running[host] -= 1
+			if "fail" in url:
+				raise ValueError("boom")
+
+	real_get_site = downloader.get_site
+
+	def get_site(url: str):
+		if "broken" in url:
+			raise ImportError("No module named 'playwright'")
+		return None if "unknown" in url else real_get_site(url) or Site
+
+	monkeypatch.setattr(downloader, "get_site", get_site)
+
+	studies = [downloader._Study(f"https://a/{i}") for i in range(4)]
+	studies += [downloader._Study(f"https://b/{i}", options={"concurrency": 9}) for i in range(4)]
+	studies += [downloader._Study("https://c/fail"), downloader._Study("https://unknown/")]
+	studies += [downloader._Study("https://broken/"), downloader._Study("https://[bad/")]
+
+	results = io.StringIO()
+	batch = downloader._Batch(3, 2, results)
+	async with asyncio.TaskGroup() as group:
+		for study in studies:
+			group.create_task(batch.run_one(study))
+
+	lines = [json.loads(x) for x in results.getvalue().splitlines()]
+	status = {x["url"]: x["status"] for x in lines}
+
+	assert peak["a"] == 2 and peak["b"] <= 2
+	assert status["https://c/fail"] == "error"
+	assert status["https://unknown/"] == "unsupported"
+	assert status["https://broken/"] == "error"
+	assert status["https://[bad/"] == "error"
+	assert batch.failed == 4
+	assert all(c == (9 if "//b/" in u else 4) for u, c in seen)
+
+
+def test_needs_browser():
+	studies = [downloader._Study("https://m.yzhcloud.com/x"), downloader._Study("https://[bad/")]
+	assert not downloader.needs_browser(studies)
+
+	studies.append(downloader._Study("https://yyx.ftimage.cn/x"))
+	assert downloader.needs_browser(studies)
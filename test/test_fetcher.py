@@ -0,0 +1,343 @@
+import asyncio
+import random
+import shutil
+import threading
+from pathlib import Path
+
+import pytest
+from aiohttp import web
+
+# noinspection PyProtectedMember
+from crawlers._fetcher import InstanceFetcher, _SeriesJob
+from crawlers._sink import PARTIAL_DIR, spool
+from crawlers._utils import SeriesDirectory, new_http_client, fetch_options, FetchOptions
+from crawlers._writer import FileWriter
+
+_study_dir = Path("download/__test_fetcher")
+
+
+@pytest.fixture(autouse=True)
+def clean_study_dir():
+	yield
+	shutil.rmtree(_study_dir, ignore_errors=True)
+
+
+def wait_finished(monkeypatch, count: int):
+	"""
+	返回一个 Event，在引擎处理完（保存或跳过）count 个实例后设置，
+	让出错的 fetch 等它，就能确定前面的实例已经写入，不会被取消。
+	"""
+	finished, original = asyncio.Event(), _SeriesJob.finish_one
+	counter = [0]
+
+	def finish_one(job):
+		original(job)
+		counter[0] += 1
+		if counter[0] >= count:
+			finished.set()
+
+	monkeypatch.setattr(_SeriesJob, "finish_one", finish_one)
+	return finished
+
+
+async def test_numbering_is_stable():
+	async def fetch(value: int):
+		await asyncio.sleep(random.uniform(0, 0.01))
+		return str(value).encode()
+
+	fetcher = InstanceFetcher(concurrency=8)
+	fetcher.add(SeriesDirectory(_study_dir, 1, "A", 20), "A", range(20), fetch)
+	await fetcher.run()
+
+	files = sorted(_study_dir.joinpath("[1] A").iterdir())
+	assert [int(f.read_text()) for f in files] == list(range(20))
+
+
+async def test_concurrency_limits():
+	running, peak = {"A": 0, "B": 0, "all": 0}, {"A": 0, "B": 0, "all": 0}
+
+	def fetch_of(key):
+		async def fetch(_):
+			for k in (key, "all"):
+				running[k] += 1
+				peak[k] = max(peak[k], running[k])
+			await asyncio.sleep(0.001)
+			for k in (key, "all"):
+				running[k] -= 1
+			return b""
+		return fetch
+
+	fetcher = InstanceFetcher(concurrency=5, series_concurrency=3)
+	fetcher.add(SeriesDirectory(_study_dir, 1, "A", 10), "A", range(10), fetch_of("A"))
+	fetcher.add(SeriesDirectory(_study_dir, 2, "B", 10), "B", range(10), fetch_of("B"))
+	await fetcher.run()
+
+	# 两个序列怎么分配全局的名额取决于调度的顺序，只能确定不超过上限。
+	assert peak["all"] == 5
+	assert max(peak["A"], peak["B"]) == 3
+	assert peak["A"] <= 3 and peak["B"] <= 3
+
+
+async def test_skip_and_error():
+	async def fetch(value: int):
+		if value == 3:
+			raise ValueError("boom")
+		return None
+
+	fetcher = InstanceFetcher()
+	fetcher.add(SeriesDirectory(_study_dir, None, "A", 5), "A", range(5), fetch)
+
+	with pytest.raises(ValueError):
+		await fetcher.run()
+
+
+async def test_directory_layout():
+	async def fetch(value: int):
+		await asyncio.sleep(value / 1000)
+		return b"" if value >= 0 else None
+
+	# 后面的序列先完成，而第二个全部跳过，结果应该跟逐个下载一样。
+	fetcher = InstanceFetcher(concurrency=8)
+	fetcher.add(SeriesDirectory(_study_dir, None, "A", 2), "A", [30, 30], fetch)
+	fetcher.add(SeriesDirectory(_study_dir, None, "A", 2), "A", [-1, -1], fetch)
+	fetcher.add(SeriesDirectory(_study_dir, None, "A", 2), "A", [1, 1], fetch)
+	await fetcher.run()
+
+	assert sorted(p.name for p in _study_dir.iterdir() if p.is_dir()) == ["A", "A (1)"]
+	assert _study_dir.joinpath("A", "1.dcm").exists()
+
+
+async def test_resume(monkeypatch):
+	fetched, first_run = [], [True]
+	saved = wait_finished(monkeypatch, 3)
+
+	async def fetch(value: int):
+		if value == 3 and first_run[0]:
+			# 等前面的保存完，否则 2 可能还没写入就被取消了。
+			await saved.wait()
+			raise ValueError("boom")
+		await asyncio.sleep(0)
+		fetched.append(value)
+		return str(value).encode() * 10
+
+	def new_fetcher():
+		fetcher = InstanceFetcher(concurrency=1)
+		fetcher.add(SeriesDirectory(_study_dir, 1, "A", 5), "A", range(5), fetch)
+		return fetcher
+
+	with pytest.raises(ValueError):
+		await new_fetcher().run()
+
+	# 第一次在 3 出错，0-2 已下载；再把 1 截断，第二次应该只下载 1、3、4。
+	assert fetched == [0, 1, 2]
+	_study_dir.joinpath("[1] A", "2.dcm").write_bytes(b"1")
+
+	fetched.clear()
+	first_run[0] = False
+	await new_fetcher().run()
+
+	# 检查日志在写入线程里进行，完成的先后不固定。
+	assert sorted(fetched) == [1, 3, 4]
+	assert [p.name for p in _study_dir.iterdir() if p.is_dir()] == ["[1] A"]
+
+
+async def test_object_store():
+	async def fetch(value: int):
+		return str(value % 2).encode() * 100
+
+	def new_fetcher():
+		fetcher = InstanceFetcher()
+		fetcher.add(SeriesDirectory(_study_dir, 1, "A", 4), "A", range(4), fetch)
+		return fetcher
+
+	token = fetch_options.set(FetchOptions(store=str(_study_dir / "store")))
+	try:
+		first = new_fetcher()
+		await first.run()
+
+		# 再次运行时文件都已完整，不会再放入存储。
+		second = new_fetcher()
+		await second.run()
+	finally:
+		fetch_options.reset(token)
+
+	assert len(list(_study_dir.joinpath("store", "objects").glob("*/*"))) == 2
+	assert (first.store.instances, first.store.duplicates, first.store.saved_bytes) == (4, 2, 200)
+	assert second.store.instances == 0
+	files = sorted(_study_dir.joinpath("[1] A").iterdir())
+	assert [f.read_bytes() for f in files] == [b"0" * 100, b"1" * 100] * 2
+	assert not _study_dir.joinpath(PARTIAL_DIR).exists()
+
+
+async def test_resume_with_variant():
+	fetched = []
+
+	async def fetch(value: int):
+		fetched.append(value)
+		return str(value).encode()
+
+	async def download(variant: str):
+		fetcher = InstanceFetcher(variant=variant)
+		fetcher.add(SeriesDirectory(_study_dir, 1, "A", 2), "A", range(2), fetch)
+		await fetcher.run()
+
+	# 选项变了要重新下载，但还是用原来的目录。
+	await download("")
+	await download("raw")
+	await download("raw")
+
+	assert fetched == [0, 1, 0, 1]
+	assert [p.name for p in _study_dir.iterdir() if p.is_dir()] == ["[1] A"]
+
+
+async def test_file_producer():
+	async def produce(path: Path):
+		path.write_bytes(b"produced")
+		return 8, "digest"
+
+	async def fetch(_):
+		return produce
+
+	fetcher = InstanceFetcher()
+	fetcher.add(SeriesDirectory(_study_dir, None, "A", 2), "A", range(2), fetch)
+	await fetcher.run()
+
+	assert _study_dir.joinpath("A", "1.dcm").read_bytes() == b"produced"
+	assert not _study_dir.joinpath(PARTIAL_DIR).exists()
+
+
+async def test_stream_response():
+	body = bytes(range(256)) * 1024
+
+	async def handler(_):
+		return web.Response(body=body)
+
+	app = web.Application()
+	app.router.add_get("/", handler)
+	runner = web.AppRunner(app)
+	await runner.setup()
+	await web.TCPSite(runner, "127.0.0.1", 12348).start()
+
+	try:
+		async with new_http_client() as client:
+			async def fetch(_):
+				return await client.get("http://127.0.0.1:12348")
+
+			fetcher = InstanceFetcher()
+			fetcher.add(SeriesDirectory(_study_dir, None, "A", 3), "A", range(3), fetch)
+			await fetcher.run()
+	finally:
+		await runner.cleanup()
+
+	assert _study_dir.joinpath("A", "2.dcm").read_bytes() == body
+	assert not _study_dir.joinpath(PARTIAL_DIR).exists()
+
+
+async def test_retry_broken_body():
+	body, requests = bytes(range(256)) * 64, []
+
+	# 第一次只发一半就断开连接。
+	async def handler(request):
+		requests.append(True)
+		response = web.StreamResponse(headers={"Content-Length": str(len(body))})
+		await response.prepare(request)
+		if len(requests) > 1:
+			await response.write(body)
+			return response
+		await response.write(body[:1024])
+		request.transport.close()
+		return response
+
+	app = web.Application()
+	app.router.add_get("/", handler)
+	runner = web.AppRunner(app)
+	await runner.setup()
+	await web.TCPSite(runner, "127.0.0.1", 12354).start()
+
+	token = fetch_options.set(FetchOptions(retries=1))
+	try:
+		async with new_http_client() as client:
+			async def fetch(_):
+				return await client.get("http://127.0.0.1:12354")
+
+			fetcher = InstanceFetcher()
+			fetcher.add(SeriesDirectory(_study_dir, None, "A", 1), "A", range(1), fetch)
+			await fetcher.run()
+	finally:
+		fetch_options.reset(token)
+		await runner.cleanup()
+
+	assert len(requests) == 2
+	assert _study_dir.joinpath("A", "1.dcm").read_bytes() == body
+
+
+async def test_spool_release_response():
+	finished = asyncio.Event()
+
+	# 响应体一直没发完，不释放的话连接会被一直占着。
+	async def handler(request):
+		response = web.StreamResponse()
+		await response.prepare(request)
+		await response.write(b"x" * 1024)
+		await finished.wait()
+		return response
+
+	app = web.Application()
+	app.router.add_get("/", handler)
+	runner = web.AppRunner(app)
+	await runner.setup()
+	await web.TCPSite(runner, "127.0.0.1", 12352).start()
+
+	# 临时文件的目录的父级是个文件，创建临时文件会失败。
+	_study_dir.mkdir(parents=True)
+	blocker = _study_dir / "file"
+	blocker.write_bytes(b"")
+
+	try:
+		async with new_http_client() as client, FileWriter() as writer:
+			response = await client.get("http://127.0.0.1:12352")
+			with pytest.raises(OSError):
+				await spool(writer, blocker / PARTIAL_DIR, response)
+
+			# 没读取的响应也要释放，否则连接不会回到连接池。
+			assert response.connection is None
+			assert response.closed
+	finally:
+		finished.set()
+		await runner.cleanup()
+
+
+async def test_file_writer_backpressure():
+	gate = threading.Event()
+
+	async with FileWriter(workers=1, queue_size=2) as writer:
+		await writer.submit(gate.wait)
+		await writer.submit(gate.wait)
+
+		# 队列满了，第三个要等到前面的完成才能提交。
+		third = asyncio.create_task(writer.submit(gate.wait))
+		await asyncio.sleep(0.01)
+		assert not third.done()
+
+		gate.set()
+		await third
+		await writer.drain()
+
+
+async def test_file_writer_drain_error():
+	def fail():
+		raise OSError("disk full")
+
+	async with FileWriter() as writer:
+		# 等它执行完再 drain()，已完成的操作出的错也要抛出。
+		await asyncio.wait([await writer.submit(fail)])
+		with pytest.raises(OSError, match="disk full"):
+			await writer.drain()
+
+		# 异常只抛一次，之后的 drain() 正常返回。
+		await writer.drain()
+
+		# call() 的异常已经抛给了调用方，不会再从 drain() 抛出。
+		with pytest.raises(OSError):
+			await writer.call(fail)
+		await writer.drain()
@@ -0,0 +1,11 @@
+# noinspection PyProtectedMember
+from crawlers.ftimage import _with_series
+
+
+def test_with_series():
+	# 查询参数和文件名里也有序列 ID，只替换路径里那一段。
+	url = "https://example.com/a/b/1234/aaaa/c/7.dcm?s=aaaa"
+	assert _with_series(url, "bbbb") == "https://example.com/a/b/1234/bbbb/c/7.dcm?s=aaaa"
+
+	url = "https://example.com/a/b/aaaa-1/aaaa/c/aaaa.dcm"
+	assert _with_series(url, "bbbb") == "https://example.com/a/b/aaaa-1/bbbb/c/aaaa.dcm"
@@ -0,0 +1,110 @@
+import asyncio
+import json
+from hashlib import sha256
+from io import BytesIO
+
+import pytest
+from pydicom import dcmread
+from pydicom.encaps import generate_frames
+
+from crawlers import hinacom
+from crawlers._capture import CaptureWriter, INDEX_FILE
+
+# noinspection PyProtectedMember
+from crawlers.hinacom import _build_dicom, _DicomEncoder, _get_schema, build_dcm_from_responses
+
+TAGS = [
+	{"tag": "0002,0010", "value": "1.2.840.10008.1.2.1"},
+	{"tag": "0008,0008", "value": "ORIGINAL\\PRIMARY\\AXIAL"},
+	{"tag": "0008,0016", "value": "1.2.840.10008.5.1.4.1.1.2"},
+	{"tag": "0008,0018", "value": "1.2.3.4.5.6.7"},
+	{"tag": "0008,0060", "value": "CT"},
+	{"tag": "0010,0010", "value": "Kaciras"},
+	{"tag": "0018,0050", "value": "5.0"},
+	{"tag": "0020,0013", "value": "7"},
+	{"tag": "0020,0032", "value": "-125\\-125\\30.5"},
+	{"tag": "0028,0010", "value": "4"},
+	{"tag": "0028,0011", "value": "4"},
+	{"tag": "0028,0100", "value": "16"},
+	{"tag": "0029,0010", "value": "Hinacom"},
+	{"tag": "0029,1001", "value": "private"},
+]
+
+PIXELS = bytes(range(32))
+
+# 文件头的长度跟像素的对不上，会被当作 JPEG2000 封装。长度是奇数，测试填充。
+J2K = bytes(16) + b"ftypjp2" + bytes(10)
+
+
+def test_build_dicom():
+	ds = dcmread(BytesIO(_build_dicom(TAGS, PIXELS)))
+
+	assert ds.PatientName == "Kaciras"
+	assert ds.InstanceNumber == 7
+	assert ds.ImagePositionPatient == [-125, -125, 30.5]
+	assert ds.PixelData == PIXELS
+	assert ds[0x0029, 0x1001].VR == "LO"
+	assert ds.file_meta.MediaStorageSOPInstanceUID == "1.2.3.4.5.6.7"
+
+
+@pytest.mark.parametrize("image", [PIXELS, J2K])
+def test_pixels_written_directly(monkeypatch, image):
+	data = _build_dicom(TAGS, image)
+
+	# 让所有标签都算在像素之后，走 pydicom 写像素的路径。
+	monkeypatch.setattr(hinacom, "_PIXEL_DATA", 0)
+	assert data == _build_dicom(TAGS, image)
+
+	ds = dcmread(BytesIO(data))
+	if image is J2K:
+		assert next(generate_frames(ds.PixelData, number_of_frames=1)) == J2K + b"\x00"
+	else:
+		assert ds.PixelData == PIXELS
+
+
+def test_schema_cache():
+	_build_dicom(TAGS, PIXELS)
+	hits = _get_schema.cache_info().hits
+
+	other = [x | {"value": "8"} if x["tag"] == "0020,0013" else x for x in TAGS]
+	ds = dcmread(BytesIO(_build_dicom(other, PIXELS)))
+
+	assert _get_schema.cache_info().hits == hits + 1
+	assert ds.InstanceNumber == 8
+
+
+async def test_encode_in_process_pool(tmp_path):
+	files = [tmp_path / f"{i}.dcm" for i in range(4)]
+	with _DicomEncoder(2) as encoder:
+		results = await asyncio.gather(*(encoder.encode(TAGS, PIXELS)(file) for file in files))
+
+	# 子进程直接写入文件，只返回大小和摘要。
+	expected = _build_dicom(TAGS, PIXELS)
+	assert all(file.read_bytes() == expected for file in files)
+	assert results == [(len(expected), sha256(expected).hexdigest())] * 4
+	assert encoder.count == 4
+
+
+def test_build_from_capture(tmp_path):
+	source, out_dir = tmp_path / "capture", tmp_path / "out"
+	source.joinpath("CT").mkdir(parents=True)
+
+	images = [{}] * 3
+	image_set = {"displaySets": [{"description": "CT", "seriesNumber": 2, "images": images}]}
+	source.joinpath("ImageSet.json").write_text(json.dumps(image_set))
+
+	with CaptureWriter(source / "CT") as capture:
+		capture.append(json.dumps(TAGS).encode(), b"{}", PIXELS)
+		capture.append(b"[]", b"{}", b"")
+		capture.append(json.dumps(TAGS).encode(), b"{}", J2K)
+
+	# 模拟中断时写了一半的索引。
+	with source.joinpath("CT", INDEX_FILE).open("a") as fp:
+		fp.write('{"offset": 9')
+
+	build_dcm_from_responses(source, out_dir, workers=2)
+
+	files = sorted(p.name for p in out_dir.joinpath("[2] CT").iterdir())
+	assert files == ["1.dcm", "3.dcm"]
+	assert out_dir.joinpath("[2] CT", "1.dcm").read_bytes() == _build_dicom(TAGS, PIXELS)
+	assert out_dir.joinpath("[2] CT", "3.dcm").read_bytes() == _build_dicom(TAGS, J2K)
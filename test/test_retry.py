@@ -0,0 +1,35 @@
+from aiohttp import web
+
+from crawlers._retry import parse_retry_after
+from crawlers._utils import new_http_client
+
+
+def test_parse_retry_after():
+	assert parse_retry_after("120") == 120
+	assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0
+	assert parse_retry_after("invalid") is None
+	assert parse_retry_after(None) is None
+
+
+async def test_retry_transient_errors():
+	calls = []
+
+	async def flaky(_):
+		calls.append(1)
+		if len(calls) < 3:
+			return web.Response(status=503, headers={"Retry-After": "0"})
+		return web.Response(text="OK")
+
+	app = web.Application()
+	app.router.add_get("/", flaky)
+	runner = web.AppRunner(app)
+	await runner.setup()
+	await web.TCPSite(runner, "127.0.0.1", 12347).start()
+
+	try:
+		async with new_http_client() as client:
+			async with client.get("http://127.0.0.1:12347") as response:
+				assert await response.text() == "OK"
+		assert len(calls) == 3
+	finally:
+		await runner.cleanup()
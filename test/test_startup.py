@@ -0,0 +1,46 @@
+import re
+import subprocess
+import sys
+from pathlib import Path
+
+# 启动并选好站点的总耗时上限（微秒），目前大约 0.4 秒，留足余量以免在慢机器上误报。
+_BUDGET = 1_500_000
+
+# 普通 HTTP 的网站不应该加载这些库。
+_HEAVY = ("playwright", "Cryptodome")
+
+_LINE = re.compile(r"import time:\s+\d+ \|\s+(\d+) \|( *)\S")
+
+
+def _import_times(code: str):
+	"""
+	用 -X importtime 运行代码，返回顶层模块的累计耗时，以及所有导入的模块名。
+	import_module 导入的模块本身不会出现在 importtime 的输出里（它导入的仍会），所以名字从 sys.modules 取。
+	"""
+	code += "\nimport sys; print(*sys.modules)"
+	process = subprocess.run(
+		[sys.executable, "-X", "importtime", "-c", code],
+		cwd=Path(__file__).parent.parent,
+		capture_output=True,
+		text=True,
+		check=True,
+	)
+	total = 0
+	for match in _LINE.finditer(process.stderr):
+		if len(match[2]) == 1:
+			total += int(match[1])
+	return total, set(process.stdout.split())
+
+
+def test_plain_site_startup():
+	total, names = _import_times("import downloader; downloader.get_site('https://work.sugh.net:8002/pc')")
+
+	assert "crawlers.sugh" in names
+	for name in names:
+		assert name.split(".")[0] not in _HEAVY
+	assert total < _BUDGET, f"启动耗时 {total / 1000:.0f}ms 超过了 {_BUDGET / 1000:.0f}ms"
+
+
+def test_unsupported_site():
+	_, names = _import_times("import downloader; assert downloader.get_site('https://example.com') is None")
+	assert not any(name.startswith("crawlers.") and name[9] != "_" for name in names)
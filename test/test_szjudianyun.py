@@ -0,0 +1,227 @@
+import json
+import shutil
+from contextlib import AsyncExitStack, asynccontextmanager
+from io import BytesIO
+from pathlib import Path
+
+import pytest
+from aiohttp import web
+from pydicom import dcmread
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, CTImageStorage
+
+from crawlers._utils import new_http_client
+from crawlers import szjudianyun
+from crawlers._writer import FileWriter
+# noinspection PyProtectedMember
+from crawlers.szjudianyun import _Pipeline, _Session, _SeriesCheck, download_study, separator
+
+
+def _check(message, _, data):
+	return data == message["series_in"].encode()
+
+
+async def _serve_and_fetch(reply_order, window=4):
+	"""
+	启动一个模拟的服务端，它对每个请求回复 451 消息和以序号为内容的二进制帧，
+	reply_order 决定收到一个请求后要发送哪些请求的回复。
+	"""
+	received = []
+
+	async def handler(request):
+		ws = web.WebSocketResponse()
+		await ws.prepare(request)
+		async for message in ws:
+			received.append(json.loads(message.data[2:])[1]["series_in"])
+			for series_in in reply_order(received):
+				await ws.send_str('451-["hangC",{"_placeholder":true,"num":0}]')
+				await ws.send_bytes(b"\x04" + series_in.encode())
+		return ws
+
+	app = web.Application()
+	app.router.add_get("/", handler)
+	runner = web.AppRunner(app)
+	await runner.setup()
+	await web.TCPSite(runner, "127.0.0.1", 12349).start()
+
+	try:
+		async with new_http_client() as client:
+			async with client.ws_connect("http://127.0.0.1:12349") as ws:
+				pipeline = _Pipeline(ws, window, timeout=0.5, settle=0.2)
+				messages = [{"series": "A", "series_in": str(i)} for i in range(10)]
+				results = [x async for x in pipeline.fetch(messages, _check)]
+				return pipeline, results
+	finally:
+		await runner.cleanup()
+
+
+def _in_order(received):
+	return received[-1:]
+
+
+async def test_pipeline_in_order():
+	pipeline, results = await _serve_and_fetch(_in_order)
+	assert results == [str(i).encode() for i in range(10)]
+	assert pipeline.window == 4
+
+
+@pytest.mark.parametrize("window", [1, 4])
+async def test_pipeline_window(window):
+	# 只在收到 window 个请求之后才开始回复，窗口不够时会卡住直到超时回退。
+	def reply_order(received):
+		if len(received) < window:
+			return []
+		if len(received) == window:
+			return received
+		return received[-1:]
+
+	pipeline, results = await _serve_and_fetch(reply_order, window)
+	assert results == [str(i).encode() for i in range(10)]
+	assert pipeline.fallbacks == 0
+
+
+async def test_fall_back_when_reordered():
+	# 前两个的回复交换了顺序。
+	def reply_order(received):
+		if len(received) == 1:
+			return []
+		if len(received) == 2:
+			return received[::-1]
+		return received[-1:]
+
+	pipeline, results = await _serve_and_fetch(reply_order)
+	assert results == [str(i).encode() for i in range(10)]
+	assert pipeline.window == 1
+	assert pipeline.fallbacks == 1
+
+
+async def test_fall_back_when_dropped():
+	def reply_order(received):
+		return [] if len(received) == 3 else received[-1:]
+
+	pipeline, results = await _serve_and_fetch(reply_order)
+	assert results == [str(i).encode() for i in range(10)]
+	assert pipeline.window == 1
+
+
+def _make_dcm(series: str, index: str):
+	ds = Dataset()
+	ds.file_meta = FileMetaDataset()
+	ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+	ds.PatientName = "Test"
+	ds.Modality = "CT"
+	ds.StudyDescription = "CT"
+	ds.StudyDate, ds.StudyTime = "20240101", "120000"
+	ds.SeriesNumber = int(series[1:])
+	ds.SeriesDescription = series
+	ds.SeriesInstanceUID = f"1.2.{ds.SeriesNumber}"
+	ds.SOPClassUID = CTImageStorage
+	ds.SOPInstanceUID = f"1.2.{ds.SeriesNumber}.{index}"
+	buffer = BytesIO()
+	ds.save_as(buffer, enforce_file_format=True)
+	return buffer.getvalue()
+
+
+def test_series_check():
+	check = _SeriesCheck(dcmread(BytesIO(_make_dcm("S1", "0"))))
+	assert check(None, "", _make_dcm("S1", "1"))
+	assert not check(None, "", _make_dcm("S1", "1"))
+	assert not check(None, "", _make_dcm("S2", "2"))
+
+	# 损坏的回复不抛异常，让流水线回退到逐个请求。
+	assert not check(None, "", b"not a dicom file")
+	assert not check(None, "", _make_dcm("S1", "3")[:200])
+
+
+async def _handle_hang(request):
+	ws = web.WebSocketResponse()
+	await ws.prepare(request)
+	async for message in ws:
+		args = json.loads(message.data[2:])[1]
+		await ws.send_str('451-["hangC",{"_placeholder":true,"num":0}]')
+		await ws.send_bytes(b"\x04" + _make_dcm(args["series"], args["series_in"]))
+	return ws
+
+
+_info = {
+	"hosipital": f"H{separator}S",
+	"series": ["s1", "s2", "dfyfilm1"],
+	"series_dicom_number": {"s1": 40, "s2": 3, "dfyfilm1": 1},
+}
+
+_study_dir = Path("download/Test-CT-20240101120000")
+
+
+@asynccontextmanager
+async def _serve():
+	app = web.Application()
+	app.router.add_get("/", _handle_hang)
+	runner = web.AppRunner(app)
+	await runner.setup()
+	await web.TCPSite(runner, "127.0.0.1", 12349).start()
+	try:
+		yield
+	finally:
+		await runner.cleanup()
+		shutil.rmtree(_study_dir, ignore_errors=True)
+
+
+async def _download(connections=2):
+	"""用 connections 个连接下载 _info 描述的检查，返回各个会话。"""
+	async with new_http_client() as client, AsyncExitStack() as stack:
+		sessions = []
+		for i in range(connections):
+			ws = await stack.enter_async_context(client.ws_connect("http://127.0.0.1:12349"))
+			sessions.append(_Session(i, ws, 4))
+		async with FileWriter() as writer:
+			await download_study(sessions, writer, _info)
+			await writer.drain()
+		return sessions
+
+
+async def test_download_with_sessions():
+	async with _serve():
+		sessions = await _download()
+
+		files = sorted(_study_dir.joinpath("[1] s1").iterdir())
+		assert len(files) == 40
+		assert dcmread(files[-1]).SOPInstanceUID == "1.2.1.40"
+		assert len(list(_study_dir.joinpath("[2] s2").iterdir())) == 3
+
+		# 两个连接都分到了任务。
+		assert sessions[0].count + sessions[1].count == 43
+		assert sessions[0].count > 0 and sessions[1].count > 0
+
+
+async def test_resume():
+	async with _serve():
+		await _download()
+
+		# 删掉一个，截断一个，再次下载应该只补上这两个，而且不创建新的目录。
+		series_dir = _study_dir / "[1] s1"
+		files = sorted(series_dir.iterdir())
+		files[10].unlink()
+		files[20].write_bytes(b"1")
+
+		sessions = await _download()
+		assert sorted(p.name for p in _study_dir.iterdir()) == [".journal.jsonl", "[1] s1", "[2] s2"]
+
+		# 每个序列的第一张总是要下载的，用来确定目录的名字。
+		assert sessions[0].count + sessions[1].count == 2 + 2
+		assert dcmread(files[10]).SOPInstanceUID == "1.2.1.11"
+		assert dcmread(files[20]).SOPInstanceUID == "1.2.1.21"
+
+
+async def test_write_error(monkeypatch):
+	original = szjudianyun._save
+
+	def save(journal, job, index, data):
+		if index == 5:
+			raise OSError("disk full")
+		original(journal, job, index, data)
+
+	# 写入在线程池里进行，出错也不能当作下载成功。
+	monkeypatch.setattr(szjudianyun, "_save", save)
+	async with _serve():
+		with pytest.raises(OSError, match="disk full"):
+			await _download()
@@ -0,0 +1,50 @@
+import asyncio
+import time
+
+# noinspection PyProtectedMember
+from crawlers._throttle import _HostWindow, percentile
+
+
+def test_percentile():
+	values = list(range(1, 101))
+	assert percentile(values, 50) == 51
+	assert percentile(values, 90) == 91
+	assert percentile(values, 100) == 100
+
+
+async def test_additive_increase():
+	window = _HostWindow(2, 8, 2.0)
+	for _ in range(40):
+		await window.acquire()
+		await window.acquire()
+		started = time.monotonic()
+		window.release(started, 200)
+		window.release(started, 200)
+
+	assert 2 < window.limit <= 8
+
+
+async def test_multiplicative_decrease():
+	window = _HostWindow(8, 8, 2.0)
+	await window.acquire()
+	window.release(time.monotonic(), 503)
+	assert window.limit == 4
+
+	# 减小之前发出的请求不再重复减小。
+	started = time.monotonic() - 1
+	await window.acquire()
+	window.release(started, 429)
+	assert window.limit == 4
+
+
+async def test_wait_for_slot():
+	window = _HostWindow(1, 1, 2.0)
+	await window.acquire()
+
+	waiter = asyncio.create_task(window.acquire())
+	await asyncio.sleep(0)
+	assert not waiter.done()
+
+	window.release(time.monotonic(), 200)
+	await asyncio.wait_for(waiter, 1)
+	assert window.in_flight == 1
@@ -0,0 +1,100 @@
+import shutil
+from io import BytesIO
+from pathlib import Path
+
+import numpy as np
+import pytest
+from pydicom import dcmread
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.pixels import get_encoder
+from pydicom.uid import ExplicitVRLittleEndian, CTImageStorage, RLELossless
+
+from crawlers._fetcher import InstanceFetcher
+from crawlers._journal import StudyJournal
+from crawlers._transcode import SYNTAXES
+from crawlers._utils import SeriesDirectory, fetch_options, FetchOptions
+
+_study_dir = Path("download/__test_transcode")
+
+
+def _pixels(index: int):
+	rng = np.random.default_rng(index)
+	return rng.integers(0, 4096, (64, 48), dtype=np.uint16)
+
+
+def _make_dcm(index: int, pixels=True):
+	ds = Dataset()
+	ds.file_meta = FileMetaDataset()
+	ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+	ds.StudyInstanceUID = "1.2.3"
+	ds.SeriesInstanceUID = "1.2.3.1"
+	ds.SOPClassUID = CTImageStorage
+	ds.SOPInstanceUID = f"1.2.3.1.{index}"
+	if pixels:
+		ds.Rows, ds.Columns = 64, 48
+		ds.SamplesPerPixel, ds.PhotometricInterpretation = 1, "MONOCHROME2"
+		ds.BitsAllocated, ds.BitsStored, ds.HighBit, ds.PixelRepresentation = 16, 12, 11, 0
+		ds.PixelData = _pixels(index).tobytes()
+	buffer = BytesIO()
+	ds.save_as(buffer, enforce_file_format=True)
+	return buffer.getvalue()
+
+
+@pytest.mark.parametrize("name", ["rle", "jpeg2000"])
+async def test_transcode(name):
+	if not get_encoder(SYNTAXES[name]).is_available:
+		pytest.skip(f"{name} 编码器不可用")
+
+	async def fetch(index: int):
+		return _make_dcm(index, pixels=index != 2)
+
+	token = fetch_options.set(FetchOptions(transcode=name, processes=2))
+	try:
+		fetcher = InstanceFetcher()
+		fetcher.add(SeriesDirectory(_study_dir, 1, "S", 3), "S", range(3), fetch)
+		await fetcher.run()
+
+		series_dir = _study_dir / "[1] S"
+		for index in range(2):
+			ds = dcmread(series_dir / f"{index + 1}.dcm")
+			assert ds.file_meta.TransferSyntaxUID == SYNTAXES[name]
+			assert ds.SOPInstanceUID == f"1.2.3.1.{index}"
+			assert np.array_equal(ds.pixel_array, _pixels(index))
+
+		# 没有像素的原样保存。
+		assert (series_dir / "3.dcm").read_bytes() == _make_dcm(2, pixels=False)
+
+		# 日志记录的是转码后的大小，断点续传不会重新下载。
+		journal = StudyJournal(_study_dir)
+		assert journal.is_complete(f"0/S|{name}", 0, series_dir / "1.dcm")
+		journal.close()
+	finally:
+		fetch_options.reset(token)
+		shutil.rmtree(_study_dir, ignore_errors=True)
+
+
+async def test_not_dicom_or_truncated():
+	if not get_encoder(SYNTAXES["rle"]).is_available:
+		pytest.skip("rle 编码器不可用")
+
+	# 有些服务器出错时返回 HTML 页面，扩展名仍然是 dcm。
+	# 还有在文件头里和数据集里截断的。
+	page = b"<html><body>502 Bad Gateway</body></html>"
+	broken = [page, _make_dcm(1)[:142], _make_dcm(2)[:477]]
+
+	async def fetch(index: int):
+		return broken[index] if index < len(broken) else _make_dcm(index)
+
+	token = fetch_options.set(FetchOptions(transcode="rle", processes=1))
+	try:
+		fetcher = InstanceFetcher()
+		fetcher.add(SeriesDirectory(_study_dir, 1, "S", 4), "S", range(4), fetch)
+		await fetcher.run()
+
+		series_dir = _study_dir / "[1] S"
+		for index, data in enumerate(broken):
+			assert (series_dir / f"{index + 1}.dcm").read_bytes() == data
+		assert dcmread(series_dir / "4.dcm").file_meta.TransferSyntaxUID == RLELossless
+	finally:
+		fetch_options.reset(token)
+		shutil.rmtree(_study_dir, ignore_errors=True)
@@ -5,7 +5,8 @@ from aiohttp import web, ClientResponseError
 from pytest import mark
 
 # noinspection PyProtectedMember
-from crawlers._utils import pathify, new_http_client, make_unique_dir
+from crawlers._connector import ConnectionPool
+from crawlers._utils import pathify, new_http_client, make_unique_dir, fetch_options, FetchOptions
 
 
 @mark.parametrize('text, expected', [
@@ -31,6 +32,8 @@ async def test_response_dumping():
 	site = web.TCPSite(runner, '[::1]', 12345)
 	await site.start()
 
+	# 不重试，否则要等重试的退避时间。
+	token = fetch_options.set(FetchOptions(retries=0))
 	client = new_http_client()
 	try:
 		await client.get('http://[::1]:12345')
@@ -38,10 +41,95 @@ async def test_response_dumping():
 	except ClientResponseError:
 		assert Path("dump.zip").exists()
 	finally:
+		fetch_options.reset(token)
 		await runner.cleanup()
 		Path("dump.zip").unlink(missing_ok=True)
 
 
+async def test_retry_then_dump(capsys):
+	received = []
+
+	async def unavailable(_):
+		received.append(True)
+		return web.Response(status=503, headers={"Retry-After": "0"})
+
+	app = web.Application()
+	app.router.add_get('/', unavailable)
+	runner = web.AppRunner(app)
+	await runner.setup()
+	await web.TCPSite(runner, '127.0.0.1', 12353).start()
+
+	# 打开了连接池时，各个会话共用它的重试策略，失败累计到同一个断路器上。
+	token = fetch_options.set(FetchOptions(retries=1))
+	try:
+		async with ConnectionPool(retries=1) as pool:
+			for _ in range(2):
+				async with new_http_client() as client:
+					with pytest.raises(ClientResponseError):
+						await client.get('http://127.0.0.1:12353')
+
+			# 重试完仍然失败才转储，每个会话只有一次。
+			assert len(received) == 4
+			assert capsys.readouterr().err.count("dump.zip") == 2
+			assert pool.retry_policy.retried == 2
+			assert pool.retry_policy.circuits['127.0.0.1'].failures == 4
+			assert "重试 2 次" in pool.summary()
+	finally:
+		fetch_options.reset(token)
+		await runner.cleanup()
+		Path("dump.zip").unlink(missing_ok=True)
+
+
+async def ok(_):
+	return web.Response(text='OK')
+
+
+async def test_shared_connection_pool():
+	app = web.Application()
+	app.router.add_get('/', ok)
+	runner = web.AppRunner(app)
+	await runner.setup()
+	await web.TCPSite(runner, '127.0.0.1', 12350).start()
+
+	try:
+		async with ConnectionPool(limit_per_host=1) as pool:
+			# 两个会话先后请求同一个主机，第二个会话复用第一个留下的连接。
+			for _ in range(2):
+				async with new_http_client() as client:
+					for _ in range(2):
+						async with client.get('http://127.0.0.1:12350') as response:
+							assert await response.text() == 'OK'
+
+			assert not pool.connector.closed
+			assert (pool.misses, pool.hits) == (1, 3)
+			assert pool.hosts['127.0.0.1'].hits == 3
+			assert "命中率 75%" in pool.summary()
+
+		assert pool.connector.closed
+	finally:
+		await runner.cleanup()
+
+
+async def test_connection_pool_no_keepalive():
+	app = web.Application()
+	app.router.add_get('/', ok)
+	runner = web.AppRunner(app)
+	await runner.setup()
+	await web.TCPSite(runner, '127.0.0.1', 12351).start()
+
+	try:
+		# 0 表示用完即关闭，每个请求都新建连接。
+		async with ConnectionPool(keepalive_timeout=0) as pool:
+			async with new_http_client() as client:
+				for _ in range(3):
+					async with client.get('http://127.0.0.1:12351') as response:
+						assert await response.text() == 'OK'
+
+			assert (pool.misses, pool.hits) == (3, 0)
+	finally:
+		await runner.cleanup()
+
+
 def test_make_unique_dir():
 	path = Path("download/__test_dir")
 	created = make_unique_dir(path)
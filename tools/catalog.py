@@ -0,0 +1,81 @@
+"""
+查询和重建已下载影像的目录（见 crawlers/_catalog.py），例如：
+
+python -m tools.catalog rebuild download
+python -m tools.catalog find --patient 张三 --modality CT --from 202403 --to 202403
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from tqdm import tqdm
+
+from crawlers._catalog import Catalog, read_header
+
+DEFAULT_FILE = "download/catalog.db"
+
+
+def _walk(root: Path):
+	"""列出所有 DCM 文件，跳过 . 开头的目录（对象存储、临时文件等）。"""
+	for directory, dirs, files in os.walk(root):
+		dirs[:] = [d for d in dirs if not d.startswith(".")]
+		for name in files:
+			if name.endswith(".dcm"):
+				yield Path(directory, name)
+
+
+def rebuild(catalog: Catalog, root: Path, workers: int = None):
+	"""
+	用多个进程读取 root 下所有 DCM 文件的头部，添加到目录，然后删除文件已不存在的记录。
+	"""
+	files = list(_walk(root))
+	added = 0
+	with ProcessPoolExecutor(workers) as executor:
+		headers = executor.map(read_header, files, chunksize=64)
+		for header in tqdm(headers, total=len(files), unit="张"):
+			if header:
+				catalog.add(header)
+				added += 1
+	return added, catalog.remove_missing()
+
+
+def _print_study(study: dict):
+	size = (study["size"] or 0) / 1048576
+	print(f"{study['date'] or '-'} {study['patient_name'] or '-'} {study['modalities'] or '-'} "
+		  f"{study['description'] or ''}  {study['series_count']} 个序列 {study['instances']} 张 {size:.1f}MB")
+	print(f"    {study['path']}")
+
+
+def main():
+	parser = argparse.ArgumentParser(description="已下载影像的目录")
+	parser.add_argument("--db", default=DEFAULT_FILE, help=f"数据库文件，默认为 {DEFAULT_FILE}")
+	commands = parser.add_subparsers(dest="command", required=True)
+
+	command = commands.add_parser("rebuild", help="扫描目录下的 DCM 文件重建目录")
+	command.add_argument("root", nargs="?", default="download", help="下载目录，默认为 download")
+	command.add_argument("--processes", type=int, metavar="N", help="读取文件的进程数，默认跟 CPU 核数相同")
+
+	command = commands.add_parser("find", help="查找检查")
+	command.add_argument("--patient", help="患者姓名或 ID 包含的文字")
+	command.add_argument("--modality", help="模态，如 CT、MR")
+	command.add_argument("--from", dest="date_from", metavar="DATE", help="检查日期的下限，如 20240301")
+	command.add_argument("--to", dest="date_to", metavar="DATE", help="检查日期的上限，可以只写年份或年月")
+
+	args = parser.parse_args()
+	with Catalog(Path(args.db)) as catalog:
+		if args.command == "rebuild":
+			start = time.perf_counter()
+			added, removed = rebuild(catalog, Path(args.root), args.processes)
+			elapsed = time.perf_counter() - start
+			return print(f"添加了 {added} 个实例，删除了 {removed} 个不存在的，用时 {elapsed:.1f} 秒")
+
+		studies = catalog.find_studies(args.patient, args.modality, args.date_from, args.date_to)
+		for study in studies:
+			_print_study(study)
+		print(f"共 {len(studies)} 个检查")
+
+
+if __name__ == "__main__":
+	main()